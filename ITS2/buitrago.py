@@ -9,8 +9,9 @@ plt.rcParams['svg.fonttype'] = 'none'
 import matplotlib.gridspec as gridspec
 import pandas as pd
 import os
+import sys
 from matplotlib.patches import Rectangle
-from matplotlib.collections import PatchCollection
+from matplotlib.collections import PatchCollection, PathCollection, PolyCollection
 from itertools import chain
 from matplotlib.colors import ListedColormap
 import numpy as np
@@ -19,6 +20,203 @@ import re
 import itertools
 import pickle
 import skbio
+from scipy.spatial.distance import pdist, squareform
+from scipy.stats import rankdata
+from scipy.stats import t as t_dist
+from scipy import sparse
+from scipy.cluster.hierarchy import linkage, fcluster, dendrogram
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import tempfile
+import glob
+import shutil
+import io
+import json
+import threading
+import hashlib
+import inspect
+import time
+from buitrago_data import ProfileDIVIncidence, ProfileRepresentatives, SampleMetaIndex, SPAbundance, SPAbundanceCube
+from buitrago_jobs import get_backend, seeded_chunks
+from buitrago_stats import (
+    MANTEL_TOLERANCE, abs_hist, bc_sqrt_linkage, bootstrap_dendro_chunk, bootstrap_profile_chunk, bootstrap_worker_init,
+    clade_keys, clr_centred, cooccurrence_blocks, cooccurrence_perm_chunk, cooccurrence_worker_init,
+    env_scan_perm_chunk, env_scan_t_stats, env_scan_worker_init, indval_perm_chunk, indval_stats, indval_worker_init,
+    mantel_perm_chunk, mantel_worker_init, partial_r
+)
+
+def _read_input_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _parse_input(kind, data):
+    """
+    Parse the raw bytes of an input file.
+    :param kind: 'lines' (list of lines), 'csv' (df with the first column as index), 'table' (tab separated df),
+    'dist' (SymPortal .dist file as a df with no header), 'seq' or 'profile' (SymPortal count table as an SPAbundance)
+    or 'asv_zip' (zipped 16S ASV table as an SPAbundance)
+    """
+    if kind == 'lines':
+        return [_.rstrip() for _ in data.decode('utf-8').splitlines()]
+    elif kind == 'csv':
+        return pd.read_csv(io.BytesIO(data), index_col=0)
+    elif kind == 'table':
+        return pd.read_table(io.BytesIO(data))
+    elif kind == 'dist':
+        return pd.read_table(io.BytesIO(data), header=None)
+    elif kind == 'seq':
+        return SPAbundance.from_seq_count_table(io.BytesIO(data))
+    elif kind == 'profile':
+        return SPAbundance.from_profile_count_table(io.BytesIO(data))
+    elif kind == 'asv_zip':
+        return SPAbundance.from_zipped_asv_table(io.BytesIO(data))
+    raise ValueError(f"Unknown input kind {kind}")
+
+
+class InputCache:
+    """
+    An on disk cache of parsed inputs that is shared between analyses, SymPortal runs and processes.
+
+    Entries are keyed by the absolute path, size and modification time of the input (so modified inputs are
+    re-parsed) and its kind. The distance matrices of .dist files are stored as .npy files (with the names and uids
+    in a .json) that are memory mapped when loaded (see dist_memmap). All other parsed inputs are pickled.
+    Entries are written to a temporary file and then moved into place so concurrent writers are safe.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _stub(self, path, kind):
+        stat = os.stat(path)
+        key = hashlib.sha1(
+            f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{kind}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{kind}_{key}")
+
+    def _write(self, final_path, write):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=os.path.splitext(final_path)[1])
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, final_path)
+
+    def load(self, path, kind):
+        """The cached parsed input or None if it is not cached"""
+        stub = self._stub(path, kind)
+        if kind == 'dist':
+            if not os.path.exists(stub + '.npy'):
+                return None
+            names, uids, values = self._load_dist(stub)
+            # The same layout as the parsed .dist file (name, uid, distances)
+            return pd.concat([
+                pd.DataFrame({0: names, 1: uids}),
+                pd.DataFrame(np.asarray(values), columns=range(2, len(names) + 2))
+            ], axis=1)
+        if not os.path.exists(stub + '.p'):
+            return None
+        with open(stub + '.p', 'rb') as f:
+            return pickle.load(f)
+
+    def store(self, path, kind, parsed):
+        stub = self._stub(path, kind)
+        if kind == 'dist':
+            meta = {'names': parsed[0].tolist(), 'uids': parsed[1].tolist()}
+            # The .json is written first as the .npy marks the entry as complete
+            self._write(stub + '.json', lambda f: f.write(json.dumps(meta).encode('utf-8')))
+            self._write(stub + '.npy', lambda f: np.save(f, parsed.iloc[:, 2:].to_numpy(dtype=float)))
+        else:
+            self._write(stub + '.p', lambda f: pickle.dump(parsed, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def _load_dist(stub):
+        with open(stub + '.json') as f:
+            meta = json.load(f)
+        return meta['names'], meta['uids'], np.load(stub + '.npy', mmap_mode='r')
+
+    def dist_memmap(self, path):
+        """
+        The names, uids and read only memory mapped square distance array of a .dist file
+        (parsed and cached first if it is not already cached).
+        """
+        stub = self._stub(path, 'dist')
+        if not os.path.exists(stub + '.npy'):
+            self.store(path, 'dist', _parse_input('dist', _read_input_bytes(path)))
+        return self._load_dist(stub)
+
+
+class InputPrefetcher:
+    """
+    Read and parse input files concurrently.
+
+    Every submitted file is read on a thread pool (the reads are latency rather than CPU bound) and, once read,
+    the CPU bound parses (count tables, distance matrices and tables) are handed to a process pool while
+    the small files are parsed on the reading thread. Each input is read once and consumers get a
+    Future of the parsed result so that the wall time of a cold start is bounded by the slowest single input
+    rather than the sum of all of them. If given an InputCache, inputs that are already cached are loaded from it
+    and newly parsed inputs are added to it.
+
+    e.g.
+        prefetcher = BuitragoMantel.prefetch(dist_type='bc')
+        BuitragoMantel(dist_type='bc', prefetcher=prefetcher)
+    """
+    cpu_bound_kinds = ('table', 'dist', 'seq', 'profile', 'asv_zip')
+
+    def __init__(self, n_threads=16, n_proc=None, cache=None):
+        """
+        :param n_proc: The number of parsing processes. 0 to parse everything on the reading threads.
+        :param cache: An optional InputCache
+        """
+        self.n_proc = n_proc if n_proc is not None else min(4, os.cpu_count())
+        self.cache = cache
+        self._thread_pool = ThreadPoolExecutor(max_workers=n_threads)
+        self._process_pool = None
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(path, kind):
+        return os.path.abspath(path), kind
+
+    def submit(self, path, kind):
+        """Start reading and parsing a file (if not already started). :return: Future of the parsed input"""
+        key = self._key(path, kind)
+        with self._lock:
+            if key not in self._futures:
+                self._futures[key] = self._thread_pool.submit(self._fetch, path, kind)
+            return self._futures[key]
+
+    def has(self, path, kind):
+        return self._key(path, kind) in self._futures
+
+    def result(self, path, kind):
+        return self.submit(path, kind).result()
+
+    def _fetch(self, path, kind):
+        if self.cache is not None:
+            cached = self.cache.load(path, kind)
+            if cached is not None:
+                return cached
+        data = _read_input_bytes(path)
+        if kind in self.cpu_bound_kinds and self.n_proc:
+            with self._lock:
+                if self._process_pool is None:
+                    self._process_pool = ProcessPoolExecutor(max_workers=self.n_proc)
+            parsed = self._process_pool.submit(_parse_input, kind, data).result()
+        else:
+            parsed = _parse_input(kind, data)
+        if self.cache is not None:
+            self.cache.store(path, kind, parsed)
+        return parsed
+
+    def shutdown(self):
+        self._thread_pool.shutdown()
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
 
 class Buitrago:
     """
@@ -28,16 +226,24 @@ class Buitrago:
     pver.ind.ordered.byclusters.txt
     spis.ind.ordered.byclusters.txt
     We will get the reef info from the name.
+
+    Inputs are read through self._read_input so that they can be prefetched (see InputPrefetcher and prefetch).
+    The names of the inputs each analysis needs are listed in its inputs class attribute. The base inputs include the
+    genetic cluster strata as every analysis using get_meta_index (or get_cube) reads them.
     """
-    def __init__(self, dist_type):
+    inputs = ('pver_samples', 'spis_samples', 'sym_dist', 'pver_strata', 'spis_strata')
+
+    def __init__(self, dist_type, prefetcher=None, sp_output_dir=None):
         self.root_dir = os.path.dirname(os.path.abspath(__file__))
         self.plotting_dir = os.path.join(self.root_dir, "plots")
+        self.prefetcher = prefetcher
+        self.input_path_dict = self._input_path_dict(dist_type, sp_output_dir)
 
         # Absolute abundance count table paths
-        self.seq_count_table_path = os.path.join(self.root_dir,
-                                                 'sp_output/post_med_seqs/131_20201203_DBV_20201207T095144.seqs.absolute.abund_and_meta.txt')
-        self.profile_count_table_path = os.path.join(self.root_dir,
-                                                     'sp_output/its2_type_profiles/131_20201203_DBV_20201207T095144.profiles.absolute.abund_and_meta.txt')
+        self.seq_count_table_path = self.input_path_dict['seq'][0]
+        self.profile_count_table_path = self.input_path_dict['profile'][0]
+        # Profile count table where the profiles have been clustered by having 3 or more DIVs in common
+        self.clustered_profile_count_table_path = self.input_path_dict['profile_clustered'][0]
 
         # dfs that hold reef and region info
         self.pver_df = self._make_pver_df()
@@ -60,24 +266,105 @@ class Buitrago:
         # Determine the samples for plotting that contain Symbiodinium
         # Run SPHier through blank to get the list of samples we have in the A matrix
         # THen find the interset of samples listed in the self.pver and self.spis dfs.
-        if dist_type == 'bc':
-            self.symbiodinium_dist_path = 'sp_output/between_sample_distances/A/20201207T095144_braycurtis_sample_distances_A_sqrt.dist'
-        elif dist_type == 'uf':
-            self.symbiodinium_dist_path = 'sp_output/between_sample_distances/A/20201207T095144_unifrac_sample_distances_A_sqrt.dist'
+        self.symbiodinium_dist_path = self.input_path_dict['sym_dist'][0]
 
-        self.sph = SPHierarchical(dist_output_path=self.symbiodinium_dist_path, no_plotting=True)
-        self.symbiodinium_names = self.sph.obj_name_to_obj_uid_dict.keys()
+        if self.prefetcher is not None:
+            # The names and uids are the first two columns of the already parsed .dist file
+            sym_dist_df = self._read_input(self.symbiodinium_dist_path, 'dist')
+            obj_name_to_obj_uid_dict = dict(zip(sym_dist_df[0], sym_dist_df[1]))
+        else:
+            self.sph = SPHierarchical(dist_output_path=self.symbiodinium_dist_path, no_plotting=True)
+            obj_name_to_obj_uid_dict = self.sph.obj_name_to_obj_uid_dict
+        self.symbiodinium_names = obj_name_to_obj_uid_dict.keys()
         self.symbiodinium_host_names = set(self.symbiodinium_names).intersection(set(self.all_samples_df.index))
         self.symbiodinium_sample_uid_to_sample_name_dict = {
-            k: v for k, v in self.sph.obj_name_to_obj_uid_dict.items() if k in self.symbiodinium_host_names
+            k: v for k, v in obj_name_to_obj_uid_dict.items() if k in self.symbiodinium_host_names
         }
         self.symbiodinium_sample_uid_to_sample_name_dict = {
             v: k for k, v in self.symbiodinium_sample_uid_to_sample_name_dict.items()
         }
 
+    @staticmethod
+    def _input_path_dict(dist_type, sp_output_dir=None):
+        """
+        The path and kind (see _parse_input) of every named input.
+        :param sp_output_dir: The SymPortal output directory of the submission to analyse. The count tables and
+        distance files are found within it by their SymPortal suffixes so that any submission can be used.
+        The clustered profile count table, sample lists, genetic cluster strata and reef info are looked for in the
+        directory containing sp_output_dir and otherwise in the directory of this script.
+        By default the sp_output directory next to this script (the 131_20201203_DBV_20201207T095144 submission).
+        """
+        root_dir = os.path.dirname(os.path.abspath(__file__))
+        sp_output_dir = sp_output_dir if sp_output_dir else os.path.join(root_dir, 'sp_output')
+        study_dir = os.path.dirname(os.path.abspath(sp_output_dir))
+        dist_name = {'bc': 'braycurtis', 'uf': 'unifrac'}[dist_type]
+
+        def sp_output_file(pattern):
+            # The latest matching file (SymPortal file names start with the submission time stamp)
+            # or the pattern itself if there is no match so that reading it fails with the expected location
+            matches = sorted(glob.glob(os.path.join(sp_output_dir, pattern)))
+            return matches[-1] if matches else os.path.join(sp_output_dir, pattern)
+
+        def study_file(pattern):
+            for directory in [study_dir, root_dir]:
+                matches = sorted(glob.glob(os.path.join(directory, pattern)))
+                if matches:
+                    return matches[-1]
+            return os.path.join(study_dir, pattern)
+
+        profile_count_table_path = sp_output_file('its2_type_profiles/*.profiles.absolute.abund_and_meta.txt')
+        clustered_profile_count_table_path = study_file('*.profiles.absolute.abund_and_meta.clustered.tsv')
+        input_path_dict = {
+            'pver_samples': (study_file("pver.ind.ordered.byclusters.txt"), 'lines'),
+            'spis_samples': (study_file("spis.ind.ordered.byclusters.txt"), 'lines'),
+            'sym_dist': (
+                sp_output_file(f'between_sample_distances/A/*_{dist_name}_sample_distances_A_sqrt.dist'), 'dist'),
+            'sym_pcoa': (
+                sp_output_file(f'between_sample_distances/A/*_{dist_name}_sample*_PCoA_coords_A_sqrt.csv'), 'csv'),
+            'seq': (sp_output_file('post_med_seqs/*.seqs.absolute.abund_and_meta.txt'), 'seq'),
+            'profile': (profile_count_table_path, 'profile'),
+            'profile_clustered': (clustered_profile_count_table_path, 'profile'),
+            'profile_table': (profile_count_table_path, 'table'),
+            'profile_clustered_table': (clustered_profile_count_table_path, 'table'),
+            # The .txt version of the clustered profile count table read by BuitragoBars
+            'profile_clustered_txt_table': (os.path.splitext(clustered_profile_count_table_path)[0] + '.txt', 'table'),
+            'pver_strata': (study_file('pver.genclust.strata.K*.csv'), 'csv'),
+            'spis_strata': (study_file('spis.genclust.strata.K*.csv'), 'csv'),
+            'reef_temp': (study_file('reef_temp.csv'), 'csv'),
+            'reef_coords': (study_file('reef_coords.csv'), 'csv'),
+            # The QC filtered 16S ASV table of the 16S directory next to the ITS2 directory
+            '16S': (study_file(os.path.join('..', '16S', 'SpisPver_ASVs_QCfiltered.txt.zip')), 'asv_zip'),
+        }
+        for clade in ['A', 'C', 'D']:
+            input_path_dict[f'profile_dist_{clade}'] = (
+                sp_output_file(f'between_profile_distances/{clade}/*_braycurtis_profile_distances_{clade}_sqrt.dist'),
+                'dist')
+        return input_path_dict
+
+    @classmethod
+    def prefetch(cls, dist_type='bc', prefetcher=None, sp_output_dir=None):
+        """
+        Start reading and parsing all of the inputs of this analysis (cls.inputs) concurrently.
+        :return: the InputPrefetcher to pass to the analysis as its prefetcher
+        """
+        prefetcher = prefetcher if prefetcher else InputPrefetcher()
+        input_path_dict = cls._input_path_dict(dist_type, sp_output_dir)
+        for name in cls.inputs:
+            prefetcher.submit(*input_path_dict[name])
+        return prefetcher
+
+    def _read_input(self, path, kind):
+        """
+        The parsed input from the prefetcher (and its cache) if there is one, otherwise read and parsed now.
+        dfs are copied so that consumers can modify them.
+        """
+        if self.prefetcher is not None:
+            parsed = self.prefetcher.result(path, kind)
+            return parsed.copy() if isinstance(parsed, pd.DataFrame) else parsed
+        return _parse_input(kind, _read_input_bytes(path))
+
     def _make_spis_df(self):
-        with open("spis.ind.ordered.byclusters.txt", "r") as f:
-            spis_to_plot = [_.rstrip() for _ in f]
+        spis_to_plot = self._read_input(*self.input_path_dict['spis_samples'])
         spis_df_list = []
         for _ in spis_to_plot:
             # list of sample name, reef, region
@@ -90,8 +377,7 @@ class Buitrago:
         return spis_df
 
     def _make_pver_df(self):
-        with open("pver.ind.ordered.byclusters.txt", "r") as f:
-            pver_to_plot = [_.rstrip() for _ in f]
+        pver_to_plot = self._read_input(*self.input_path_dict['pver_samples'])
         pver_df_list = []
         for _ in pver_to_plot:
             # list of sample name, reef, region
@@ -101,6 +387,176 @@ class Buitrago:
         df = pd.DataFrame(pver_df_list, columns=['sample_name', 'reef', 'region'])
         return df.set_index('sample_name')
 
+    def _read_genetic_clusters(self):
+        """Series of sample name to genetic cluster e.g. pver_CL2, from the .genclust.strata files"""
+        ser_list = []
+        for species in ['pver', 'spis']:
+            strata_df = self._read_input(*self.input_path_dict[f'{species}_strata'])
+            ser_list.append(species + "_" + strata_df["STRATA"])
+        return pd.concat(ser_list)
+
+    def _load_abundance(self, feature_set):
+        """
+        Load one of the count tables as an SPAbundance.
+        :param feature_set: 'seq', 'profile' or 'profile_clustered'
+        """
+        if feature_set not in ['seq', 'profile', 'profile_clustered']:
+            raise ValueError(f"Unknown feature set {feature_set}")
+        return self._read_input(*self.input_path_dict[feature_set])
+
+    def _make_sample_meta_df(self):
+        """The species, region, reef and genetic cluster of every sample in self.all_samples_df"""
+        meta_df = self.all_samples_df[['reef', 'region']].copy()
+        meta_df['species'] = ['pver' if _[0] == 'P' else 'spis' for _ in meta_df.index]
+        meta_df['cluster'] = self._read_genetic_clusters().reindex(meta_df.index).fillna('NA')
+        return meta_df
+
+    def get_cube(self, feature_set):
+        """
+        The SPAbundanceCube for one of the count tables ('seq', 'profile' or 'profile_clustered').
+        Built on first request and then reused.
+        """
+        if not hasattr(self, '_cubes'):
+            self._cubes = {}
+        if feature_set not in self._cubes:
+            self._cubes[feature_set] = SPAbundanceCube(
+                abundance=self._load_abundance(feature_set), sample_meta_df=self._make_sample_meta_df())
+        return self._cubes[feature_set]
+
+    def get_meta_index(self):
+        """
+        The SampleMetaIndex of the samples in self.all_samples_df (regions ordered as self.regions).
+        Built on first request and then reused.
+        """
+        if not hasattr(self, '_meta_index'):
+            self._meta_index = SampleMetaIndex(
+                self._make_sample_meta_df(), categories={'species': ['pver', 'spis'], 'region': self.regions})
+        return self._meta_index
+
+    def get_div_incidence(self):
+        """
+        The ProfileDIVIncidence of the profiles of the profile count table.
+        Built on first request and then reused.
+        """
+        if not hasattr(self, '_div_incidence'):
+            self._div_incidence = ProfileDIVIncidence.from_abundance(self._load_abundance('profile'))
+        return self._div_incidence
+
+    def _reef_boundaries(self, sample_names):
+        """The positions at which the reef changes between consecutive samples of an ordered list of sample names"""
+        meta_index = self.get_meta_index()
+        return meta_index.boundaries('reef', meta_index.take(sample_names))
+
+    def _plot_meta_runs(self, ax, meta, sample_names, x_coords, width, vertical=False):
+        """
+        Plot a set of meta info ('region' or 'species') as categorical colors for samples at the given x coordinates.
+        Consecutive samples of the same category are drawn as a single rectangle. Samples not in the
+        meta index (e.g. negative samples) are black.
+        If vertical, the samples are at the given y coordinates (and the strip spans x 0 to 1).
+        """
+        meta_index = self.get_meta_index()
+        rows = meta_index.take(sample_names)
+        if meta == 'region':
+            color_dict = self.region_color_dict
+        else:
+            color_dict = {'pver': self.species_color_dict['P'], 'spis': self.species_color_dict['S']}
+        starts, lengths, _ = meta_index.runs(meta, rows)
+        x_coords = np.asarray(x_coords, dtype=float)
+        x0 = x_coords[starts] - width / 2
+        x1 = x_coords[starts + lengths - 1] + width / 2
+        zeros, ones = np.zeros(len(starts)), np.ones(len(starts))
+        verts = np.stack([np.c_[x0, zeros], np.c_[x1, zeros], np.c_[x1, ones], np.c_[x0, ones]], axis=1)
+        if vertical:
+            verts = verts[:, :, ::-1]
+        ax.add_collection(PolyCollection(
+            verts, facecolors=list(meta_index.colors(meta, color_dict, rows[starts])), edgecolors='face'))
+
+    def _read_sp_dist_df(self, dist_path):
+        """Read a SymPortal .dist file (name, uid, distances) into a square df indexed by name"""
+        dist_df = self._read_input(dist_path, 'dist')
+        names = dist_df[0].values
+        dist_df = dist_df.iloc[:, 2:]
+        dist_df.index = names
+        dist_df.columns = names
+        return dist_df
+
+
+    def _compact_bar_ax(self, ax, rasterize=True):
+        """
+        Make the bars of a bar axis compact for vector output.
+        All rectangles (Rectangle patches and PatchCollections of rectangles) are collected, adjacent rectangles of
+        the same colour are merged and each colour is then drawn as a single compound path.
+        If rasterize, the merged bar layer is rasterized when saved to .svg or .pdf (at the savefig dpi)
+        while the text, lines (e.g. the reef boundary hlines/vlines), legends and axes stay as vectors.
+        """
+        rects = []
+        for patch in list(ax.patches):
+            if isinstance(patch, Rectangle):
+                rects.append((
+                    patch.get_x(), patch.get_y(), patch.get_x() + patch.get_width(),
+                    patch.get_y() + patch.get_height(), mpl.colors.to_hex(patch.get_facecolor(), keep_alpha=True)
+                ))
+                patch.remove()
+        for collection in list(ax.collections):
+            if not isinstance(collection, PatchCollection):
+                continue
+            facecolors = collection.get_facecolor()
+            for i, path in enumerate(collection.get_paths()):
+                x0, y0, x1, y1 = path.get_extents().extents
+                rects.append((x0, y0, x1, y1, mpl.colors.to_hex(facecolors[i % len(facecolors)], keep_alpha=True)))
+            collection.remove()
+        if not rects:
+            return
+        rect_df = pd.DataFrame(rects, columns=['x0', 'y0', 'x1', 'y1', 'color']).round(9)
+        for color, color_df in rect_df.groupby('color'):
+            merged = self._merge_touching_rects(
+                self._merge_touching_rects(color_df[['x0', 'y0', 'x1', 'y1']].values, axis=0), axis=1)
+            vertices = np.stack([
+                merged[:, [0, 1]], merged[:, [2, 1]], merged[:, [2, 3]], merged[:, [0, 3]], merged[:, [0, 1]]
+            ], axis=1).reshape(-1, 2)
+            codes = np.tile(
+                [mpl.path.Path.MOVETO, mpl.path.Path.LINETO, mpl.path.Path.LINETO,
+                 mpl.path.Path.LINETO, mpl.path.Path.CLOSEPOLY], len(merged))
+            collection = PathCollection(
+                [mpl.path.Path(vertices, codes)], facecolors=[color], edgecolors='none', linewidths=0,
+                transform=ax.transData
+            )
+            # Keep the bars below the reef boundary lines
+            collection.set_zorder(1)
+            collection.set_rasterized(rasterize)
+            ax.add_collection(collection, autolim=False)
+
+    @staticmethod
+    def _merge_touching_rects(rects, axis):
+        """
+        Merge rectangles (rows of x0, y0, x1, y1) that share the same extent on the other axis and
+        touch along the given axis (0 is x, 1 is y).
+        """
+        start, other_start, end, other_end = (0, 1, 2, 3) if axis == 0 else (1, 0, 3, 2)
+        rects = rects[np.lexsort((rects[:, start], rects[:, other_end], rects[:, other_start]))]
+        merged = [rects[0].copy()]
+        for rect in rects[1:]:
+            last = merged[-1]
+            if (
+                    rect[other_start] == last[other_start] and rect[other_end] == last[other_end] and
+                    np.isclose(rect[start], last[end])
+            ):
+                last[end] = max(last[end], rect[end])
+            else:
+                merged.append(rect.copy())
+        return np.array(merged)
+
+    def _savefig_bars(self, path_stub, compact_vectors, raster_dpi, bar_axes):
+        """Save the current figure as .svg, .pdf and .png optionally compacting the vector output of the bar axes"""
+        if compact_vectors:
+            for ax in bar_axes:
+                self._compact_bar_ax(ax, rasterize=True)
+            plt.savefig(f"{path_stub}.svg", dpi=raster_dpi)
+            plt.savefig(f"{path_stub}.pdf", dpi=raster_dpi)
+        else:
+            plt.savefig(f"{path_stub}.svg")
+            plt.savefig(f"{path_stub}.pdf")
+        plt.savefig(f"{path_stub}.png", dpi=600)
 
     def _mm2inch(self, *tupl):
         inch = 25.4
@@ -113,16 +569,14 @@ class Buitrago:
 class BuitragoOrdinations(Buitrago):
     """Plot PCoA ordinations. In the end this code was not used and rather the plots were made in R so that they were compatible
     with the 16S plots. See script plot_buitrago.R"""
+    inputs = Buitrago.inputs + ('sym_pcoa',)
+
     # We have the list of Symbiodinium samples that also have related host sample data
     # read in the pcoA coords and keep only the samples that are in
-    def __init__(self, dist_type='bc'):
-        super().__init__(dist_type=dist_type)
-        if dist_type == 'bc':
-            self.pcoa_df = pd.read_csv(
-                'sp_output/between_sample_distances/A/20201207T095144_braycurtis_samples_PCoA_coords_A_sqrt.csv')
-        else:
-            self.pcoa_df = pd.read_csv(
-                'sp_output/between_sample_distances/A/20201207T095144_unifrac_sample_PCoA_coords_A_sqrt.csv')
+    def __init__(self, dist_type='bc', prefetcher=None, sp_output_dir=None):
+        super().__init__(dist_type=dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
+        # The braycurtis or unifrac PCoA coordinates according to dist_type
+        self.pcoa_df = self._read_input(*self.input_path_dict['sym_pcoa']).reset_index()
         self.pcoa_df.set_index('sample', inplace=True)
         # Plot species wise
         # four components per species
@@ -131,18 +585,18 @@ class BuitragoOrdinations(Buitrago):
 
 
         # Then Plot up species by ordination
-        for species, species_df in zip(['Pocillopra', 'Stylophora'],[self.pver_df, self.spis_df]):
+        meta_index = self.get_meta_index()
+        for species, species_code in zip(['Pocillopra', 'Stylophora'], ['pver', 'spis']):
             for pc in ['PC2', 'PC3', 'PC4', 'PC5']:
                 ax = next(self.ax_gen)
                 for region in self.region_color_dict.keys():
                     for reef in self.reef_marker_shape_dict.keys():
 
                         #Get the samples that are of the given region, reef and in the symbiodinium host samples
-                        plot_df = species_df[
-                            (species_df['REGION'] == region) &
-                            (species_df['REEF'].str.contains(reef))
+                        sym_host_plot = [
+                            _ for _ in meta_index.names(species=species_code, region=region, reef=f'{region}-{reef}')
+                            if _ in self.symbiodinium_host_names
                         ]
-                        sym_host_plot = [_ for _ in plot_df.index if _ in self.symbiodinium_host_names]
                         plot_df = self.pcoa_df.loc[sym_host_plot, :]
                         edgecolors = None
                         if reef == 'R4':
@@ -217,9 +671,23 @@ class BuitragoHier_split_species(Buitrago):
     """
     Plot up a series of dendrograms
     This dendogram will be split by species and we will perform clustering for each species and plot this up as well
+    If incremental_profiles, the profile representatives saved by a previous run (representatives_path, by default
+    profile_representatives.p in the directory of this script) are loaded and only the profiles that they do not
+    already contain are assigned (see ProfileRepresentatives) so that the existing representatives and their colours
+    stay the same. The updated representatives are then saved back for the next run.
+    Otherwise all profiles are clustered from scratch and nothing is saved.
+    If a BuitragoBootstrap is given (bootstrap) the support of the clades is written on the dendrograms.
     """
-    def __init__(self, dist_type='bc', consolidate_profiles=True):
-        super().__init__(dist_type=dist_type)
+    inputs = Buitrago.inputs + ('profile', 'profile_table')
+
+    def __init__(
+            self, dist_type='bc', consolidate_profiles=True, incremental_profiles=False,
+            representatives_path=None, bootstrap=None, prefetcher=None, sp_output_dir=None
+    ):
+        super().__init__(dist_type=dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
+        self.incremental_profiles = incremental_profiles
+        self.representatives_path = representatives_path if representatives_path else os.path.join(
+            self.root_dir, 'profile_representatives.p')
 
         # setup fig
         # 6 rows for the dendro and 1 for the coloring by species
@@ -273,6 +741,17 @@ class BuitragoHier_split_species(Buitrago):
             zip(self.sph_pver.dendrogram['ivl'], self.x_coords_pver)
         }
 
+        if bootstrap is not None:
+            for species, ax, name_to_coord_dict in [
+                ('spis', self.dendro_ax_spis, self.sample_name_to_x_coord_dict_spis),
+                ('pver', self.dendro_ax_pver, self.sample_name_to_x_coord_dict_pver)
+            ]:
+                # The dendrogram leaves are the sample uids
+                bootstrap.annotate_dendrogram(ax, species, leaf_x_dict={
+                    self.symbiodinium_sample_uid_to_sample_name_dict[uid]: x
+                    for uid, x in name_to_coord_dict.items()
+                })
+
         self._plot_meta_info_ax(ax=self.region_ax_spis, meta='region',  name_to_coord_dict=self.sample_name_to_x_coord_dict_spis, x_coords=self.x_coords_spis)
 
 
@@ -304,9 +783,11 @@ class BuitragoHier_split_species(Buitrago):
             bar_ax=self.prof_bars_ax_spis
         )
         self.profile_color_dict = spb.profile_color_dict
-        profile_count_df_abund = pd.read_csv(self.profile_count_table_path, sep='\t', skiprows=[1, 2, 3, 4, 5, 6],
-                                             skipfooter=2, engine='python')
-        profile_count_df_meta = pd.read_csv(self.profile_count_table_path, sep='\t', index_col=0)
+        profile_table_df = self._read_input(*self.input_path_dict['profile_table'])
+        # The sample rows (below the 6 rows of profile meta info and above the 2 footer rows) reparsed so that
+        # the counts and sample uids are numeric
+        profile_count_df_abund = pd.read_table(io.StringIO(profile_table_df.iloc[6:-2].to_csv(sep='\t', index=False)))
+        profile_count_df_meta = profile_table_df.set_index(profile_table_df.columns[0])
         self.profile_count_df_meta = profile_count_df_meta.drop(profile_count_df_meta.columns[0], axis=1)
         profile_uid_to_profile_name_dict = {
             p_uid: p_name for p_uid, p_name in profile_count_df_meta.loc['ITS2 type profile'].items()
@@ -381,66 +862,35 @@ class BuitragoHier_split_species(Buitrago):
         ax.set_ylabel("profiles", rotation='vertical', fontsize='xx-small')
 
     def cluster_profiles(self):
-        profile_to_div_set_dict = defaultdict(set)
-        for sample_uid in self.profile_count_df_abund.index:
-            # get the list of profiles in the sample
-            ser = self.profile_count_df_abund.loc[sample_uid]
-            non_z = ser[ser != 0].keys()
-            for prof_uid in non_z:
-                if prof_uid not in profile_to_div_set_dict:
-                    prof_name = self.profile_count_df_meta.at["ITS2 type profile", prof_uid]
-                    prof_divs = set(filter(None, re.split("[/\-]+", prof_name)))
-                    profile_to_div_set_dict[prof_uid] = prof_divs
+        # The profiles found in any sample, in order of first appearance (sample by sample)
+        abund = self.profile_count_df_abund.values
+        sample_rows, prof_cols = np.nonzero(abund != 0)
+        prof_cols = pd.unique(prof_cols)
+        prof_uids = [self.profile_count_df_abund.columns[_] for _ in prof_cols]
+        # The column labels of the count table are the profile uids as strings
+        div_set_dict = self.get_div_incidence().div_sets([int(float(_)) for _ in prof_uids])
+        profile_to_div_set_dict = {
+            prof_uid: div_set_dict[int(float(prof_uid))] for prof_uid in prof_uids
+        }
         # Here we have a collection of all of the profiles found in the pver
         # Now work out the representatives
-        rep_divs_to_profiles = defaultdict(list)
-        for profile_outer, div_outer in profile_to_div_set_dict.items():
-            set_of_representatives = set()
-            for profile_inner, div_inner in profile_to_div_set_dict.items():
-                if not profile_inner == profile_outer:
-                    divs_in_common = div_outer.intersection(div_inner)
-                    if len(div_outer.intersection(div_inner)) >= 3:
-                        # THen these can be merged
-                        divs_in_common_as_string = ",".join(sorted(divs_in_common))
-                        set_of_representatives.add(divs_in_common_as_string)
-            if set_of_representatives:
-                if len(set_of_representatives) == 1:
-                    rep_divs_to_profiles[list(set_of_representatives)[0]].append(profile_outer)
-                else:
-                    # Make a bunch of 3 tuples of the sets and see which of these is found
-                    # in the largest number of the list_of_representatives
-                    all_divs = set()
-                    for div_set in set_of_representatives:
-                        all_divs.update(set(div_set.split(',')))
-                    three_tup_abund_dict = defaultdict(int)
-                    for three_tup in itertools.combinations(all_divs, 3):
-                        three_set = set(three_tup)
-                        for div_str in set_of_representatives:
-                            div_set = set(div_str.split(","))
-                            if three_set.issubset(div_set):
-                                three_tup_abund_dict[three_tup] += 1
-                    # Now take the most abundant
-                    sorted_tups = sorted(three_tup_abund_dict.items(), key=lambda x: x[1], reverse=True)
-                    biggest = sorted_tups[0][1]
-                    next = sorted_tups[1][1]
-                    if biggest > next:
-                        # all good
-                        div_rep = ",".join(sorted(sorted_tups[0][0]))
-                        rep_divs_to_profiles[div_rep].append(profile_outer)
-                    else:
-                        if {"C21", "C21n", "C21r"}.issubset(div_outer):
-                            rep_divs_to_profiles['C21,C21n,C21r'].append(profile_outer)
-                        else:
-                            print("we have a problem")
-        prof_to_rep_dict = {}
+        if self.incremental_profiles and os.path.exists(self.representatives_path):
+            self.profile_representatives = ProfileRepresentatives.load(self.representatives_path)
+            assigned = self.profile_representatives.assign(profile_to_div_set_dict)
+            print(f"Assigned {len(assigned)} new profiles to the saved representatives")
+        else:
+            self.profile_representatives = ProfileRepresentatives.from_div_sets(profile_to_div_set_dict)
+        if self.incremental_profiles:
+            self.profile_representatives.save(self.representatives_path)
         # Create a new column in the profile count table
-        for k, v in rep_divs_to_profiles.items():
+        for k, v in self.profile_representatives.rep_divs_to_profiles.items():
+            # The saved representatives may hold profiles that are not in this count table
+            v = [_ for _ in v if _ in self.profile_count_df_abund_clustered.columns]
+            if not v:
+                continue
             self.profile_count_df_abund_clustered[k] = self.profile_count_df_abund_clustered[v].sum(axis=1)
             self.profile_count_df_abund_clustered.drop(columns=list(v), inplace=True)
-        for k, v in rep_divs_to_profiles.items():
-            for prof_uid in v:
-                prof_to_rep_dict[prof_uid] = v[0]
-        return prof_to_rep_dict
+        return self.profile_representatives.prof_to_rep_dict()
 
     def _plot_region_leg_ax(self):
         self.region_ax_legend.set_xlim(0, 1)
@@ -491,28 +941,10 @@ class BuitragoHier_split_species(Buitrago):
         :return: None
         """
         width = 10
-        rectangles = []
-        for sample_uid, x_coord in name_to_coord_dict.items():
-            if self.symbiodinium_sample_uid_to_sample_name_dict[sample_uid][0] in ['S', 'P']:
-                if meta == 'region':
-                    c = self.region_color_dict[self.all_samples_df.at[self.symbiodinium_sample_uid_to_sample_name_dict[sample_uid], 'region']]
-                    rectangles.append(Rectangle(
-                        (x_coord - width / 2, 0),
-                        width,
-                        1, color=c))
-                elif meta == 'species':
-                    rectangles.append(Rectangle(
-                        (x_coord - width / 2, 0),
-                        width,
-                        1, color=self.species_color_dict[self.symbiodinium_sample_uid_to_sample_name_dict[sample_uid][0]]))
-            else:
-                # negative sample
-                rectangles.append(Rectangle(
-                    (x_coord - width / 2, 0),
-                    width,
-                    1, color='black'))
-        patches_collection = PatchCollection(rectangles, match_original=True)
-        ax.add_collection(patches_collection)
+        self._plot_meta_runs(
+            ax=ax, meta=meta,
+            sample_names=[self.symbiodinium_sample_uid_to_sample_name_dict[_] for _ in name_to_coord_dict.keys()],
+            x_coords=list(name_to_coord_dict.values()), width=width)
         ax.set_xlim((x_coords[0] - width, x_coords[-1] + width))
         # Remove the axis ticks
         ax.set_xticks([])
@@ -523,8 +955,8 @@ class BuitragoHier(Buitrago):
     """
     Plot up a series of dendrograms
     """
-    def __init__(self, dist_type='bc'):
-        super().__init__(dist_type=dist_type)
+    def __init__(self, dist_type='bc', prefetcher=None, sp_output_dir=None):
+        super().__init__(dist_type=dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
 
         # setup fig
         # 6 rows for the dendro and 1 for the coloring by species
@@ -597,28 +1029,10 @@ class BuitragoHier(Buitrago):
         :return: None
         """
         width = 10
-        rectangles = []
-        for sample_uid, x_coord in self.sample_name_to_x_coord_dict.items():
-            if self.symbiodinium_sample_uid_to_sample_name_dict[sample_uid][0] in ['S', 'P']:
-                if meta == 'region':
-                    c = self.region_color_dict[self.all_samples_df.at[self.symbiodinium_sample_uid_to_sample_name_dict[sample_uid], 'region']]
-                    rectangles.append(Rectangle(
-                        (x_coord - width / 2, 0),
-                        width,
-                        1, color=c))
-                elif meta == 'species':
-                    rectangles.append(Rectangle(
-                        (x_coord - width / 2, 0),
-                        width,
-                        1, color=self.species_color_dict[self.symbiodinium_sample_uid_to_sample_name_dict[sample_uid][0]]))
-            else:
-                # negative sample
-                rectangles.append(Rectangle(
-                    (x_coord - width / 2, 0),
-                    width,
-                    1, color='black'))
-        patches_collection = PatchCollection(rectangles, match_original=True)
-        ax.add_collection(patches_collection)
+        self._plot_meta_runs(
+            ax=ax, meta=meta,
+            sample_names=[self.symbiodinium_sample_uid_to_sample_name_dict[_] for _ in self.sample_name_to_x_coord_dict.keys()],
+            x_coords=list(self.sample_name_to_x_coord_dict.values()), width=width)
         ax.set_xlim((self.x_coords[0] - width, self.x_coords[-1] + width))
         # Remove the axis ticks
         ax.set_xticks([])
@@ -626,8 +1040,18 @@ class BuitragoHier(Buitrago):
         ax.set_ylabel(meta, rotation='vertical', fontsize='xx-small')
 
 class BuitragoBars(Buitrago):
-    def __init__(self, dist_type='bc', cluster_profiles=True):
-        super().__init__(dist_type)
+    """
+    Plot the north to south genera, sequence and profile bars for each species.
+    With compact_vectors, same colour bar segments are merged and the bar layers are rasterized
+    (at raster_dpi) in the .svg and .pdf outputs while the text, legends, lines and axes stay as editable vectors.
+    """
+    inputs = Buitrago.inputs + ('profile_table', 'profile_clustered_txt_table')
+
+    def __init__(
+            self, dist_type='bc', cluster_profiles=True, compact_vectors=False, raster_dpi=600,
+            prefetcher=None, sp_output_dir=None
+    ):
+        super().__init__(dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
         self.bar_figures_dir = os.path.join(self.root_dir, "bar_figures")
         # self.fig = plt.figure(figsize=self._mm2inch((200, 320)))
         # bars to legends at ratio of 4:1
@@ -644,12 +1068,12 @@ class BuitragoBars(Buitrago):
 
         # create an instance of SPBars just to generate a seq and profile dict for the whole dataset
         # then use this dictionary for plotting the actual plots.
-        if cluster_profiles:
-            self.profile_count_table_path = "/Users/benjaminhume/Documents/projects/20210113_buitrago/ITS2/131_20201203_DBV_20201207T095144.profiles.absolute.abund_and_meta.clustered.txt"
+        profile_table = 'profile_clustered_txt_table' if cluster_profiles else 'profile_table'
+        self.profile_count_table_path = self.input_path_dict[profile_table][0]
 
         # We want to work out the number of profiles before and after clustering in spis and pver samples
         # This code works. Just uncomment to do the plotting.
-        prof_count_df = pd.read_table(self.profile_count_table_path)
+        prof_count_df = self._read_input(*self.input_path_dict[profile_table])
         prof_count_df = prof_count_df.iloc[6:,]
         cols = list(prof_count_df)
         cols[1] = "sample_name"
@@ -761,28 +1185,26 @@ class BuitragoBars(Buitrago):
                 ax[0].set_yticks([])
                 ax[0].set_title(self.titles[(3*i)+j], fontsize='small')
                 # Need to add a black line for each of the reef borders
-                reef = df.iloc[0]["reef"]
-                lines = []
-                line_colors = []
-                line_widths = []
-                for k, ind in enumerate(df.index.values):
-                    new_reef = df.at[ind, "reef"]
-                    if new_reef != reef:
-                        reef = new_reef
-                        # Then we need to plot a black line at k - 0.5
-                        lines.append(k-0.5)
-                        line_colors.append("black")
-                        line_widths.append(2)
-                ax[0].vlines(x=lines, ymin=0, ymax=1, colors=line_colors, linewidths=line_widths)
-                plt.savefig(os.path.join(self.plotting_dir, f"{self.titles[(3 * i) + j]}.bars.svg"))
-                plt.savefig(os.path.join(self.plotting_dir, f"{self.titles[(3*i)+j]}.bars.pdf"))
-                plt.savefig(os.path.join(self.plotting_dir, f"{self.titles[(3*i)+j]}.bars.png",), dpi=600)
+                lines = self._reef_boundaries(df.index.values) - 0.5
+                ax[0].vlines(x=lines, ymin=0, ymax=1, colors="black", linewidths=2)
+                self._savefig_bars(
+                    os.path.join(self.plotting_dir, f"{self.titles[(3 * i) + j]}.bars"),
+                    compact_vectors=compact_vectors, raster_dpi=raster_dpi, bar_axes=[ax[0]])
                 plt.close(fig)
                 foo = "bar"
 
 class BuitragoBars_clustered_profiles(Buitrago):
-    def __init__(self, dist_type='bc', cluster_profiles=True):
-        super().__init__(dist_type)
+    """
+    A modification of BuitragoBars to plot the clustered profiles with custom colours.
+    See BuitragoBars for compact_vectors and raster_dpi.
+    """
+    inputs = Buitrago.inputs + ('profile_clustered_table',)
+
+    def __init__(
+            self, dist_type='bc', cluster_profiles=True, compact_vectors=False, raster_dpi=600,
+            prefetcher=None, sp_output_dir=None
+    ):
+        super().__init__(dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
         self.bar_figures_dir = os.path.join(self.root_dir, "bar_figures")
         # self.fig = plt.figure(figsize=self._mm2inch((200, 320)))
         # bars to legends at ratio of 4:1
@@ -799,11 +1221,11 @@ class BuitragoBars_clustered_profiles(Buitrago):
 
         # Use the clustered profiles
         # This file was created manually using Excel.
-        self.profile_count_table_path = "/Users/benjaminhume/Documents/projects/20210113_buitrago/ITS2/131_20201203_DBV_20201207T095144.profiles.absolute.abund_and_meta.clustered.tsv"
+        self.profile_count_table_path = self.clustered_profile_count_table_path
 
         # We want to work out the number of profiles before and after clustering in spis and pver samples
         # This code works. Just uncomment to do the plotting.
-        prof_count_df = pd.read_table(self.profile_count_table_path)
+        prof_count_df = self._read_input(*self.input_path_dict['profile_clustered_table'])
         prof_count_df = prof_count_df.iloc[6:,]
         cols = list(prof_count_df)
         cols[1] = "sample_name"
@@ -837,7 +1259,7 @@ class BuitragoBars_clustered_profiles(Buitrago):
         print(f"The proportion of samples with a single profile in spis is {spis_one_prof_prop}")
 
         # Then work this out for only those samples from MAQ
-        pver_prof_df_MAQ = prof_count_df.loc[[_ for _ in self.pver_df.index if "MAQ" in _], :]
+        pver_prof_df_MAQ = prof_count_df.loc[self.get_meta_index().names(species='pver', region='MAQ'), :]
         pver__more_than_one_profile_sample = []
         for ind, ser in pver_prof_df_MAQ.iterrows():
             ser_non_zero = ser[ser != 0]
@@ -845,10 +1267,10 @@ class BuitragoBars_clustered_profiles(Buitrago):
                 pver__more_than_one_profile_sample.append(ind)
         
         # Proportion of samples
-        pver_more_than_one_prof_prop = len(pver__more_than_one_profile_sample) / len([_ for _ in self.pver_df.index if "MAQ" in _])
+        pver_more_than_one_prof_prop = len(pver__more_than_one_profile_sample) / len(pver_prof_df_MAQ.index)
         print(f"The proportion of samples with more than a single profile in pver is {pver_more_than_one_prof_prop}")
 
-        spis_prof_df_MAQ = prof_count_df.loc[[_ for _ in self.spis_df.index if "MAQ" in _], :]
+        spis_prof_df_MAQ = prof_count_df.loc[self.get_meta_index().names(species='spis', region='MAQ'), :]
         spis__more_than_one_profile_sample = []
         for ind, ser in spis_prof_df_MAQ.iterrows():
             ser_non_zero = ser[ser != 0]
@@ -856,7 +1278,7 @@ class BuitragoBars_clustered_profiles(Buitrago):
                 spis__more_than_one_profile_sample.append(ind)
         
         # Proportion of samples
-        spis_more_than_one_prof_prop = len(spis__more_than_one_profile_sample) / len([_ for _ in self.spis_df.index if "MAQ" in _])
+        spis_more_than_one_prof_prop = len(spis__more_than_one_profile_sample) / len(spis_prof_df_MAQ.index)
         print(f"The proportion of samples with a single profile in spis is {spis_more_than_one_prof_prop}")
 
         foo = "bar"
@@ -978,22 +1400,11 @@ class BuitragoBars_clustered_profiles(Buitrago):
             ax[0].set_yticks([])
             ax[0].set_title(f"clustered_profiles_{species}", fontsize='small')
             # Need to add a black line for each of the reef borders
-            reef = df.iloc[0]["reef"]
-            lines = []
-            line_colors = []
-            line_widths = []
-            for k, ind in enumerate(df.index.values):
-                new_reef = df.at[ind, "reef"]
-                if new_reef != reef:
-                    reef = new_reef
-                    # Then we need to plot a black line at k - 0.5
-                    lines.append(k - 0.5)
-                    line_colors.append("black")
-                    line_widths.append(2)
-            ax[0].hlines(y=lines, xmin=0, xmax=1, colors=line_colors, linewidths=line_widths)
-        plt.savefig(os.path.join(self.plotting_dir, f"clustered_profiles.bars.svg"))
-        plt.savefig(os.path.join(self.plotting_dir, f"clustered_profiles.bars.pdf"))
-        plt.savefig(os.path.join(self.plotting_dir, f"clustered_profiles.bars.png", ), dpi=600)
+            lines = self._reef_boundaries(df.index.values) - 0.5
+            ax[0].hlines(y=lines, xmin=0, xmax=1, colors="black", linewidths=2)
+        self._savefig_bars(
+            os.path.join(self.plotting_dir, "clustered_profiles.bars"),
+            compact_vectors=compact_vectors, raster_dpi=raster_dpi, bar_axes=[ax_arr[0], ax_arr[2]])
         plt.close(fig)
         
         # output a good profile colour dict so that we can work with it again
@@ -1022,38 +1433,22 @@ class BuitragoBars_clustered_profiles(Buitrago):
             ax[0].set_yticks([])
             ax[0].set_title(f"genera_{species}", fontsize='small')
             # Need to add a black line for each of the reef borders
-            reef = df.iloc[0]["reef"]
-            lines = []
-            line_colors = []
-            line_widths = []
-            for k, ind in enumerate(df.index.values):
-                new_reef = df.at[ind, "reef"]
-                if new_reef != reef:
-                    reef = new_reef
-                    # Then we need to plot a black line at k - 0.5
-                    lines.append(k - 0.5)
-                    line_colors.append("black")
-                    line_widths.append(2)
-            ax[0].hlines(y=lines, xmin=0, xmax=1, colors=line_colors, linewidths=line_widths)
-        plt.savefig(os.path.join(self.plotting_dir, f"clustered_profiles_genera.bars.svg"))
-        plt.savefig(os.path.join(self.plotting_dir, f"clustered_profiles_genera.bars.pdf"))
-        plt.savefig(os.path.join(self.plotting_dir, f"clustered_profiles_genera.bars.png", ), dpi=600)
+            lines = self._reef_boundaries(df.index.values) - 0.5
+            ax[0].hlines(y=lines, xmin=0, xmax=1, colors="black", linewidths=2)
+        self._savefig_bars(
+            os.path.join(self.plotting_dir, "clustered_profiles_genera.bars"),
+            compact_vectors=compact_vectors, raster_dpi=raster_dpi, bar_axes=[ax_arr[0], ax_arr[2]])
         plt.close(fig)
         foo = "bar"
 
 class CalculateAverageProfDistances(Buitrago):
     """ A class dedicated to calculating the average profile nearest neighbour distance"""
-    def __init__(self):
-        super().__init__("bc")
-        dist_path_A = "/Users/benjaminhume/Documents/projects/20210113_buitrago/ITS2/sp_output/between_profile_distances/A/20201207T095144_braycurtis_profile_distances_A_sqrt.dist"
-        dist_path_C = "/Users/benjaminhume/Documents/projects/20210113_buitrago/ITS2/sp_output/between_profile_distances/C/20201207T095144_braycurtis_profile_distances_C_sqrt.dist"
-        dist_path_D = "/Users/benjaminhume/Documents/projects/20210113_buitrago/ITS2/sp_output/between_profile_distances/D/20201207T095144_braycurtis_profile_distances_D_sqrt.dist"
-
-        profile_count_table_path = "/Users/benjaminhume/Documents/projects/20210113_buitrago/ITS2/sp_output/its2_type_profiles/131_20201203_DBV_20201207T095144.profiles.absolute.abund_and_meta.txt"
+    inputs = Buitrago.inputs + ('profile', 'profile_table', 'profile_dist_A', 'profile_dist_C', 'profile_dist_D')
 
+    def __init__(self, prefetcher=None, sp_output_dir=None):
+        super().__init__("bc", prefetcher=prefetcher, sp_output_dir=sp_output_dir)
         # We want to work out the number of profiles before and after clustering in spis and pver samples
-        prof_count_df = pd.read_table(profile_count_table_path)
-        profile_uid_to_profile_name_dict = {int(uid): name for uid, name in zip(list(prof_count_df)[2:], list(prof_count_df.iloc[5,2:].values))}
+        prof_count_df = self._read_input(*self.input_path_dict['profile_table'])
         prof_count_df = prof_count_df.iloc[6:, ]
         cols = list(prof_count_df)
         cols[1] = "sample_name"
@@ -1062,49 +1457,26 @@ class CalculateAverageProfDistances(Buitrago):
         prof_count_df = prof_count_df.iloc[:-2, 1:].astype(float).astype(int)
         prof_count_df.columns = [int(_) for _ in list(prof_count_df)]
 
-        sym_dist_df_A = pd.read_table(dist_path_A, header=None)
+        sym_dist_df_A = self._read_input(*self.input_path_dict['profile_dist_A'])
         sym_dist_df_A.index = sym_dist_df_A[1]
         sym_dist_df_A = sym_dist_df_A.iloc[:,2:]
         sym_dist_df_A.columns = sym_dist_df_A.index.values
 
-        sym_dist_df_C = pd.read_table(dist_path_C, header=None)
+        sym_dist_df_C = self._read_input(*self.input_path_dict['profile_dist_C'])
         sym_dist_df_C.index = sym_dist_df_C[1]
         sym_dist_df_C = sym_dist_df_C.iloc[:, 2:]
         sym_dist_df_C.columns = sym_dist_df_C.index.values
 
-        sym_dist_df_D = pd.read_table(dist_path_D, header=None)
+        sym_dist_df_D = self._read_input(*self.input_path_dict['profile_dist_D'])
         sym_dist_df_D.index = sym_dist_df_D[1]
         sym_dist_df_D = sym_dist_df_D.iloc[:, 2:]
         sym_dist_df_D.columns = sym_dist_df_D.index.values
 
-        # create a dictionary that holds the distance to the nearest profile for every profile
+        # create a dictionary that holds the number of DIVs in common with the nearest profile for every profile
+        incidence = self.get_div_incidence()
         profile_uid_to_nearest_profile_dist_dict = {}
-        for prof_uid, ser in sym_dist_df_A.iterrows():
-            nearest_match_uid = sorted(ser.items(), key=lambda x: x[1])[1][0]
-            # Get the number of divs in common
-            match_name = profile_uid_to_profile_name_dict[nearest_match_uid]
-            our_name = profile_uid_to_profile_name_dict[prof_uid]
-            match_divs = set(filter(None, re.split("[/\-]+", match_name)))
-            ours_divs = set(filter(None, re.split("[/\-]+", our_name)))
-            profile_uid_to_nearest_profile_dist_dict[prof_uid] = len(match_divs.intersection(ours_divs))
-
-
-        for prof_uid, ser in sym_dist_df_C.iterrows():
-            nearest_match_uid = sorted(ser.items(), key=lambda x: x[1])[1][0]
-            # Get the number of divs in common
-            match_name = profile_uid_to_profile_name_dict[nearest_match_uid]
-            our_name = profile_uid_to_profile_name_dict[prof_uid]
-            match_divs = set(filter(None, re.split("[/\-]+", match_name)))
-            ours_divs = set(filter(None, re.split("[/\-]+", our_name)))
-            profile_uid_to_nearest_profile_dist_dict[prof_uid] = len(match_divs.intersection(ours_divs))
-        for prof_uid, ser in sym_dist_df_D.iterrows():
-            nearest_match_uid = sorted(ser.items(), key=lambda x: x[1])[1][0]
-            # Get the number of divs in common
-            match_name = profile_uid_to_profile_name_dict[nearest_match_uid]
-            our_name = profile_uid_to_profile_name_dict[prof_uid]
-            match_divs = set(filter(None, re.split("[/\-]+", match_name)))
-            ours_divs = set(filter(None, re.split("[/\-]+", our_name)))
-            profile_uid_to_nearest_profile_dist_dict[prof_uid] = len(match_divs.intersection(ours_divs))
+        for sym_dist_df in [sym_dist_df_A, sym_dist_df_C, sym_dist_df_D]:
+            profile_uid_to_nearest_profile_dist_dict.update(self._nearest_profile_shared_divs(sym_dist_df, incidence))
 
         pver_instance_list = []
         for sample in self.pver_df.index:
@@ -1148,20 +1520,1692 @@ class CalculateAverageProfDistances(Buitrago):
         spis_av_profile_instance_dist = sum(spis_distances) / len(spis_distances)
         foo = "bar"
 
+    @staticmethod
+    def _nearest_profile_shared_divs(sym_dist_df, incidence):
+        """
+        For every profile of a between profile distance df, the number of DIVs it has in common with its nearest
+        (other) profile.
+        """
+        # The nearest profile is the second smallest distance of each row (the smallest is the profile itself)
+        nearest_cols = np.argsort(sym_dist_df.values, axis=1, kind='stable')[:, 1]
+        prof_uids = list(sym_dist_df.index)
+        nearest_uids = [sym_dist_df.columns[_] for _ in nearest_cols]
+        return dict(zip(prof_uids, incidence.shared_div_counts_of_pairs(prof_uids, nearest_uids)))
 
 
-# For plotting the ordinations
-# BuitragoOrdinations(dist_type='bc')
+class BuitragoMantel(Buitrago):
+    """
+    Mantel and partial Mantel tests of the between sample Symbiodinium distances against
+    host genetic, geographic and environmental distances. The tests are run separately for each species.
+
+    The host genetic distance is 0 for samples in the same genetic cluster (pver/spis.genclust.strata files)
+    and 1 otherwise unless a sample by sample host distance matrix is supplied with host_dist_path.
+    The geographic distance is the great circle distance (km) between the reefs (reef_coords.csv).
+    The environmental distance is the absolute difference in reef temperature (reef_temp.csv).
+
+    The Symbiodinium matrix is permuted. Permutations are generated as index arrays and applied in vectorized
+    batches to the condensed float32 matrices, with chunks of permutations farmed out across processes
+    (or nodes, see buitrago_jobs).
+    The p-value is the proportion of permutations with a statistic greater than or equal to
+    the observed (one-tailed, as in vegan's mantel).
+    """
+    inputs = Buitrago.inputs + ('reef_temp', 'reef_coords')
 
-# For plotting the dendrogram figure with associated meta info and sequences
-# BuitragoHier(dist_type='bc')
-# For plotting the dendogram split by species and with the option of clustering the profiles
-# BuitragoHier_split_species(dist_type='bc')
+    def __init__(
+            self, dist_type='bc', n_perm=999, method='pearson', host_dist_path=None,
+            n_proc=None, seed=1234, batch_bytes=2**28, backend=None, prefetcher=None, sp_output_dir=None
+    ):
+        """
+        :param backend: where the permutation chunks are run (see buitrago_jobs.get_backend).
+        By default a local process pool of n_proc processes.
+        """
+        super().__init__(dist_type=dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
+        self.dist_type = dist_type
+        self.n_perm = n_perm
+        self.method = method
+        self.n_proc = n_proc if n_proc else os.cpu_count()
+        self.backend = get_backend(backend, self.n_proc)
+        self.seed = seed
+        self.batch_bytes = batch_bytes
+
+        self.gen_cluster_ser = self._read_genetic_clusters()
+        self.reef_temp_ser = self._read_input(*self.input_path_dict['reef_temp'])["temp"]
+        self.reef_coords_df = self._read_input(*self.input_path_dict['reef_coords'])
+        self.sym_dist_df = self._read_sp_dist_df(self.symbiodinium_dist_path)
+        self.host_dist_df = pd.read_table(host_dist_path, index_col=0) if host_dist_path else None
+
+        # (y, z) pairs. The x is always the Symbiodinium matrix. z of None is a simple Mantel test.
+        self.tests = [
+            ('host', None), ('geo', None), ('env', None),
+            ('host', 'geo'), ('env', 'geo'), ('host', 'env')
+        ]
+
+        results = []
+        for species, species_df in zip(['pver', 'spis'], [self.pver_df, self.spis_df]):
+            results.extend(self._test_species(species, species_df))
+        self.results_df = pd.DataFrame(results)
+        self.results_df.to_csv(f"mantel_{dist_type}_{method}.csv", index=False)
+        print(self.results_df)
+
+    def _test_species(self, species, species_df):
+        samples = [
+            _ for _ in species_df.index if
+            _ in self.symbiodinium_host_names and
+            _ in self.gen_cluster_ser.index and
+            species_df.at[_, 'reef'] in self.reef_temp_ser.index and
+            species_df.at[_, 'reef'] in self.reef_coords_df.index
+        ]
+        if self.host_dist_df is not None:
+            samples = [_ for _ in samples if _ in self.host_dist_df.index]
+        n = len(samples)
+        print(f"Running Mantel tests for {species} with {n} samples")
+        reefs = species_df.loc[samples, 'reef'].values
+
+        # All matrices are held as condensed float32 vectors
+        condensed = {
+            'sym': squareform(self.sym_dist_df.loc[samples, samples].values, checks=False).astype(np.float32)
+        }
+        iu, ju = np.triu_indices(n, k=1)
+        if self.host_dist_df is not None:
+            condensed['host'] = squareform(
+                self.host_dist_df.loc[samples, samples].values, checks=False).astype(np.float32)
+        else:
+            cluster_codes, _ = pd.factorize(self.gen_cluster_ser[samples].values)
+            condensed['host'] = (cluster_codes[iu] != cluster_codes[ju]).astype(np.float32)
+        # Geographic and environmental distances are computed between reefs and then expanded to samples
+        reef_codes, reef_names = pd.factorize(reefs)
+        reef_geo_dist = squareform(pdist(
+            np.radians(self.reef_coords_df.loc[reef_names, ['lat', 'long']].values), metric=self._haversine_km))
+        condensed['geo'] = reef_geo_dist[reef_codes[iu], reef_codes[ju]].astype(np.float32)
+        reef_temps = self.reef_temp_ser[reef_names].values
+        reef_env_dist = np.abs(reef_temps[:, None] - reef_temps[None, :])
+        condensed['env'] = reef_env_dist[reef_codes[iu], reef_codes[ju]].astype(np.float32)
+        del iu, ju
+
+        # Standardise once. Permuting the objects does not change the mean or sd of a matrix.
+        for k in condensed.keys():
+            v = condensed[k].astype(np.float64)
+            if self.method == 'spearman':
+                v = rankdata(v)
+            condensed[k] = ((v - v.mean()) / v.std()).astype(np.float32)
+
+        y_names = ['host', 'geo', 'env']
+        y_stack = np.vstack([condensed[_] for _ in y_names])
+        m = len(condensed['sym'])
+        r_obs = dict(zip(y_names, (y_stack @ condensed['sym']) / m))
+        # correlations between the fixed matrices for the partial tests
+        r_fixed = {
+            (a, b): float(condensed[a] @ condensed[b]) / m for a, b in itertools.permutations(y_names, 2)
+        }
+
+        r_perm = dict(zip(y_names, self._permute(x=condensed['sym'], y_stack=y_stack, n=n).T))
+
+        results = []
+        for y, z in self.tests:
+            if z is None:
+                stat = r_obs[y]
+                perm_stats = r_perm[y]
+            else:
+                stat = partial_r(r_obs[y], r_obs[z], r_fixed[(y, z)])
+                perm_stats = partial_r(r_perm[y], r_perm[z], r_fixed[(y, z)])
+            # Compare at the float32 precision of the permuted statistics
+            stat = np.float32(stat)
+            p_val = (np.sum(perm_stats.astype(np.float32) >= stat - MANTEL_TOLERANCE) + 1) / (self.n_perm + 1)
+            results.append({
+                'species': species, 'x': 'symbiodinium', 'y': y, 'z': z if z else '', 'n_samples': n,
+                'method': self.method, 'statistic': float(stat), 'p_value': p_val, 'n_perm': self.n_perm
+            })
+        return results
+
+    def _permute(self, x, y_stack, n):
+        seeds, chunk_sizes = seeded_chunks(self.seed, self.n_perm, self.backend.n_chunks)
+        perm_arrays = self.backend.map(
+            mantel_perm_chunk, zip(seeds, chunk_sizes), initializer=mantel_worker_init,
+            initargs=(x, y_stack, n, self.batch_bytes))
+        return np.concatenate(perm_arrays)
+
+    @staticmethod
+    def _haversine_km(u, v):
+        d_lat = v[0] - u[0]
+        d_long = v[1] - u[1]
+        a = np.sin(d_lat / 2) ** 2 + np.cos(u[0]) * np.cos(v[0]) * np.sin(d_long / 2) ** 2
+        return 2 * 6371.0 * np.arcsin(np.sqrt(a))
+
+
+class BuitragoEnvScan(Buitrago):
+    """
+    Scan every ITS2 sequence and ITS2 type profile (and clustered profile) for an association with a reef level
+    covariate (a column of reef_temp.csv, by default temperature) while controlling for host species and
+    host genetic cluster.
+
+    A linear model (abundance ~ covariate + species + genetic cluster) is fitted to every feature at once.
+    The nuisance covariates are projected out of the covariate and all features are then solved with a single
+    sparse x dense matrix product over the sparse abundance matrix.
+    Significance is assessed with both the parametric t-test p-value and by permuting the covariate
+    values between reefs. The permutations give a per feature permutation p-value and a permutation based FDR
+    (q-value). Permutation chunks are run across processes (or nodes, see buitrago_jobs).
+    """
+    inputs = Buitrago.inputs + ('seq', 'profile', 'profile_clustered', 'reef_temp')
+
+    def __init__(
+            self, dist_type='bc', covariate='temp', species=None,
+            feature_sets=('seq', 'profile', 'profile_clustered'), transform='relative', min_prevalence=3,
+            n_perm=999, n_proc=None, seed=1234, batch_size=64, backend=None, prefetcher=None, sp_output_dir=None
+    ):
+        """
+        :param backend: where the permutation chunks are run (see buitrago_jobs.get_backend).
+        By default a local process pool of n_proc processes.
+        """
+        super().__init__(dist_type=dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
+        self.covariate = covariate
+        self.species = species
+        self.transform = transform
+        self.min_prevalence = min_prevalence
+        self.n_perm = n_perm
+        self.n_proc = n_proc if n_proc else os.cpu_count()
+        self.backend = get_backend(backend, self.n_proc)
+        self.seed = seed
+        self.batch_size = batch_size
+
+        self.reef_covariate_ser = self._read_input(*self.input_path_dict['reef_temp'])[covariate].astype(float)
+        self.gen_cluster_ser = self._read_genetic_clusters()
+
+        self.results = {}
+        for feature_set in feature_sets:
+            print(f"Scanning {feature_set} features for association with {covariate}")
+            results_df = self._scan(self._load_abundance(feature_set))
+            results_df.to_csv(f"env_scan_{covariate}_{feature_set}{'_' + species if species else ''}.csv")
+            self.results[feature_set] = results_df
+
+    def _scan(self, abundance):
+        samples = [
+            _ for _ in self.all_samples_df.index if
+            _ in abundance.sample_name_to_row_dict and
+            _ in self.gen_cluster_ser.index and
+            self.all_samples_df.at[_, 'reef'] in self.reef_covariate_ser.index
+        ]
+        if self.species:
+            samples = [_ for _ in samples if self.gen_cluster_ser[_].startswith(self.species)]
+        abundance = abundance.subset(sample_names=samples)
+        # Drop samples without any counts
+        samples = [s for s, tot in zip(samples, np.asarray(abundance.matrix.sum(axis=1)).ravel()) if tot > 0]
+        abundance = abundance.subset(sample_names=samples).relative()
+        if self.transform == 'sqrt':
+            abundance = abundance.sqrt()
+        abundance = abundance.subset(feature_mask=abundance.matrix.getnnz(axis=0) >= self.min_prevalence)
+        y_csc = abundance.matrix.tocsc()
+        n = len(samples)
+
+        # Nuisance design: intercept, species and genetic cluster dummies. The clusters are nested in
+        # species so the design is rank deficient. Take an orthonormal basis of its column space instead.
+        nuisance_df = pd.DataFrame({
+            'species': [_[0] for _ in samples], 'cluster': self.gen_cluster_ser[samples].values
+        })
+        z = np.column_stack([np.ones(n), pd.get_dummies(nuisance_df, drop_first=True).values.astype(float)])
+        u, s, _ = np.linalg.svd(z, full_matrices=False)
+        q = u[:, s > s[0] * 1e-10]
+        df = n - q.shape[1] - 1
+
+        # Residual sum of squares of every feature after the nuisance covariates: ||y||^2 - ||q'y||^2
+        y_ss = np.asarray(y_csc.multiply(y_csc).sum(axis=0)).ravel()
+        y_r_ss = y_ss - (np.asarray(y_csc.T @ q) ** 2).sum(axis=1)
+
+        reef_codes, reef_names = pd.factorize(self.all_samples_df.loc[samples, 'reef'].values)
+        reef_values = self.reef_covariate_ser[reef_names].values
+        t_obs, beta = env_scan_t_stats(
+            y_csc=y_csc, q=q, x=reef_values[reef_codes].reshape(-1, 1), y_r_ss=y_r_ss, df=df)
+        t_obs, beta = t_obs.ravel(), beta.ravel()
+        p_param = 2 * t_dist.sf(np.abs(t_obs), df)
+        abs_t = np.nan_to_num(np.abs(t_obs), nan=0)
+
+        sorted_abs_t = np.sort(abs_t)
+        threshold_hist, exceed_counts = self._permute(
+            initargs=(y_csc, q, reef_codes, reef_values, y_r_ss, df, sorted_abs_t, abs_t, self.batch_size))
+        # Number of null |t| >= each of the sorted observed |t| (all thresholds below the insertion point)
+        null_exceed = threshold_hist[::-1].cumsum()[::-1][1:]
+        obs_exceed = len(sorted_abs_t) - np.searchsorted(sorted_abs_t, sorted_abs_t, side='left')
+        fdr = np.minimum(1, (null_exceed / self.n_perm) / obs_exceed)
+        # q-value is the minimum FDR of any threshold at or below the statistic
+        q_sorted = np.minimum.accumulate(fdr)
+        q_perm = q_sorted[np.searchsorted(sorted_abs_t, abs_t, side='right') - 1]
+
+        results_df = pd.DataFrame({
+            'name': [abundance.feature_label(_) for _ in abundance.feature_names],
+            'prevalence': abundance.matrix.getnnz(axis=0),
+            'beta': beta, 't': t_obs, 'p_value': p_param,
+            'p_perm': (exceed_counts + 1) / (self.n_perm + 1), 'q_perm': q_perm
+        }, index=pd.Index(abundance.feature_names, name='feature'))
+        return results_df.sort_values('p_value')
+
+    def _permute(self, initargs):
+        seeds, chunk_sizes = seeded_chunks(self.seed, self.n_perm, self.backend.n_chunks)
+        n_thresholds = len(initargs[-2]) + 1
+        threshold_hist = np.zeros(n_thresholds, dtype=np.int64)
+        exceed_counts = np.zeros(n_thresholds - 1, dtype=np.int64)
+        for chunk_hist, chunk_exceed in self.backend.map(
+                env_scan_perm_chunk, zip(seeds, chunk_sizes), initializer=env_scan_worker_init, initargs=initargs
+        ):
+            threshold_hist += chunk_hist
+            exceed_counts += chunk_exceed
+        return threshold_hist, exceed_counts
+
+
+class BuitragoCoOccurrence(Buitrago):
+    """
+    Co-occurrence networks of the ITS2 sequences (or profiles) across the samples, computed for every pair
+    of features.
+
+    The counts are clr transformed (with a pseudocount) and the association of every pair of features, either
+    the proportionality rho or the Pearson correlation of the clr values (see buitrago_stats.cooccurrence_blocks),
+    is computed in blocks of rows of the upper triangle of the feature x feature matrix, each with a single matrix
+    product, so that the full matrix is never held in memory. Only the pairs with |association| >= min_abs are kept.
+
+    Significance is from a pooled permutation null (as propr's updateCutoffs): the counts of every feature are
+    shuffled between samples and the null |association| of all pairs of all permutations are binned into one
+    histogram. The FDR of a cutoff is the mean number of null pairs above it over the number of observed pairs
+    above it, and the q-value of a pair is the minimum FDR of any cutoff at or below its |association|.
+    Permutation chunks are run across processes (or nodes, see buitrago_jobs).
+
+    The networks are computed separately for every stratum (e.g. species or region) of the samples.
+    Outputs cooccurrence_{feature_set}_{measure}_{stratum}.tsv edge lists (the pairs with q_value <= fdr)
+    and cooccurrence_{feature_set}_{measure}_summary.csv.
+
+    :param stratify: None (all samples), 'species', 'region', 'cluster' or a list of them e.g. ['species', 'region']
+    :param min_prevalence: the minimum number of samples of a stratum a feature has to be found in to be included
+    :param min_abs: the minimum |association| of a pair to be reported
+    :param n_bins: the number of bins of [0, 1] of the |association| histograms (the resolution of the q-values)
+    :param block_bytes: the (approximate) size of a block of the association matrix
+    """
+    inputs = Buitrago.inputs + ('seq', 'profile', 'profile_clustered')
+
+    def __init__(
+            self, dist_type='bc', feature_set='seq', measure='rho', stratify='species', min_prevalence=10,
+            pseudocount=1, min_abs=0.5, fdr=0.05, n_perm=200, n_bins=1000, block_bytes=2 ** 27, n_proc=None,
+            seed=1234, backend=None, prefetcher=None, sp_output_dir=None
+    ):
+        """
+        :param backend: where the permutation chunks are run (see buitrago_jobs.get_backend).
+        By default a local process pool of n_proc processes.
+        """
+        super().__init__(dist_type=dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
+        if measure not in ['rho', 'pearson']:
+            raise ValueError(f"Unknown measure {measure}. Use 'rho' or 'pearson'")
+        self.feature_set = feature_set
+        self.measure = measure
+        self.min_prevalence = min_prevalence
+        self.pseudocount = pseudocount
+        self.min_abs = min_abs
+        self.fdr = fdr
+        self.n_perm = n_perm
+        self.n_bins = n_bins
+        self.block_bytes = block_bytes
+        self.n_proc = n_proc if n_proc else os.cpu_count()
+        self.backend = get_backend(backend, self.n_proc)
+        self.seed = seed
+
+        abundance = self._load_abundance(feature_set)
+        meta_df = self._make_sample_meta_df()
+        meta_df = meta_df[meta_df.index.isin(abundance.sample_name_to_row_dict)]
+        if stratify is None:
+            strata = [('all', list(meta_df.index))]
+        else:
+            strata = [
+                ('_'.join(np.atleast_1d(stratum)), list(stratum_df.index))
+                for stratum, stratum_df in meta_df.groupby(stratify, sort=True)
+            ]
+
+        self.edges = {}
+        summary = []
+        for stratum_offset, (stratum, samples) in enumerate(strata):
+            edge_df, stratum_summary = self._network(abundance.subset(sample_names=samples), stratum_offset)
+            print(
+                f"{stratum}: {stratum_summary['n_edges']} edges between {stratum_summary['n_features']} features "
+                f"of {len(samples)} samples")
+            edge_df.to_csv(f"cooccurrence_{feature_set}_{measure}_{stratum}.tsv", sep='\t', index=False)
+            self.edges[stratum] = edge_df
+            summary.append(dict(stratum=stratum, **stratum_summary))
+        self.summary_df = pd.DataFrame(summary)
+        self.summary_df.to_csv(f"cooccurrence_{feature_set}_{measure}_summary.csv", index=False)
+
+    def _network(self, abundance, stratum_offset):
+        abundance = abundance.subset(feature_mask=abundance.matrix.getnnz(axis=0) >= self.min_prevalence)
+        counts = abundance.matrix.toarray().astype(np.float32)
+        n_samples, n_features = counts.shape
+        block_features = max(1, int(self.block_bytes // (4 * max(1, n_features))))
+
+        # Observed associations: the histogram of all pairs and the pairs with |association| >= min_abs
+        clr, ss = clr_centred(counts, self.pseudocount)
+        obs_hist = np.zeros(self.n_bins, dtype=np.int64)
+        rows, cols, values = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, np.float32)]
+        for start, block in cooccurrence_blocks(clr, ss, self.measure, block_features):
+            obs_hist += abs_hist(block, self.n_bins)
+            with np.errstate(invalid='ignore'):
+                block_rows, block_cols = np.nonzero(np.abs(block) >= self.min_abs)
+            rows.append(block_rows + start)
+            cols.append(block_cols + start)
+            values.append(block[block_rows, block_cols])
+        rows, cols, values = np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+
+        # Pooled null. Bin k holds |association| in [k / n_bins, (k + 1) / n_bins) so the number of pairs with
+        # |association| >= k / n_bins is the reverse cumulative sum of the histogram.
+        seeds, chunk_sizes = seeded_chunks([self.seed, stratum_offset], self.n_perm, self.backend.n_chunks)
+        null_hist = np.zeros(self.n_bins, dtype=np.int64)
+        for chunk_hist in self.backend.map(
+                cooccurrence_perm_chunk, zip(seeds, chunk_sizes), initializer=cooccurrence_worker_init,
+                initargs=(counts, self.pseudocount, self.measure, self.n_bins, block_features)
+        ):
+            null_hist += chunk_hist
+        null_exceed = null_hist[::-1].cumsum()[::-1] / self.n_perm
+        obs_exceed = obs_hist[::-1].cumsum()[::-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fdr = np.minimum(1, np.where(obs_exceed > 0, null_exceed / obs_exceed, 1))
+        q_by_bin = np.minimum.accumulate(fdr)
+        q_values = q_by_bin[np.minimum((np.abs(values) * self.n_bins).astype(np.int64), self.n_bins - 1)]
+
+        keep = q_values <= self.fdr
+        rows, cols, values, q_values = rows[keep], cols[keep], values[keep], q_values[keep]
+        presence = (abundance.matrix > 0).tocsc().astype(np.int64)
+        features = np.array(abundance.feature_names, dtype=object)
+        edge_df = pd.DataFrame({
+            'feature_1': features[rows], 'feature_2': features[cols],
+            'name_1': [abundance.feature_label(_) for _ in features[rows]],
+            'name_2': [abundance.feature_label(_) for _ in features[cols]],
+            self.measure: values, 'q_value': q_values,
+            # The number of samples in which both features were found
+            'n_both': np.asarray(presence[:, rows].multiply(presence[:, cols]).sum(axis=0)).ravel()
+        })
+        edge_df = edge_df.iloc[np.argsort(-np.abs(edge_df[self.measure].values), kind='stable')]
+        passing = np.flatnonzero(q_by_bin <= self.fdr)
+        return edge_df, {
+            'n_samples': n_samples, 'n_features': n_features, 'n_pairs': int(obs_hist.sum()),
+            # The smallest |association| cutoff with an FDR <= fdr
+            'cutoff': max(self.min_abs, passing[0] / self.n_bins) if len(passing) else np.nan,
+            'n_edges': len(edge_df)
+        }
+
+
+def _temperature_class(temp):
+    """The temperature class of a reef as in 16S/Spis_Pver_indicSpecies.R (temp_category2)"""
+    if 27 <= temp < 28:
+        return 'cool'
+    if 29 <= temp < 30:
+        return 'med-cool'
+    if 30 <= temp < 31:
+        return 'med-warm'
+    if 31 <= temp < 32:
+        return 'warm'
+    return 'other'
+
+
+class BuitragoIndVal(Buitrago):
+    """
+    Indicator species analysis of the ITS2 sequences, profiles (and clustered profiles) and the 16S ASVs,
+    the equivalent of indicspecies' multipatt (IndVal.g, 999 permutations) in 16S/Spis_Pver_indicSpecies.R.
+
+    For every species the samples are grouped by grouping: 'temp_class' (the reef temperature classes of
+    Spis_Pver_indicSpecies.R from reef_temp.csv), 'region', 'reef', 'cluster' (the host genetic clusters)
+    or a Series of sample name to group. The IndVal.g of every feature for every single group and every
+    combination of groups (up to max_order groups) is computed at once from the sparse abundance matrix
+    (see buitrago_stats.indval_stats) and each feature is assigned to its best combination.
+    The p-value is from permuting the samples between the groups: the proportion of permutations in which the
+    best IndVal of the feature (over all combinations) is >= the observed. Permutations are computed in batches
+    of matrix products and the chunks run across processes (or nodes, see buitrago_jobs).
+
+    As in Spis_Pver_indicSpecies.R only the samples with a host genetic cluster are used, features must be found in
+    min_prevalence of these samples (of both species together) and the abundances are then made relative over the
+    remaining features. Features not found in any sample of a species are left out of that species' results
+    (multipatt gives them no statistic).
+    Outputs indval_{grouping}_{feature_set}_{species}.csv with the multipatt 'sign' columns (s.<group> membership of
+    the best combination, index, stat and p_value) along with the combination's name, A and B.
+    """
+    inputs = Buitrago.inputs + ('seq', 'profile', 'profile_clustered', 'reef_temp', '16S')
+
+    def __init__(
+            self, dist_type='bc', grouping='temp_class', feature_sets=('seq', 'profile', 'profile_clustered', '16S'),
+            species=('pver', 'spis'), min_prevalence=5, max_order=None, n_perm=999, n_proc=None, seed=1234,
+            batch_bytes=2 ** 27, asv_zip_path=None, backend=None, prefetcher=None, sp_output_dir=None
+    ):
+        """
+        :param feature_sets: any of 'seq', 'profile', 'profile_clustered' and '16S' (the QC filtered ASV table)
+        :param max_order: the maximum number of groups in a combination (default all but one, as multipatt)
+        :param backend: where the permutation chunks are run (see buitrago_jobs.get_backend).
+        By default a local process pool of n_proc processes.
+        """
+        super().__init__(dist_type=dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
+        self.min_prevalence = min_prevalence
+        self.max_order = max_order
+        self.n_perm = n_perm
+        self.n_proc = n_proc if n_proc else os.cpu_count()
+        self.backend = get_backend(backend, self.n_proc)
+        self.seed = seed
+        self.batch_bytes = batch_bytes
+        # By default the '16S' input (../16S/SpisPver_ASVs_QCfiltered.txt.zip)
+        self.asv_zip_path = asv_zip_path if asv_zip_path else self.input_path_dict['16S'][0]
+
+        group_ser = self._sample_groups(grouping)
+        grouping_name = grouping if isinstance(grouping, str) else (grouping.name or 'group')
+        gen_cluster_ser = self._read_genetic_clusters()
+        meta_df = self._make_sample_meta_df()
+
+        self.results = {}
+        for feature_set in feature_sets:
+            abundance = self._load_features(feature_set)
+            # The prevalence filter is applied to the samples of both species before making the abundances relative
+            abundance = abundance.subset(sample_names=[
+                _ for _ in meta_df.index if _ in abundance.sample_name_to_row_dict and _ in gen_cluster_ser.index])
+            abundance = abundance.subset(
+                feature_mask=abundance.matrix.getnnz(axis=0) >= self.min_prevalence).relative()
+            for seed_offset, sp in enumerate(species):
+                samples = [
+                    _ for _ in meta_df.index[meta_df['species'] == sp] if
+                    _ in abundance.sample_name_to_row_dict and pd.notnull(group_ser.get(_))
+                ]
+                print(f"Indicator {feature_set} features of the {grouping_name} groups of {len(samples)} {sp} samples")
+                results_df = self._indval(
+                    abundance.subset(sample_names=samples), group_ser[samples], seed_offset=seed_offset)
+                results_df.to_csv(f"indval_{grouping_name}_{feature_set}_{sp}.csv")
+                self.results[(feature_set, sp)] = results_df
+
+    def _sample_groups(self, grouping):
+        """Series of sample name to group"""
+        if isinstance(grouping, pd.Series):
+            return grouping
+        meta_df = self._make_sample_meta_df()
+        if grouping == 'temp_class':
+            reef_temp_ser = self._read_input(*self.input_path_dict['reef_temp'])['temp']
+            reef_class_dict = {reef: _temperature_class(temp) for reef, temp in reef_temp_ser.items()}
+            return meta_df['reef'].map(reef_class_dict)
+        if grouping in ['region', 'reef', 'cluster']:
+            return meta_df[grouping].replace('NA', np.nan)
+        raise ValueError(f"Unknown grouping {grouping}. Use 'temp_class', 'region', 'reef', 'cluster' or a Series")
+
+    def _load_features(self, feature_set):
+        if feature_set == '16S':
+            print("Streaming the 16S ASV table")
+            return self._read_input(self.asv_zip_path, 'asv_zip')
+        return self._load_abundance(feature_set)
+
+    def _combinations(self, n_groups):
+        """The (n_groups, n_comb) membership matrix of the single groups and combinations in multipatt's order"""
+        max_order = self.max_order if self.max_order else max(1, n_groups - 1)
+        combinations = [
+            comb for order in range(1, min(max_order, n_groups) + 1)
+            for comb in itertools.combinations(range(n_groups), order)
+        ]
+        comb = np.zeros((n_groups, len(combinations)))
+        for col, groups in enumerate(combinations):
+            comb[list(groups), col] = 1
+        return comb
+
+    def _indval(self, abundance, group_ser, seed_offset):
+        """
+        :param abundance: the (prevalence filtered) relative abundances of the samples to group
+        """
+        # Drop samples without any counts and features not found in any of the samples
+        totals = np.asarray(abundance.matrix.sum(axis=1)).ravel()
+        abundance = abundance.subset(sample_names=[s for s, tot in zip(abundance.sample_names, totals) if tot > 0])
+        abundance = abundance.drop_empty_features()
+        abund_t = abundance.matrix.T.tocsr()
+        presence_t = (abund_t > 0).astype(float)
+
+        codes, groups = pd.factorize(group_ser[abundance.sample_names].values, sort=True)
+        group_sizes = np.bincount(codes, minlength=len(groups)).astype(float)
+        comb = self._combinations(len(groups))
+        stat, a, b = indval_stats(abund_t, presence_t, codes[:, None], comb, group_sizes)
+        stat, a, b = stat[:, 0], a[:, 0], b[:, 0]
+        best = np.nan_to_num(stat, nan=-1).argmax(axis=1)
+        rows = np.arange(len(best))
+        max_stat = stat[rows, best]
+
+        n_features = len(best)
+        batch_size = max(1, int(self.batch_bytes // (8 * 3 * max(1, n_features) * max(comb.shape))))
+        seeds, chunk_sizes = seeded_chunks([self.seed, seed_offset], self.n_perm, self.backend.n_chunks)
+        exceed_counts = np.zeros(n_features, dtype=np.int64)
+        for chunk_exceed in self.backend.map(
+                indval_perm_chunk, zip(seeds, chunk_sizes), initializer=indval_worker_init,
+                initargs=(abund_t, presence_t, codes, comb, group_sizes, max_stat, batch_size)
+        ):
+            exceed_counts += chunk_exceed
+
+        results_df = pd.DataFrame(
+            comb.T[best].astype(int), columns=[f's.{_}' for _ in groups],
+            index=pd.Index(abundance.feature_names, name='feature'))
+        results_df.insert(0, 'name', [abundance.feature_label(_) for _ in abundance.feature_names])
+        results_df['group'] = ['+'.join(groups[comb[:, _] > 0]) for _ in best]
+        results_df['index'] = best + 1
+        results_df['A'] = a[rows, best]
+        results_df['B'] = b[rows, best]
+        results_df['stat'] = max_stat
+        results_df['p_value'] = (exceed_counts + 1) / (self.n_perm + 1)
+        return results_df.sort_values('p_value', kind='stable')
+
+
+class BuitragoBootstrap(Buitrago):
+    """
+    Bootstrap the stability of the species split dendrograms (see BuitragoHier_split_species)
+    and of the 3 shared DIV profile clustering (see BuitragoHier_split_species.cluster_profiles).
+
+    Dendrograms: the reference is the dendrogram of BuitragoHier_split_species (the linkage of the SymPortal
+    Bray-Curtis distances). The clade A sequence counts of every sample are resampled (multinomial) and the
+    Bray-Curtis distances (square root transformed relative abundances, as SymPortal computes them) and linkage
+    are recomputed for each replicate. The support of each clade of the reference dendrogram is the proportion of
+    replicates in which the same clade is recovered. Pass the BuitragoBootstrap to BuitragoHier_split_species
+    (bootstrap) to write the support on its dendrograms. The co-clustering frequency is the proportion of replicates in which two samples
+    fall in the same flat cluster when the tree is cut into n_clusters.
+
+    Profile clustering: the sequence counts of every sample are resampled (multinomial), the DIVs of every profile
+    re-derived from the samples the profile was found in (see buitrago_stats.bootstrap_profile_chunk) and
+    the clustering rerun.
+    The co-clustering frequency is the proportion of replicates in which two profiles are in the same cluster.
+
+    Replicates are run in chunks across a process pool (or nodes, see buitrago_jobs). The count matrix is shared with
+    the workers read only as a memory mapped file and the results are reduced as the chunks are returned.
+    """
+    inputs = Buitrago.inputs + ('seq', 'profile')
+
+    def __init__(
+            self, dist_type='bc', n_boot=100, n_clusters=6, method='average', n_proc=None, seed=1234,
+            backend=None, prefetcher=None, sp_output_dir=None
+    ):
+        """
+        :param backend: where the replicate chunks are run (see buitrago_jobs.get_backend).
+        By default a local process pool of n_proc processes.
+        """
+        if dist_type != 'bc':
+            raise ValueError("Only the Bray-Curtis dendrograms (dist_type='bc') can be bootstrapped")
+        super().__init__(dist_type=dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
+        self.n_boot = n_boot
+        self.n_clusters = n_clusters
+        self.method = method
+        self.n_proc = n_proc if n_proc else os.cpu_count()
+        self.backend = get_backend(backend, self.n_proc)
+        self.seed = seed
+        self.seq_abundance = self._load_abundance('seq')
+        # Where the workers (possibly on other nodes) read the count matrices from
+        self.tmp_dir = self.backend.make_temp_dir(prefix='buitrago_bootstrap_')
+        try:
+            self.dendro_results = {}
+            for species in ['pver', 'spis']:
+                self.dendro_results[species] = self._bootstrap_dendrogram(species)
+                self._plot_support(species)
+            self.profile_co_cluster_df = self._bootstrap_profile_clustering()
+        finally:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _chunks(self, seed_offset):
+        return seeded_chunks([self.seed, seed_offset], self.n_boot, self.backend.n_chunks)
+
+    def _bootstrap_dendrogram(self, species):
+        # The reference is the dendrogram of BuitragoHier_split_species: the linkage of the SymPortal distances
+        # between the species' samples with host data, in the order of the .dist file as SPHierarchical uses it
+        sym_dist_df = self._read_sp_dist_df(self.symbiodinium_dist_path)
+        sample_names = [
+            _ for _ in sym_dist_df.index if _ in self.symbiodinium_host_names and _[0] == species[0].upper()]
+        missing = [_ for _ in sample_names if _ not in self.seq_abundance.sample_name_to_row_dict]
+        if missing:
+            raise ValueError(f"No sequence counts for the {species} samples {missing}")
+        # The replicate distances are recomputed as SymPortal computes them, from the clade A sequences
+        abundance = self.seq_abundance.subset(feature_mask=self.seq_abundance.feature_clades() == 'A')
+        counts = abundance.subset(sample_names=sample_names).matrix.toarray()
+        n = len(sample_names)
+        print(f"Bootstrapping the {species} dendrogram ({n} samples, {self.n_boot} replicates)")
+
+        counts_path = os.path.join(self.tmp_dir, f'{species}_counts.npy')
+        np.save(counts_path, counts)
+        ref_linkage = linkage(
+            squareform(sym_dist_df.loc[sample_names, sample_names].values, checks=False), method=self.method)
+        ref_clade_keys = clade_keys(ref_linkage, n)
+        ref_labels = fcluster(ref_linkage, t=self.n_clusters, criterion='maxclust')
+
+        support = np.zeros(n - 1, dtype=np.int64)
+        co_cluster = np.zeros((n, n), dtype=np.int64)
+        seeds, chunk_sizes = self._chunks(seed_offset=0 if species == 'pver' else 1)
+        for chunk_support, chunk_labels in self.backend.map(
+                bootstrap_dendro_chunk, zip(seeds, chunk_sizes), initializer=bootstrap_worker_init,
+                initargs=(counts_path, ref_clade_keys, self.method, self.n_clusters, None)
+        ):
+            support += chunk_support
+            for labels in chunk_labels:
+                co_cluster += labels[:, None] == labels[None, :]
+
+        co_cluster_df = pd.DataFrame(co_cluster / self.n_boot, index=sample_names, columns=sample_names)
+        co_cluster_df.to_csv(f"bootstrap_co_clustering_{species}.csv")
+        # Stability of each sample is its mean co-clustering frequency with the other members of its reference cluster
+        same_ref_cluster = ref_labels[:, None] == ref_labels[None, :]
+        np.fill_diagonal(same_ref_cluster, False)
+        with np.errstate(invalid='ignore'):
+            stability = (co_cluster_df.values * same_ref_cluster).sum(axis=1) / same_ref_cluster.sum(axis=1)
+        pd.DataFrame(
+            {'reference_cluster': ref_labels, 'stability': stability}, index=pd.Index(sample_names, name='sample_name')
+        ).to_csv(f"bootstrap_sample_stability_{species}.csv")
+        return {
+            'linkage': ref_linkage, 'sample_names': sample_names, 'support': support / self.n_boot,
+            'co_cluster_df': co_cluster_df
+        }
+
+    def _bootstrap_profile_clustering(self):
+        print(f"Bootstrapping the profile clustering ({self.n_boot} replicates)")
+        profile_abundance = self._load_abundance('profile').drop_empty_features()
+        profile_to_div_set_dict = self.get_div_incidence().div_sets(profile_abundance.feature_names)
+        profiles = list(profile_to_div_set_dict.keys())
+
+        # The sequence counts of the samples any profile was found in
+        profile_presence = profile_abundance.matrix.tocsc() > 0
+        samples = [
+            s for s, found in zip(profile_abundance.sample_names, np.asarray(profile_presence.sum(axis=1)).ravel())
+            if found and s in self.seq_abundance.sample_name_to_row_dict
+        ]
+        seq_abundance = self.seq_abundance.subset(sample_names=samples)
+        totals = np.asarray(seq_abundance.matrix.sum(axis=1)).ravel()
+        seq_abundance = seq_abundance.subset(sample_names=[s for s, tot in zip(samples, totals) if tot > 0])
+        counts = seq_abundance.matrix.toarray()
+        counts_path = os.path.join(self.tmp_dir, 'profile_sample_counts.npy')
+        np.save(counts_path, counts)
+
+        # For every DIV of every profile: its column in the counts and the rows of the samples of the profile
+        # it was detected in
+        seq_to_col_dict = {f: i for i, f in enumerate(seq_abundance.feature_names)}
+        profile_sample_rows = np.array([
+            seq_abundance.sample_name_to_row_dict.get(_, -1) for _ in profile_abundance.sample_names])
+        profile_to_col_dict = {p: i for i, p in enumerate(profile_abundance.feature_names)}
+        profile_div_samples = {}
+        for p in profiles:
+            rows = profile_sample_rows[profile_presence[:, profile_to_col_dict[p]].nonzero()[0]]
+            rows = rows[rows >= 0]
+            div_samples = []
+            for div in sorted(profile_to_div_set_dict[p]):
+                seq_col = seq_to_col_dict.get(div)
+                if seq_col is None:
+                    div_samples.append((div, 0, np.array([], dtype=np.int64)))
+                else:
+                    div_samples.append((div, seq_col, rows[counts[rows, seq_col] > 0]))
+            profile_div_samples[p] = div_samples
+
+        co_cluster = np.zeros((len(profiles), len(profiles)), dtype=np.int64)
+        seeds, chunk_sizes = self._chunks(seed_offset=2)
+        for chunk_labels in self.backend.map(
+                bootstrap_profile_chunk, zip(seeds, chunk_sizes), initializer=bootstrap_worker_init,
+                initargs=(counts_path, [], self.method, self.n_clusters, profile_div_samples)
+        ):
+            for labels in chunk_labels:
+                co_cluster += labels[:, None] == labels[None, :]
+        profile_names = [profile_abundance.feature_label(_) for _ in profiles]
+        co_cluster_df = pd.DataFrame(co_cluster / self.n_boot, index=profile_names, columns=profile_names)
+        co_cluster_df.to_csv("bootstrap_profile_co_clustering.csv")
+        return co_cluster_df
+
+    def annotate_dendrogram(self, ax, species, leaf_x_dict=None, min_support=0.5, fontsize=3):
+        """
+        Write the bootstrap support (%) of each clade at its node of a dendrogram drawn from the reference linkage.
+        A link is centred over its two children at the height of the merge.
+        :param leaf_x_dict: sample name to the x coordinate of its leaf in the drawn dendrogram. By default
+        scipy's dendrogram layout of the reference linkage (leaves at 5, 15, 25...)
+        """
+        results = self.dendro_results[species]
+        ref_linkage = results['linkage']
+        n = len(results['sample_names'])
+        x = np.empty(2 * n - 1)
+        if leaf_x_dict is None:
+            x[dendrogram(ref_linkage, no_plot=True)['leaves']] = np.arange(5, n * 10, 10)
+        else:
+            x[:n] = [leaf_x_dict[_] for _ in results['sample_names']]
+        for i, (left, right) in enumerate(ref_linkage[:, :2].astype(int)):
+            x[n + i] = (x[left] + x[right]) / 2
+            if results['support'][i] >= min_support and i < n - 2:
+                ax.text(
+                    x[n + i], ref_linkage[i, 2], f"{results['support'][i] * 100:.0f}",
+                    ha='center', va='bottom', fontsize=fontsize
+                )
+
+    def _plot_support(self, species):
+        fig, ax = plt.subplots(figsize=self._mm2inch(183, 80))
+        results = self.dendro_results[species]
+        dendrogram(results['linkage'], ax=ax, no_labels=True, color_threshold=0, above_threshold_color='black')
+        ax.collections[0].set_linewidth(0.25)
+        self.annotate_dendrogram(ax, species)
+        ax.set_title(
+            f"{'P. verrucosa' if species == 'pver' else 'S. pistillata'} bootstrap support ({self.n_boot} replicates)",
+            style='italic', fontsize='small')
+        plt.savefig(f'bootstrap_dendro_{species}.svg')
+        plt.savefig(f'bootstrap_dendro_{species}.png', dpi=1200)
+        plt.close(fig)
+
+
+class Buitrago16S(Buitrago):
+    """
+    Run the dendrogram and bar figure pipeline on the 16S ASV tables so that bacterial and
+    Symbiodiniaceae panels can be plotted together.
+
+    The ASV table is streamed from its zip archive into an SPAbundance (the same sparse representation used for the
+    ITS2 count tables). For each species the samples are clustered (Bray-Curtis of the square root transformed
+    relative abundances) and the 16S ASVs, the ITS2 sequences and the region of each sample are plotted
+    below the 16S dendrogram in the dendrogram leaf order.
+    """
+    inputs = Buitrago.inputs + ('seq', '16S')
+
+    def __init__(
+            self, dist_type='bc', asv_zip_path=None, n_bar_features=20, method='average',
+            prefetcher=None, sp_output_dir=None
+    ):
+        super().__init__(dist_type=dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
+        self.n_bar_features = n_bar_features
+        self.method = method
+        print("Streaming the 16S ASV table")
+        # By default the '16S' input (../16S/SpisPver_ASVs_QCfiltered.txt.zip)
+        self.asv_abundance = self._read_input(
+            asv_zip_path if asv_zip_path else self.input_path_dict['16S'][0], 'asv_zip')
+        self.seq_abundance = self._load_abundance('seq')
+
+        gs = gridspec.GridSpec(nrows=19, ncols=2)
+        self.fig = plt.figure(figsize=(self._mm2inch(183, 80)))
+        for col, (species, species_df, title) in enumerate(
+                [('pver', self.pver_df, 'P. verrucosa'), ('spis', self.spis_df, 'S. pistillata')]
+        ):
+            dendro_ax = plt.subplot(gs[:8, col:col + 1])
+            asv_bars_ax = plt.subplot(gs[8:12, col:col + 1])
+            seq_bars_ax = plt.subplot(gs[12:16, col:col + 1])
+            region_ax = plt.subplot(gs[16:18, col:col + 1])
+            samples = [
+                _ for _ in species_df.index if
+                _ in self.asv_abundance.sample_name_to_row_dict and _ in self.seq_abundance.sample_name_to_row_dict
+            ]
+            asv_abundance = self.asv_abundance.subset(sample_names=samples)
+            totals = np.asarray(asv_abundance.matrix.sum(axis=1)).ravel()
+            samples = [s for s, tot in zip(samples, totals) if tot > 0]
+            leaf_order_samples = self.plot_dendrogram(
+                ax=dendro_ax, abundance=self.asv_abundance.subset(sample_names=samples))
+            dendro_ax.set_title(title, style='italic', fontsize='small')
+            self.plot_abundance_bars(
+                ax=asv_bars_ax, abundance=self.asv_abundance, sample_names=leaf_order_samples, label='16S ASVs')
+            self.plot_abundance_bars(
+                ax=seq_bars_ax, abundance=self.seq_abundance, sample_names=leaf_order_samples, label='ITS2 seqs')
+            self.plot_region_strip(ax=region_ax, sample_names=leaf_order_samples)
+        plt.savefig(f'dendro_bars_16S_ITS2_{dist_type}.species.split.svg')
+        plt.savefig(f'dendro_bars_16S_ITS2_{dist_type}.species.split.png', dpi=1200)
+
+    def plot_dendrogram(self, ax, abundance):
+        """
+        Plot the dendrogram of the samples of an SPAbundance.
+        :return: the sample names in leaf order
+        """
+        sample_linkage = bc_sqrt_linkage(abundance.matrix.toarray(), self.method)
+        dendro = dendrogram(
+            sample_linkage, ax=ax, no_labels=True, color_threshold=0, above_threshold_color='black')
+        ax.collections[0].set_linewidth(0.25)
+        ax.set_xticks([])
+        return [abundance.sample_names[_] for _ in dendro['leaves']]
+
+    def plot_abundance_bars(self, ax, abundance, sample_names, label):
+        """
+        Plot the relative abundances of the n_bar_features most abundant features (plus 'other') of an
+        SPAbundance as stacked bars, one per sample in the order given.
+        """
+        rel = abundance.subset(sample_names=sample_names).relative().matrix
+        top = np.argsort(-np.asarray(rel.sum(axis=0)).ravel())[:self.n_bar_features]
+        top_rel = rel[:, top].toarray()
+        other = np.clip(1 - top_rel.sum(axis=1), 0, 1)
+        colors = plt.get_cmap('tab20').colors
+        x = np.arange(len(sample_names))
+        bottom = np.zeros(len(sample_names))
+        for i in range(top_rel.shape[1]):
+            ax.bar(x, top_rel[:, i], bottom=bottom, width=1, color=colors[i % len(colors)], linewidth=0)
+            bottom += top_rel[:, i]
+        ax.bar(x, other, bottom=bottom, width=1, color='#D0CFD4', linewidth=0)
+        ax.set_xlim(-0.5, len(sample_names) - 0.5)
+        ax.set_ylim(0, 1)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        ax.set_ylabel(label, rotation='vertical', fontsize='xx-small')
+
+    def plot_region_strip(self, ax, sample_names):
+        meta_index = self.get_meta_index()
+        colors = list(meta_index.colors('region', self.region_color_dict, meta_index.take(sample_names)))
+        ax.bar(np.arange(len(sample_names)), np.ones(len(sample_names)), width=1, color=colors, linewidth=0)
+        ax.set_xlim(-0.5, len(sample_names) - 0.5)
+        ax.set_ylim(0, 1)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        ax.set_ylabel('region', rotation='vertical', fontsize='xx-small')
+
+
+_HTML_VIEWER_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>__TITLE__</title>
+<style>
+body { font-family: sans-serif; font-size: 12px; margin: 8px; }
+.panel { display: block; width: 100%; border-bottom: 1px solid #ddd; }
+#tooltip { position: fixed; pointer-events: none; background: rgba(255,255,255,0.95); border: 1px solid #888;
+           padding: 4px; display: none; white-space: pre; font-size: 11px; }
+#controls { margin-bottom: 4px; }
+</style>
+</head>
+<body>
+<div id="controls">
+species: <select id="species"></select>
+<span>scroll to zoom, drag to pan, double click to reset</span>
+</div>
+<div id="panels"></div>
+<div id="tooltip"></div>
+<script>
+const DATA = __DATA__;
+const TILES = __TILES__;
+// Tiles are held as strings and only parsed when a tile of the visible level is first drawn
+const parsedTiles = {};
+function getTile(species, level, tile) {
+  const key = species + "_" + level + "_" + tile;
+  if (!(key in parsedTiles)) { parsedTiles[key] = key in TILES ? JSON.parse(TILES[key]) : null; }
+  return parsedTiles[key];
+}
+const PANELS = [["dendro", 160], ["seq", 80], ["prof", 80], ["region", 20]];
+const canvases = {};
+for (const [name, height] of PANELS) {
+  const c = document.createElement("canvas");
+  c.className = "panel"; c.height = height; c.dataset.panel = name;
+  document.getElementById("panels").appendChild(c);
+  canvases[name] = c;
+}
+const select = document.getElementById("species");
+for (const sp of Object.keys(DATA.species)) {
+  const o = document.createElement("option"); o.value = sp; o.text = sp; select.appendChild(o);
+}
+let species = select.value;
+let view = {start: 0, end: DATA.species[species].n};
+select.onchange = () => { species = select.value; view = {start: 0, end: DATA.species[species].n}; draw(); };
+
+function level() {
+  // The coarsest level whose bins are still no wider than a pixel column
+  const perPixel = (view.end - view.start) / canvases.seq.width;
+  const sp = DATA.species[species];
+  return Math.max(0, Math.min(sp.n_levels - 1, Math.floor(Math.log2(Math.max(perPixel, 1)))));
+}
+function xOf(pos, width) { return (pos - view.start) / (view.end - view.start) * width; }
+
+function forEachVisibleBin(fn) {
+  const sp = DATA.species[species];
+  const lvl = level();
+  const binSize = 1 << lvl;
+  const firstBin = Math.max(0, Math.floor(view.start / binSize));
+  const lastBin = Math.min(Math.ceil(sp.n / binSize) - 1, Math.ceil(view.end / binSize));
+  for (let t = Math.floor(firstBin / DATA.tile_size); t <= Math.floor(lastBin / DATA.tile_size); t++) {
+    const tile = getTile(species, lvl, t);
+    if (!tile) continue;
+    for (let i = 0; i < tile.bins.length; i++) {
+      const b = t * DATA.tile_size + i;
+      if (b < firstBin || b > lastBin) continue;
+      fn(b * binSize, Math.min((b + 1) * binSize, sp.n), tile.bins[i]);
+    }
+  }
+}
+
+function drawBars(name, key, colors) {
+  const c = canvases[name], ctx = c.getContext("2d");
+  ctx.clearRect(0, 0, c.width, c.height);
+  forEachVisibleBin((s, e, bin) => {
+    const x0 = xOf(s, c.width), x1 = xOf(e, c.width);
+    let y = c.height;
+    const [idx, vals] = bin[key];
+    for (let k = 0; k < idx.length; k++) {
+      const h = vals[k] * c.height;
+      ctx.fillStyle = colors[idx[k]];
+      ctx.fillRect(x0, y - h, Math.max(x1 - x0, 1), h);
+      y -= h;
+    }
+  });
+}
+
+function drawRegion() {
+  const c = canvases.region, ctx = c.getContext("2d");
+  ctx.clearRect(0, 0, c.width, c.height);
+  forEachVisibleBin((s, e, bin) => {
+    ctx.fillStyle = DATA.region_colors[bin.region];
+    const x0 = xOf(s, c.width), x1 = xOf(e, c.width);
+    ctx.fillRect(x0, 0, Math.max(x1 - x0, 1), c.height);
+  });
+}
+
+function drawDendro() {
+  const c = canvases.dendro, ctx = c.getContext("2d");
+  const sp = DATA.species[species];
+  ctx.clearRect(0, 0, c.width, c.height);
+  ctx.strokeStyle = "black"; ctx.lineWidth = 0.5; ctx.beginPath();
+  for (let i = 0; i < sp.dendro_x.length; i += 4) {
+    // Only draw the links that overlap the view
+    if (sp.dendro_x[i + 3] < view.start || sp.dendro_x[i] > view.end) continue;
+    for (let k = 0; k < 4; k++) {
+      const x = xOf(sp.dendro_x[i + k], c.width), y = c.height * (1 - sp.dendro_y[i + k] / sp.max_height);
+      if (k === 0) ctx.moveTo(x, y); else ctx.lineTo(x, y);
+    }
+  }
+  ctx.stroke();
+}
+
+function draw() {
+  for (const c of Object.values(canvases)) { c.width = c.clientWidth; }
+  drawDendro();
+  drawBars("seq", "seq", DATA.seq_colors);
+  drawBars("prof", "prof", DATA.prof_colors);
+  drawRegion();
+}
+
+function describe(bin, s, e) {
+  const lines = [];
+  const sp = DATA.species[species];
+  lines.push(e - s === 1 ? bin.name : (e - s) + " samples (" + sp.sample_names[s] + " ... " + sp.sample_names[e - 1] + ")");
+  lines.push("region: " + DATA.regions[bin.region]);
+  const [pIdx, pVals] = bin.prof;
+  if (pIdx.length) lines.push("profiles:");
+  for (let k = 0; k < pIdx.length; k++) lines.push("  " + DATA.prof_names[pIdx[k]] + " " + (pVals[k] * 100).toFixed(1) + "%");
+  const [sIdx, sVals] = bin.seq;
+  lines.push("DIVs:");
+  for (let k = 0; k < Math.min(sIdx.length, 6); k++) lines.push("  " + DATA.seq_names[sIdx[k]] + " " + (sVals[k] * 100).toFixed(1) + "%");
+  return lines.join("\\n");
+}
+
+const tooltip = document.getElementById("tooltip");
+let drag = null;
+for (const c of Object.values(canvases)) {
+  c.addEventListener("wheel", ev => {
+    ev.preventDefault();
+    const sp = DATA.species[species];
+    const pos = view.start + ev.offsetX / c.width * (view.end - view.start);
+    const factor = ev.deltaY > 0 ? 1.25 : 0.8;
+    const span = Math.min(sp.n, Math.max(10, (view.end - view.start) * factor));
+    let start = pos - (pos - view.start) * span / (view.end - view.start);
+    start = Math.max(0, Math.min(sp.n - span, start));
+    view = {start: start, end: start + span};
+    draw();
+  });
+  c.addEventListener("mousedown", ev => { drag = {x: ev.clientX, view: Object.assign({}, view)}; });
+  c.addEventListener("dblclick", () => { view = {start: 0, end: DATA.species[species].n}; draw(); });
+  c.addEventListener("mousemove", ev => {
+    const sp = DATA.species[species];
+    if (drag) {
+      const span = drag.view.end - drag.view.start;
+      let start = drag.view.start - (ev.clientX - drag.x) / c.width * span;
+      start = Math.max(0, Math.min(sp.n - span, start));
+      view = {start: start, end: start + span};
+      draw();
+      return;
+    }
+    const pos = view.start + ev.offsetX / c.width * (view.end - view.start);
+    let found = null;
+    forEachVisibleBin((s, e, bin) => { if (pos >= s && pos < e) found = describe(bin, s, e); });
+    if (found) {
+      tooltip.textContent = found; tooltip.style.display = "block";
+      tooltip.style.left = (ev.clientX + 12) + "px"; tooltip.style.top = (ev.clientY + 12) + "px";
+    }
+  });
+  c.addEventListener("mouseleave", () => { tooltip.style.display = "none"; });
+}
+window.addEventListener("mouseup", () => { drag = null; });
+window.addEventListener("resize", draw);
+draw();
+</script>
+</body>
+</html>
+"""
+
+
+class BuitragoHTMLViewer(Buitrago):
+    """
+    Export the species split dendrogram, sequence, profile and region stack (see BuitragoHier_split_species)
+    as a self contained interactive HTML file that can be opened from disk without a server.
+
+    For every species, the samples (in dendrogram leaf order) are aggregated into multi resolution levels: level 0
+    has one bin per sample and each subsequent level halves the number of bins by averaging the relative
+    abundances of neighbouring samples. Each level is split into tiles of tile_size bins and only the
+    top_k sequences and profiles of each bin are kept. The viewer picks the level matching the current zoom
+    (bins no narrower than a pixel column) and only parses the tiles of that level that are in view.
+    Hovering shows the sample (or sample range), region, profiles and most abundant DIVs.
+    """
+    inputs = Buitrago.inputs + ('seq', 'profile')
+
+    def __init__(
+            self, dist_type='bc', html_path=None, top_k=12, tile_size=256, method='average',
+            prefetcher=None, sp_output_dir=None
+    ):
+        super().__init__(dist_type=dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
+        self.top_k = top_k
+        self.tile_size = tile_size
+        self.method = method
+        self.html_path = html_path if html_path else f'dendro_bars_{dist_type}.species.split.html'
+        self.seq_abundance = self._load_abundance('seq').relative()
+        self.profile_abundance = self._load_abundance('profile').relative()
+        self.sym_dist_df = self._read_sp_dist_df(self.symbiodinium_dist_path)
+
+        data = {
+            'tile_size': tile_size, 'regions': self.regions,
+            'region_colors': [self.region_color_dict[_] for _ in self.regions],
+            'seq_names': [str(_) for _ in self.seq_abundance.feature_names],
+            'prof_names': [str(self.profile_abundance.feature_label(_)) for _ in self.profile_abundance.feature_names],
+            'species': {}
+        }
+        data['seq_colors'] = self._feature_colors(len(data['seq_names']))
+        data['prof_colors'] = self._feature_colors(len(data['prof_names']))
+        tiles = {}
+        for species in ['pver', 'spis']:
+            data['species'][species] = self._make_species_levels(species, tiles)
+
+        html = _HTML_VIEWER_TEMPLATE.replace('__TITLE__', self.html_path)
+        html = html.replace('__DATA__', json.dumps(data, separators=(',', ':')))
+        html = html.replace('__TILES__', json.dumps(tiles, separators=(',', ':')))
+        with open(self.html_path, 'w') as f:
+            f.write(html)
+        print(f"Wrote {self.html_path}")
+
+    @staticmethod
+    def _feature_colors(n):
+        """Distinct colours for n features (cycling the tab20 colours with a varying lightness)"""
+        base = np.array(plt.get_cmap('tab20').colors)
+        colors = []
+        for i in range(n):
+            shade = 0.6 + 0.4 * ((i // len(base)) % 3) / 2
+            colors.append(mpl.colors.to_hex(np.clip(base[i % len(base)] * shade, 0, 1)))
+        return colors
+
+    def _make_species_levels(self, species, tiles):
+        samples = sorted(
+            _ for _ in self.symbiodinium_host_names if _[0] == species[0].upper()
+            and _ in self.seq_abundance.sample_name_to_row_dict
+        )
+        dist = squareform(self.sym_dist_df.loc[samples, samples].values, checks=False)
+        dendro = dendrogram(linkage(dist, method=self.method), no_plot=True)
+        samples = [samples[_] for _ in dendro['leaves']]
+        n = len(samples)
+        seq_rel = self.seq_abundance.subset(sample_names=samples).matrix
+        prof_rows = [self.profile_abundance.sample_name_to_row_dict.get(_) for _ in samples]
+        prof_rel = sparse.vstack([
+            self.profile_abundance.matrix[r] if r is not None else
+            sparse.csr_matrix((1, len(self.profile_abundance.feature_names))) for r in prof_rows
+        ]).tocsr()
+        region_codes = self.get_meta_index().codes_of('region', self.get_meta_index().take(samples))
+
+        n_levels = int(np.ceil(np.log2(n))) + 1 if n > 1 else 1
+        for lvl in range(n_levels):
+            bin_size = 2 ** lvl
+            n_bins = int(np.ceil(n / bin_size))
+            bin_codes = np.arange(n) // bin_size
+            # bins x samples averaging matrix
+            averager = sparse.csr_matrix(
+                (1 / np.bincount(bin_codes)[bin_codes], (bin_codes, np.arange(n))), shape=(n_bins, n))
+            seq_bins = (averager @ seq_rel).tocsr()
+            prof_bins = (averager @ prof_rel).tocsr()
+            bins = []
+            for b in range(n_bins):
+                members = region_codes[b * bin_size:(b + 1) * bin_size]
+                bin_dict = {
+                    'seq': self._top_features(seq_bins, b), 'prof': self._top_features(prof_bins, b),
+                    'region': int(np.bincount(members).argmax())
+                }
+                if bin_size == 1:
+                    bin_dict['name'] = samples[b]
+                bins.append(bin_dict)
+            for t in range(int(np.ceil(n_bins / self.tile_size))):
+                tiles[f"{species}_{lvl}_{t}"] = json.dumps(
+                    {'bins': bins[t * self.tile_size:(t + 1) * self.tile_size]}, separators=(',', ':'))
+
+        # Dendrogram link coordinates converted from scipy's 5, 15, 25... leaf positions to sample positions
+        dendro_x = ((np.array(dendro['icoord']) - 5) / 10 + 0.5).round(2)
+        dendro_y = np.array(dendro['dcoord']).round(5)
+        return {
+            'n': n, 'n_levels': n_levels, 'sample_names': samples,
+            'dendro_x': dendro_x.ravel().tolist(), 'dendro_y': dendro_y.ravel().tolist(),
+            'max_height': float(dendro_y.max()) if len(dendro_y) else 1.0
+        }
+
+    def _top_features(self, bin_matrix, b):
+        """The top_k (feature index, rounded relative abundance) of a bin, most abundant first"""
+        start, end = bin_matrix.indptr[b], bin_matrix.indptr[b + 1]
+        idx = bin_matrix.indices[start:end]
+        vals = bin_matrix.data[start:end]
+        order = np.argsort(-vals)[:self.top_k]
+        return [idx[order].tolist(), vals[order].round(4).tolist()]
+
+
+class BuitragoDistHeatmap(Buitrago):
+    """
+    Heatmap of a between sample (or between profile) distance matrix in dendrogram leaf order, for matrices too large
+    to plot cell by cell.
+
+    The distances are read from the memory mapped .npy of the InputCache (see InputCache.dist_memmap) in blocks of
+    rows. Each block is reduced onto the output pixel grid (resolution x resolution) as it is read, keeping the mean,
+    min and max of the cells falling in each pixel, so that only one block and the pixel grids are held in memory
+    and the figure renders resolution**2 pixels regardless of the number of samples.
+    The samples are ordered by the leaves of the SPHierarchical dendrogram (plotted above the heatmap). Between sample
+    heatmaps are annotated with the species and region strips.
+
+    :param dist: 'sample' for the between sample distances or 'profile_A', 'profile_C' or 'profile_D'
+    :param species: 'pver' or 'spis' to plot one species' samples (between sample distances only)
+    :param reduce: which pixel statistic to plot: 'mean', 'min' or 'max'
+    """
+    inputs = Buitrago.inputs + ('profile_dist_A', 'profile_dist_C', 'profile_dist_D')
+
+    def __init__(
+            self, dist_type='bc', dist='sample', species=None, resolution=1000, reduce='mean',
+            cache_dir='.buitrago_cache', block_bytes=2 ** 26, cmap='viridis', prefetcher=None, sp_output_dir=None
+    ):
+        super().__init__(dist_type=dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
+        if reduce not in ['mean', 'min', 'max']:
+            raise ValueError(f"Unknown reduce {reduce}. Use 'mean', 'min' or 'max'")
+        if dist == 'sample':
+            dist_path = self.symbiodinium_dist_path
+        else:
+            dist_path = self.input_path_dict[f'profile_dist_{dist[-1]}'][0]
+        names, uids, self.dist_memmap = InputCache(cache_dir).dist_memmap(dist_path)
+        self.block_bytes = block_bytes
+
+        gs = gridspec.GridSpec(nrows=22, ncols=20)
+        self.fig = plt.figure(figsize=self._mm2inch(183, 200))
+        dendro_ax = plt.subplot(gs[:4, 1:19])
+        heatmap_ax = plt.subplot(gs[6:, 1:19])
+        colorbar_ax = plt.subplot(gs[6:, 19:20])
+
+        if dist == 'sample':
+            meta_index = self.get_meta_index()
+            included = meta_index.names(species=species) if species else list(self.all_samples_df.index)
+            included = [_ for _ in included if _ in self.symbiodinium_host_names]
+        else:
+            included = None
+        sph = SPHierarchical(dist_output_path=dist_path, ax=dendro_ax, sample_names_included=included)
+        sph.plot()
+        dendro_ax.collections[0].set_linewidth(0.25)
+        dendro_ax.set_xticks([])
+        dendro_ax.set_yticks([])
+        uid_to_row_dict = {str(uid): row for row, uid in enumerate(uids)}
+        self.leaf_rows = np.array([uid_to_row_dict[str(_)] for _ in sph.dendrogram['ivl']], dtype=np.int64)
+        self.leaf_names = [names[_] for _ in self.leaf_rows]
+        n = len(self.leaf_rows)
+        print(f"Reducing the {n} x {n} distance matrix to {min(resolution, n)} x {min(resolution, n)} pixels")
+        self.grids = self.reduce_to_grid(min(resolution, n))
+
+        image = heatmap_ax.imshow(
+            self.grids[reduce], cmap=cmap, extent=(-0.5, n - 0.5, n - 0.5, -0.5), interpolation='nearest',
+            aspect='auto')
+        image.set_rasterized(True)
+        heatmap_ax.set_xticks([])
+        heatmap_ax.set_yticks([])
+        cbar = plt.colorbar(image, cax=colorbar_ax)
+        cbar.set_label(f'{reduce} {dist_type} distance', fontsize='xx-small')
+        cbar.ax.tick_params(labelsize='xx-small')
+        if dist == 'sample':
+            leaf_positions = np.arange(n)
+            for i, meta in enumerate(['species', 'region']):
+                strip_ax = plt.subplot(gs[4 + i:5 + i, 1:19])
+                self._plot_meta_runs(ax=strip_ax, meta=meta, sample_names=self.leaf_names, x_coords=leaf_positions,
+                                     width=1)
+                strip_ax.set_xlim(-0.5, n - 0.5)
+                strip_ax.set_ylim(0, 1)
+                strip_ax.set_xticks([])
+                strip_ax.set_yticks([])
+                strip_ax.set_ylabel(meta, rotation='horizontal', ha='right', va='center', fontsize='xx-small')
+            region_ax = plt.subplot(gs[6:, :1])
+            self._plot_meta_runs(ax=region_ax, meta='region', sample_names=self.leaf_names, x_coords=leaf_positions,
+                                 width=1, vertical=True)
+            region_ax.set_ylim(n - 0.5, -0.5)
+            region_ax.set_xlim(0, 1)
+            region_ax.set_xticks([])
+            region_ax.set_yticks([])
+        path_stub = f"dist_heatmap_{dist_type}_{dist}{'_' + species if species else ''}_{reduce}"
+        plt.savefig(f"{path_stub}.svg", dpi=600)
+        plt.savefig(f"{path_stub}.png", dpi=600)
+
+    def reduce_to_grid(self, resolution):
+        """
+        Reduce the leaf ordered distance matrix to resolution x resolution pixels reading it in blocks of rows.
+        Pixel i covers the leaves whose position * resolution // n is i.
+        :return: dict of 'mean', 'min' and 'max' to the resolution x resolution pixel grids
+        """
+        n = len(self.leaf_rows)
+        pixel_of_leaf = np.arange(n) * resolution // n
+        # The first leaf of each pixel (leaf positions are in order so each pixel is a contiguous run of leaves)
+        pixel_starts = np.searchsorted(pixel_of_leaf, np.arange(resolution))
+        pixel_sizes = np.diff(np.append(pixel_starts, n))
+        sum_grid = np.zeros((resolution, resolution))
+        min_grid = np.full((resolution, resolution), np.inf)
+        max_grid = np.full((resolution, resolution), -np.inf)
+        block_rows = max(1, int(self.block_bytes // (8 * self.dist_memmap.shape[1])))
+        for start in range(0, n, block_rows):
+            leaf_rows = self.leaf_rows[start:start + block_rows]
+            # Read the block's rows in file order (sequential reads of the memory map) then put them in leaf order
+            file_order = np.argsort(leaf_rows)
+            block = np.empty((len(leaf_rows), self.dist_memmap.shape[1]))
+            block[file_order] = self.dist_memmap[leaf_rows[file_order]]
+            block = block[:, self.leaf_rows]
+            pixel_rows = pixel_of_leaf[start:start + block_rows]
+            np.add.at(sum_grid, pixel_rows, np.add.reduceat(block, pixel_starts, axis=1))
+            np.minimum.at(min_grid, pixel_rows, np.minimum.reduceat(block, pixel_starts, axis=1))
+            np.maximum.at(max_grid, pixel_rows, np.maximum.reduceat(block, pixel_starts, axis=1))
+        return {
+            'mean': sum_grid / np.outer(pixel_sizes, pixel_sizes), 'min': min_grid, 'max': max_grid
+        }
+
+
+def _import_radseq_genotypes():
+    """The genotype module of the RAD-Seq analyses (RADSeq/radseq_genotypes.py)"""
+    radseq_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RADSeq')
+    if radseq_dir not in sys.path:
+        sys.path.append(radseq_dir)
+    import radseq_genotypes
+    return radseq_genotypes
+
+
+class BuitragoHostSymbiontOrdination(Buitrago):
+    """
+    Host genetic structure and Symbiodinium composition side by side for the same colonies.
+
+    For each species the host PCA (the randomized genotype PCA of RADSeq/radseq_genotypes.py, or any plink style
+    .eigenvec/.eigenval pair e.g. from 06_*_PCAstructure.R) and the PCoA of the Symbiodinium distances of that
+    species' samples are aligned by sample name. The correlations between every host PC and (unrotated) symbiont
+    PCoA axis are written to host_symbiont_axis_correlations_{dist_type}.csv. The symbiont PCoA is Procrustes rotated
+    onto the host PCs for display only, so that the panels share orientation; as the rotation is fitted to the host PCs
+    the fit is tested with PROTEST (the symmetric Procrustes m2 compared with n_perm permutations of the samples)
+    and written to host_symbiont_procrustes_{dist_type}.csv. The aligned (unrotated) coordinates are written to
+    host_symbiont_coords_{dist_type}.csv.
+
+    :param host_pca: dict of species ('pver', 'spis') to a genotype store directory, a filtered .vcf(.gz)
+    (converted to a genotype store next to it on first use) or the prefix of a plink .eigenvec/.eigenval pair.
+    By default RADSeq/{species}_genotypes.
+    """
+    def __init__(
+            self, dist_type='bc', host_pca=None, n_components=10, min_maf=0.0, n_perm=999, seed=1234,
+            prefetcher=None, sp_output_dir=None
+    ):
+        super().__init__(dist_type=dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
+        if host_pca is None:
+            host_pca = {
+                species: os.path.join(self.root_dir, '..', 'RADSeq', f'{species}_genotypes')
+                for species in ['pver', 'spis']
+            }
+        self.n_components = n_components
+        self.min_maf = min_maf
+        self.n_perm = n_perm
+        self.seed = seed
+        self.sym_dist_df = self._read_sp_dist_df(self.symbiodinium_dist_path)
+        meta_index = self.get_meta_index()
+
+        coord_dfs = []
+        corr_dfs = []
+        protest_rows = []
+        self.fig, self.ax_arr = plt.subplots(nrows=2, ncols=4, figsize=self._mm2inch(240, 120))
+        for row, (species, title) in enumerate([('pver', 'P. verrucosa'), ('spis', 'S. pistillata')]):
+            host_df, host_pve = self._host_pcs(host_pca[species])
+            samples = [
+                _ for _ in meta_index.names(species=species)
+                if _ in self.symbiodinium_host_names and _ in host_df.index
+            ]
+            print(f"{title}: {len(samples)} samples with both host genotypes and Symbiodinium")
+            sym_df, sym_pve = self._pcoa(self.sym_dist_df.loc[samples, samples], n_axes=self.n_components)
+            host_df = host_df.loc[samples]
+            corr_df = pd.DataFrame(
+                np.corrcoef(host_df.values.T, sym_df.values.T)[:host_df.shape[1], host_df.shape[1]:],
+                index=[f'host_{_}' for _ in host_df.columns], columns=[f'sym_{_}' for _ in sym_df.columns]
+            )
+            corr_dfs.append(corr_df.assign(species=species))
+            coord_dfs.append(pd.concat(
+                [host_df.add_prefix('host_'), sym_df.add_prefix('sym_')], axis=1).assign(species=species))
+            m2, p_value = self._protest(sym_df, host_df, n_perm=self.n_perm, seed=self.seed)
+            protest_rows.append({
+                'species': species, 'n_samples': len(samples), 'm2': m2, 'r': np.sqrt(1 - m2),
+                'n_perm': self.n_perm, 'p_value': p_value
+            })
+            rotated_sym_df = self._procrustes_rotate(sym_df, host_df)
+
+            rows = meta_index.take(samples)
+            colors = meta_index.colors('region', self.region_color_dict, rows)
+            self._scatter(self.ax_arr[row][0], host_df['PC1'], host_df['PC2'], colors,
+                          f'host PC1 {host_pve[0]:.2f}', f'host PC2 {host_pve[1]:.2f}')
+            self.ax_arr[row][0].set_title(f'{title} host', fontsize='x-small', style='italic')
+            self._scatter(self.ax_arr[row][1], rotated_sym_df['PC1'], rotated_sym_df['PC2'], colors,
+                          'Symbiodinium rotated axis 1', 'Symbiodinium rotated axis 2')
+            # The rotated axes mix the PCoA axes so the title gives the variance explained by the first two PCoA axes
+            self.ax_arr[row][1].set_title(
+                f'{title} Symbiodinium (rotated, PC1+2 {sym_pve[:2].sum():.2f}, '
+                f'm2 = {m2:.2f}, p = {p_value:.3f})', fontsize='x-small', style='italic')
+            self._scatter(self.ax_arr[row][2], host_df['PC1'], sym_df['PC1'], colors,
+                          'host PC1', f'Symbiodinium PC1 {sym_pve[0]:.2f}')
+            self.ax_arr[row][2].set_title(f'r = {corr_df.iat[0, 0]:.2f}', fontsize='x-small')
+            self._plot_corr(self.ax_arr[row][3], corr_df.iloc[:5, :5])
+        self._plot_region_legend(self.ax_arr[0][0])
+
+        pd.concat(coord_dfs).to_csv(f'host_symbiont_coords_{dist_type}.csv')
+        pd.concat(corr_dfs).to_csv(f'host_symbiont_axis_correlations_{dist_type}.csv')
+        self.protest_df = pd.DataFrame(protest_rows).set_index('species')
+        self.protest_df.to_csv(f'host_symbiont_procrustes_{dist_type}.csv')
+        plt.tight_layout()
+        plt.savefig(f'host_symbiont_ordination_{dist_type}.svg')
+        plt.savefig(f'host_symbiont_ordination_{dist_type}.png', dpi=600)
+
+    def _host_pcs(self, source):
+        """
+        The host PCs (samples x PC1..PCk) and proportion of variance explained of each PC.
+        PCs are computed from a genotype store (or a VCF) or read from a plink .eigenvec/.eigenval pair.
+        """
+        radseq_genotypes = _import_radseq_genotypes()
+        if os.path.exists(f'{source}.eigenvec'):
+            pc_df, eigenvalues = radseq_genotypes.read_plink_pca(source)
+            # Relative to the computed components only, as in 06_*_PCAstructure.R
+            return pc_df.iloc[:, :self.n_components], eigenvalues[:self.n_components] / eigenvalues.sum()
+        if re.search(r'\.vcf(\.gz)?$', source):
+            store_dir = re.sub(r'\.vcf(\.gz)?$', '_genotypes', source)
+            if not os.path.exists(os.path.join(store_dir, 'meta.json')):
+                radseq_genotypes.GenotypeStore.from_vcf(source, store_dir)
+            source = store_dir
+        store = radseq_genotypes.GenotypeStore.open(source)
+        if self.min_maf:
+            store = store.filter_maf(self.min_maf)
+        pc_df, eigenvalues, total_variance = radseq_genotypes.randomized_pca(store, n_components=self.n_components)
+        return pc_df, eigenvalues / total_variance
+
+    @staticmethod
+    def _pcoa(dist_df, n_axes):
+        """Principal coordinates of a square distance df. :return: (df of samples x PC1..PCk, proportion explained)"""
+        d = dist_df.values.astype(float)
+        n = len(d)
+        centering = np.eye(n) - np.ones((n, n)) / n
+        b = -0.5 * centering @ (d ** 2) @ centering
+        eigenvalues, eigenvectors = np.linalg.eigh(b)
+        order = np.argsort(eigenvalues)[::-1]
+        eigenvalues, eigenvectors = eigenvalues[order], eigenvectors[:, order]
+        positive = eigenvalues > 0
+        coords = eigenvectors[:, :n_axes] * np.sqrt(np.clip(eigenvalues[:n_axes], 0, None))
+        pcoa_df = pd.DataFrame(coords, index=dist_df.index, columns=[f'PC{_ + 1}' for _ in range(coords.shape[1])])
+        return pcoa_df, eigenvalues[:n_axes] / eigenvalues[positive].sum()
+
+    @staticmethod
+    def _procrustes_rotate(sym_df, host_df):
+        """
+        Rotate (and reflect) the symbiont coordinates onto the host PCs with an orthogonal Procrustes rotation of the
+        leading axes common to both. Distances between samples, and so the ordination, are unchanged.
+        """
+        k = min(sym_df.shape[1], host_df.shape[1])
+        sym = sym_df.values[:, :k] - sym_df.values[:, :k].mean(axis=0)
+        host = host_df.values[:, :k] - host_df.values[:, :k].mean(axis=0)
+        u, _, vt = np.linalg.svd(sym.T @ host)
+        return pd.DataFrame(sym @ u @ vt, index=sym_df.index, columns=sym_df.columns[:k])
+
+    @staticmethod
+    def _protest(sym_df, host_df, n_perm, seed):
+        """
+        PROTEST of the symbiont PCoA against the host PCs (leading axes common to both): the symmetric Procrustes m2
+        of the centred and unit scaled configurations and the proportion of n_perm permutations of the symbiont
+        samples with an m2 as small or smaller (+1 in numerator and denominator).
+        :return: (m2, p_value)
+        """
+        k = min(sym_df.shape[1], host_df.shape[1])
+        sym = sym_df.values[:, :k] - sym_df.values[:, :k].mean(axis=0)
+        host = host_df.values[:, :k] - host_df.values[:, :k].mean(axis=0)
+        sym /= np.sqrt((sym ** 2).sum())
+        host /= np.sqrt((host ** 2).sum())
+        m2 = 1 - np.linalg.svd(sym.T @ host, compute_uv=False).sum() ** 2
+        rng = np.random.default_rng(seed)
+        n_as_good = sum(
+            1 - np.linalg.svd(sym[rng.permutation(len(sym))].T @ host, compute_uv=False).sum() ** 2 <= m2
+            for _ in range(n_perm)
+        )
+        return m2, (n_as_good + 1) / (n_perm + 1)
+
+    @staticmethod
+    def _scatter(ax, x, y, colors, x_label, y_label):
+        ax.scatter(x, y, c=list(colors), s=6, alpha=0.8, linewidths=0)
+        ax.set_xlabel(x_label, fontsize='xx-small')
+        ax.set_ylabel(y_label, fontsize='xx-small')
+        ax.tick_params(labelsize='xx-small')
+
+    @staticmethod
+    def _plot_corr(ax, corr_df):
+        im = ax.imshow(corr_df.values, cmap='RdBu_r', vmin=-1, vmax=1)
+        ax.set_xticks(range(corr_df.shape[1]))
+        ax.set_xticklabels(corr_df.columns, rotation=90, fontsize='xx-small')
+        ax.set_yticks(range(corr_df.shape[0]))
+        ax.set_yticklabels(corr_df.index, fontsize='xx-small')
+        plt.colorbar(im, ax=ax, fraction=0.046).ax.tick_params(labelsize='xx-small')
+
+    def _plot_region_legend(self, ax):
+        import matplotlib.lines as mlines
+        handles = [
+            mlines.Line2D(
+                [], [], color=self.region_color_dict[region], marker='o', markersize=2, label=region, linewidth=0)
+            for region in self.regions
+        ]
+        ax.legend(handles=handles, loc='best', fontsize='xx-small')
+
+
+def _batch_cache_run(sp_output_dir, cache_dir, dist_type, input_names):
+    """
+    Parse the inputs of one SymPortal run into the shared cache (in a batch worker process)
+    and collect the per run numbers for the batch summary.
+    """
+    input_path_dict = Buitrago._input_path_dict(dist_type, sp_output_dir)
+    run_stats = {}
+    with InputPrefetcher(n_proc=0, cache=InputCache(cache_dir)) as prefetcher:
+        futures = {
+            name: prefetcher.submit(*input_path_dict[name]) for name in input_names
+            if os.path.exists(input_path_dict[name][0])
+        }
+        for name in input_names:
+            run_stats[f'has_{name}'] = name in futures
+        if 'seq' in futures:
+            seq_abundance = futures['seq'].result()
+            run_stats['n_samples'] = len(seq_abundance.sample_names)
+            run_stats['n_sequences'] = len(seq_abundance.feature_names)
+        if 'profile' in futures:
+            run_stats['n_profiles'] = len(futures['profile'].result().feature_names)
+        if 'sym_dist' in futures:
+            run_stats['n_samples_sym_dist'] = len(futures['sym_dist'].result())
+    return run_stats
+
+
+def _batch_run_analysis(analysis, sp_output_dir, out_dir, cache_dir, dist_type, kwargs):
+    """Run one analysis of one SymPortal run in the run's output directory (in a batch worker process)"""
+    os.makedirs(out_dir, exist_ok=True)
+    os.chdir(out_dir)
+    before = set(os.listdir(out_dir))
+    cls = globals()[analysis]
+    params = inspect.signature(cls.__init__).parameters
+    if 'dist_type' in params:
+        kwargs = dict(kwargs, dist_type=dist_type)
+    start = time.time()
+    try:
+        with InputPrefetcher(n_proc=0, cache=InputCache(cache_dir)) as prefetcher:
+            cls.prefetch(dist_type=dist_type, prefetcher=prefetcher, sp_output_dir=sp_output_dir)
+            cls(prefetcher=prefetcher, sp_output_dir=sp_output_dir, **kwargs)
+        status = 'ok'
+    except Exception as e:
+        status = f'failed: {type(e).__name__}: {e}'
+    plt.close('all')
+    return {
+        'analysis': analysis, 'status': status, 'seconds': round(time.time() - start, 2),
+        'outputs': sorted(set(os.listdir(out_dir)) - before)
+    }
+
+
+class BuitragoBatch:
+    """
+    Run the same analyses across many SymPortal submissions.
 
-# For plotting the north to south genera, sequence, and profile bars for each species
-# BuitragoBars()
+    SymPortal output directories (directories containing post_med_seqs and its2_type_profiles) are discovered
+    below the search directories. Every analysis of every run is a job in a single process pool so that the
+    total number of processes used stays within n_workers: jobs that are given processes of their own
+    (the analyses with an n_proc parameter get n_proc_per_job) count as that many workers.
 
-# A modification of the original BuitragoBars to do custom colours of the clustered profiles plot
-BuitragoBars_clustered_profiles()
+    The inputs of every run are first parsed once into a shared InputCache (count tables pickled, distance
+    matrices as memory mappable .npy files) so that the analyses of a run, and reruns of the batch,
+    load them rather than re-parsing them.
 
-CalculateAverageProfDistances()
+    Outputs are written to out_dir/<run name>/<analysis>/. out_dir/batch_summary.csv has a row per run and
+    analysis (status, time and outputs), out_dir/batch_runs.csv a row per run (number of samples, sequences and
+    profiles and which inputs were found) and every .csv output that is produced by more than one run is
+    concatenated across the runs (with a run column) as out_dir/batch_<output name>.csv.
+    """
+    default_analyses = (
+        'BuitragoMantel', 'BuitragoEnvScan', 'BuitragoBootstrap', 'BuitragoHTMLViewer', 'CalculateAverageProfDistances'
+    )
+
+    def __init__(
+            self, search_dirs, out_dir='batch_output', analyses=default_analyses, analysis_kwargs=None,
+            dist_type='bc', n_workers=None, n_proc_per_job=1, cache_dir=None
+    ):
+        """
+        :param search_dirs: A directory or list of directories to search for SymPortal output directories
+        :param analysis_kwargs: Optional dict of analysis name to a dict of keyword arguments for that analysis
+        """
+        self.search_dirs = [search_dirs] if isinstance(search_dirs, str) else list(search_dirs)
+        self.out_dir = os.path.abspath(out_dir)
+        self.analyses = list(analyses)
+        self.analysis_kwargs = analysis_kwargs if analysis_kwargs else {}
+        self.dist_type = dist_type
+        self.n_workers = n_workers if n_workers else os.cpu_count()
+        self.n_proc_per_job = n_proc_per_job
+        self.cache_dir = os.path.abspath(cache_dir if cache_dir else os.path.join(out_dir, 'cache'))
+        os.makedirs(self.out_dir, exist_ok=True)
+
+        self.run_dict = self.discover_sp_output_dirs(self.search_dirs)
+        print(f"Found {len(self.run_dict)} SymPortal runs")
+        self.run_stats_df = self._cache_runs()
+        self.summary_df = self._run_analyses()
+        self._write_summaries()
+
+    @staticmethod
+    def discover_sp_output_dirs(search_dirs):
+        """:return: dict of run name to SymPortal output directory"""
+        run_dict = {}
+        for search_dir in search_dirs:
+            for dir_path, dir_names, _ in os.walk(search_dir):
+                if 'post_med_seqs' in dir_names and 'its2_type_profiles' in dir_names:
+                    # The run is named by the path of the directory holding the output (often sp_output)
+                    rel_path = os.path.relpath(dir_path, search_dir)
+                    if os.path.basename(dir_path) == 'sp_output':
+                        rel_path = os.path.dirname(rel_path)
+                    name = rel_path.replace(os.sep, '_') if rel_path not in ['', '.'] else \
+                        os.path.basename(os.path.abspath(search_dir))
+                    while name in run_dict:
+                        name += '_'
+                    run_dict[name] = os.path.abspath(dir_path)
+                    dir_names.clear()
+        return run_dict
+
+    def _cache_runs(self):
+        input_names = sorted(set(chain.from_iterable(globals()[_].inputs for _ in self.analyses)))
+        run_stats = {}
+        with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+            futures = {
+                executor.submit(_batch_cache_run, sp_output_dir, self.cache_dir, self.dist_type, input_names): run
+                for run, sp_output_dir in self.run_dict.items()
+            }
+            for future in as_completed(futures):
+                run_stats[futures[future]] = future.result()
+        run_stats_df = pd.DataFrame.from_dict(run_stats, orient='index')
+        run_stats_df.index.name = 'run'
+        return run_stats_df.reindex(list(self.run_dict.keys()))
+
+    def _run_analyses(self):
+        rows = []
+        with ProcessPoolExecutor(max_workers=max(1, self.n_workers // self.n_proc_per_job)) as executor:
+            futures = {}
+            for run, sp_output_dir in self.run_dict.items():
+                for analysis in self.analyses:
+                    kwargs = dict(self.analysis_kwargs.get(analysis, {}))
+                    if 'n_proc' in inspect.signature(globals()[analysis].__init__).parameters:
+                        kwargs.setdefault('n_proc', self.n_proc_per_job)
+                    out_dir = os.path.join(self.out_dir, run, analysis)
+                    future = executor.submit(
+                        _batch_run_analysis, analysis, sp_output_dir, out_dir, self.cache_dir, self.dist_type, kwargs)
+                    futures[future] = run
+            for future in as_completed(futures):
+                row = future.result()
+                row['run'] = futures[future]
+                print(f"{row['run']} {row['analysis']}: {row['status']} ({row['seconds']} s)")
+                rows.append(row)
+        summary_df = pd.DataFrame(rows, columns=['run', 'analysis', 'status', 'seconds', 'outputs'])
+        return summary_df.sort_values(['run', 'analysis']).reset_index(drop=True)
+
+    def _write_summaries(self):
+        self.run_stats_df.to_csv(os.path.join(self.out_dir, 'batch_runs.csv'))
+        summary_df = self.summary_df.copy()
+        summary_df['outputs'] = summary_df['outputs'].apply(lambda _: ';'.join(_))
+        summary_df.to_csv(os.path.join(self.out_dir, 'batch_summary.csv'), index=False)
+        # Concatenate the .csv outputs common to runs
+        output_to_df_list_dict = defaultdict(list)
+        for _, row in self.summary_df.iterrows():
+            for output in row['outputs']:
+                if output.endswith('.csv'):
+                    df = pd.read_csv(os.path.join(self.out_dir, row['run'], row['analysis'], output))
+                    df.insert(0, 'run', row['run'])
+                    output_to_df_list_dict[output].append(df)
+        for output, df_list in output_to_df_list_dict.items():
+            if len(df_list) > 1:
+                pd.concat(df_list).to_csv(os.path.join(self.out_dir, f'batch_{output}'), index=False)
+
+
+if __name__ == "__main__":
+    # For plotting the ordinations
+    # BuitragoOrdinations(dist_type='bc')
+
+    # For plotting the dendrogram figure with associated meta info and sequences
+    # BuitragoHier(dist_type='bc')
+    # For plotting the dendogram split by species and with the option of clustering the profiles
+    # BuitragoHier_split_species(dist_type='bc')
+    # To add the profiles of a new submission to the previously saved profile representatives (stable colours)
+    # BuitragoHier_split_species(dist_type='bc', incremental_profiles=True)
+
+    # For plotting the north to south genera, sequence, and profile bars for each species
+    # BuitragoBars()
+    # For compact .svg/.pdf output (merged and rasterized bar layers) use
+    # BuitragoBars(compact_vectors=True, raster_dpi=600)
+
+    # A modification of the original BuitragoBars to do custom colours of the clustered profiles plot
+    BuitragoBars_clustered_profiles()
+
+    CalculateAverageProfDistances()
+
+    # Mantel and partial Mantel tests of the Symbiodinium distances against host genetic,
+    # geographic and environmental distances
+    # BuitragoMantel(dist_type='bc', n_perm=999)
+
+    # Association of every sequence and profile with reef temperature controlling for species and genetic cluster
+    # BuitragoEnvScan(covariate='temp', n_perm=999)
+
+    # Composition queries from the pre-aggregated species x region x reef x genetic cluster cube
+    # e.g. the relative abundance of the Cladocopium profiles in S. pistillata at WAJ-R3
+    # Buitrago(dist_type='bc').get_cube('profile').composition(clade='C', species='spis', reef='WAJ-R3')
+
+    # The network of profiles sharing 3 or more DIVs (shared DIV counts and Jaccard similarities) as an edge list
+    # Buitrago(dist_type='bc').get_div_incidence().export_network('profile_shared_div_network.tsv', min_shared=3)
+
+    # Sequence co-occurrence (clr proportionality) networks per species with a pooled permutation FDR
+    # BuitragoCoOccurrence(dist_type='bc', feature_set='seq', measure='rho', stratify='species', n_perm=200)
+
+    # Indicator sequences, profiles and 16S ASVs of the reef temperature classes and of the host genetic clusters
+    # BuitragoIndVal(dist_type='bc', grouping='temp_class', n_perm=999)
+    # BuitragoIndVal(dist_type='bc', grouping='cluster', n_perm=999)
+
+    # Bootstrap support for the species split dendrograms and the profile clustering
+    # BuitragoBootstrap(dist_type='bc', n_boot=100)
+    # and written on the species split dendrograms
+    # BuitragoHier_split_species(dist_type='bc', bootstrap=BuitragoBootstrap(dist_type='bc', n_boot=100))
+
+    # The same with the replicates run by workers on other nodes (python buitrago_jobs.py worker /shared/buitrago_queue)
+    # BuitragoBootstrap(dist_type='bc', n_boot=1000, backend='queue:/shared/buitrago_queue')
+
+    # For plotting the dendrogram split by species using the 16S ASVs with the 16S and ITS2 bars
+    # Buitrago16S(dist_type='bc')
+
+    # Interactive (offline) html version of the species split dendrogram, sequence, profile and region stack
+    # BuitragoHTMLViewer(dist_type='bc')
+
+    # Heatmap of the between sample distances in dendrogram leaf order reduced to 1000 x 1000 pixels
+    # BuitragoDistHeatmap(dist_type='bc', dist='sample', resolution=1000, reduce='mean')
+
+    # Host genotype PCA (from the RADSeq genotype stores) next to the Symbiodinium PCoA of the same colonies
+    # BuitragoHostSymbiontOrdination(
+    #     dist_type='bc', host_pca={'pver': '../RADSeq/pver_genotypes', 'spis': '../RADSeq/spis_genotypes'})
+
+    # Any of the analyses can be given a prefetcher that reads and parses all of its inputs concurrently
+    # with BuitragoMantel.prefetch(dist_type='bc') as prefetcher:
+    #     BuitragoMantel(dist_type='bc', prefetcher=prefetcher)
+
+    # Run the analyses for every SymPortal output directory found below ./submissions
+    # (each analysis can also be pointed at a single submission with sp_output_dir)
+    # BuitragoBatch(search_dirs='submissions', out_dir='batch_output', n_workers=16)
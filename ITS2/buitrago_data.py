@@ -0,0 +1,656 @@
+#!/usr/bin/env python3
+"""
+The data structures that the analyses of buitrago.py share: sparse abundance tables, the pre-aggregated
+abundance cube, the integer coded sample meta info, the profile x DIV incidence matrix and the DIV cluster
+representatives of the profiles.
+"""
+
+import io
+import itertools
+import pickle
+import re
+import zipfile
+from collections import defaultdict
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+class SPAbundance:
+    """
+    A sparse sample x feature absolute abundance matrix along with its sample and feature names.
+    Features are either post-MED sequences (named by sequence name) or ITS2 type profiles (named by profile UID).
+    The feature_meta_df holds any per feature meta info (e.g. 'Clade' and 'ITS2 type profile' for profiles)
+    and is indexed by the feature names.
+    """
+    def __init__(self, matrix, sample_names, feature_names, feature_meta_df=None):
+        self.matrix = sparse.csr_matrix(matrix)
+        self.sample_names = list(sample_names)
+        self.feature_names = list(feature_names)
+        self.sample_name_to_row_dict = {name: i for i, name in enumerate(self.sample_names)}
+        self.feature_meta_df = feature_meta_df
+
+    @classmethod
+    def from_seq_count_table(cls, seq_count_table_path):
+        """Read a SymPortal post-MED absolute sequence count table (samples x sequences)"""
+        seq_df = pd.read_table(seq_count_table_path, dtype=str)
+        # Drop the seq_accession row at the bottom of the table
+        seq_df = seq_df[seq_df['sample_uid'].str.isdigit().fillna(False)]
+        first_seq_col = list(seq_df).index('collection_depth') + 1
+        counts = seq_df.iloc[:, first_seq_col:].astype(float).values
+        return cls(
+            matrix=counts, sample_names=seq_df['sample_name'].values,
+            feature_names=list(seq_df)[first_seq_col:]
+        )
+
+    @classmethod
+    def from_profile_count_table(cls, profile_count_table_path):
+        """
+        Read a SymPortal ITS2 type profile absolute count table (samples x profiles).
+        The 6 rows of profile meta info below the UID header row are kept in the feature_meta_df.
+        """
+        prof_df = pd.read_table(profile_count_table_path, header=None, dtype=str)
+        profile_uids = [int(float(_)) for _ in prof_df.iloc[0, 2:].values]
+        meta_df = prof_df.iloc[1:7, 2:].T
+        meta_df.columns = prof_df.iloc[1:7, 0].values
+        meta_df.index = profile_uids
+        sample_df = prof_df[prof_df[0].str.isdigit().fillna(False)]
+        counts = sample_df.iloc[:, 2:].astype(float).values
+        return cls(
+            matrix=counts, sample_names=sample_df[1].values,
+            feature_names=profile_uids, feature_meta_df=meta_df
+        )
+
+    @classmethod
+    def from_zipped_asv_table(cls, zip_path, chunksize=500):
+        """
+        Stream a 16S ASV table (ASVs x samples, as in the 16S directory) straight out of its zip archive
+        without extracting it. The table is read in chunks of ASV rows and each chunk is converted to sparse
+        so that only one dense chunk is held in memory at a time.
+        Sample names are converted to the ITS2 format (SMAQ_R1_1 -> SMAQ-R1-1). Any non count columns
+        (e.g. the taxonomy of the QC filtered table) are kept in the feature_meta_df.
+        """
+        with zipfile.ZipFile(zip_path) as zf:
+            member = [_ for _ in zf.namelist() if not _.startswith('__MACOSX') and not _.endswith('/')][0]
+            with zf.open(member) as f:
+                text = io.TextIOWrapper(f, encoding='utf-8')
+                # The raw table is space separated, the QC filtered table tab separated
+                header = text.readline().rstrip('\n')
+                sep = '\t' if '\t' in header else ' '
+                columns = header.split(sep)
+                if columns[0] != 'ASV':
+                    # Header without an entry for the ASV name column
+                    columns = ['ASV'] + columns
+                chunks = []
+                meta_chunks = []
+                feature_names = []
+                count_cols = None
+                for chunk in pd.read_csv(text, sep=sep, header=None, names=columns, chunksize=chunksize):
+                    if count_cols is None:
+                        count_cols = [_ for _ in columns[1:] if pd.api.types.is_numeric_dtype(chunk[_])]
+                        meta_cols = [_ for _ in columns[1:] if _ not in count_cols]
+                    feature_names.extend(chunk['ASV'].values)
+                    chunks.append(sparse.csr_matrix(chunk[count_cols].to_numpy(dtype=float).T))
+                    if meta_cols:
+                        meta_chunks.append(chunk.set_index('ASV')[meta_cols])
+        return cls(
+            matrix=sparse.hstack(chunks, format='csr'),
+            sample_names=[_.replace('_', '-') for _ in count_cols],
+            feature_names=feature_names,
+            feature_meta_df=pd.concat(meta_chunks) if meta_chunks else None
+        )
+
+    def subset(self, sample_names=None, feature_mask=None):
+        """Return a new SPAbundance for the given samples (in the given order) and/or features"""
+        matrix = self.matrix
+        feature_names = self.feature_names
+        feature_meta_df = self.feature_meta_df
+        if sample_names is None:
+            sample_names = self.sample_names
+        else:
+            matrix = matrix[[self.sample_name_to_row_dict[_] for _ in sample_names]]
+        if feature_mask is not None:
+            feature_mask = np.asarray(feature_mask)
+            matrix = matrix[:, np.flatnonzero(feature_mask)]
+            feature_names = [f for f, keep in zip(feature_names, feature_mask) if keep]
+            if feature_meta_df is not None:
+                feature_meta_df = feature_meta_df.loc[feature_names]
+        return SPAbundance(matrix, sample_names, feature_names, feature_meta_df)
+
+    def drop_empty_features(self):
+        return self.subset(feature_mask=self.matrix.getnnz(axis=0) > 0)
+
+    def relative(self):
+        """Row normalise to relative abundances. Samples with no counts are left as zeros."""
+        row_sums = np.asarray(self.matrix.sum(axis=1)).ravel()
+        scale = np.divide(1, row_sums, out=np.zeros_like(row_sums, dtype=float), where=row_sums != 0)
+        return SPAbundance(
+            sparse.diags(scale) @ self.matrix, self.sample_names, self.feature_names, self.feature_meta_df)
+
+    def sqrt(self):
+        return SPAbundance(self.matrix.sqrt(), self.sample_names, self.feature_names, self.feature_meta_df)
+
+    def feature_clades(self):
+        """The clade (genus letter) of each feature"""
+        if self.feature_meta_df is not None and 'Clade' in self.feature_meta_df:
+            return self.feature_meta_df.loc[self.feature_names, 'Clade'].values.astype(str)
+        # Sequences are either named e.g. C3 or are unnamed and in the format <uid>_<clade> e.g. 964_A
+        return np.array([f[-1] if f[0].isdigit() else f[0] for f in map(str, self.feature_names)])
+
+    def feature_label(self, feature):
+        """A human readable feature name i.e. the profile name for profiles"""
+        if self.feature_meta_df is not None and 'ITS2 type profile' in self.feature_meta_df:
+            return self.feature_meta_df.at[feature, 'ITS2 type profile']
+        return feature
+
+
+class SPAbundanceCube:
+    """
+    Pre-aggregated abundances for every combination (cell) of the sample meta dimensions
+    species, region, reef and genetic cluster.
+
+    For every cell x feature we store the summed absolute counts, the summed per sample relative abundances
+    and the number of samples in which the feature was found. For every cell we store the number of samples.
+    Queries select cells by any combination of the dimensions (unselected dimensions are rolled up) and
+    features by name or clade. Cell and feature selections are cached so that repeated
+    composition questions are answered from a handful of small array sums rather than by rescanning samples.
+
+    e.g. the relative abundance of the Cladocopium profiles in S. pistillata at WAJ-R3:
+        cube.composition(clade='C', species='spis', reef='WAJ-R3')
+    """
+    dims = ('species', 'region', 'reef', 'cluster')
+
+    def __init__(self, abundance, sample_meta_df):
+        """
+        :param abundance: SPAbundance
+        :param sample_meta_df: df indexed by sample name with a column for each of the cube dims
+        """
+        samples = [_ for _ in sample_meta_df.index if _ in abundance.sample_name_to_row_dict]
+        abundance = abundance.subset(sample_names=samples)
+        self.feature_names = abundance.feature_names
+        self.feature_name_to_col_dict = {f: i for i, f in enumerate(self.feature_names)}
+        self.feature_clades = abundance.feature_clades()
+
+        cell_codes, cell_tuples = pd.factorize(
+            pd.MultiIndex.from_frame(sample_meta_df.loc[samples, list(self.dims)].astype(str)))
+        self.cell_df = pd.DataFrame(list(cell_tuples), columns=list(self.dims))
+        n_cells = len(self.cell_df)
+        # cells x samples indicator used to aggregate everything in one sparse product each
+        indicator = sparse.csr_matrix(
+            (np.ones(len(samples)), (cell_codes, np.arange(len(samples)))), shape=(n_cells, len(samples)))
+        self.counts = (indicator @ abundance.matrix).toarray()
+        self.rel_sums = (indicator @ abundance.relative().matrix).toarray()
+        self.nonzero = (indicator @ (abundance.matrix > 0).astype(np.int64)).toarray()
+        self.sample_counts = np.bincount(cell_codes, minlength=n_cells)
+        self.cell_totals = self.counts.sum(axis=1)
+
+        # Per dimension, the value of each cell as a numpy array for fast masking
+        self.cell_values = {dim: self.cell_df[dim].values for dim in self.dims}
+        self._cell_mask_cache = {}
+        self._feature_mask_cache = {}
+        self._cell_feature_sum_cache = {}
+
+    def cell_mask(self, **selection):
+        """
+        Boolean mask over the cells for the given selection e.g. species='spis', reef=['WAJ-R1', 'WAJ-R3'].
+        Dimensions that are not given are rolled up.
+        """
+        key = tuple(sorted((k, tuple(v) if isinstance(v, (list, tuple, set)) else v) for k, v in selection.items()))
+        if key not in self._cell_mask_cache:
+            mask = np.ones(len(self.cell_df), dtype=bool)
+            for dim, value in selection.items():
+                if dim not in self.dims:
+                    raise ValueError(f"Unknown cube dimension {dim}. Dimensions are {self.dims}")
+                if isinstance(value, (list, tuple, set)):
+                    mask &= np.isin(self.cell_values[dim], list(value))
+                else:
+                    mask &= self.cell_values[dim] == value
+            self._cell_mask_cache[key] = mask
+        return self._cell_mask_cache[key]
+
+    def feature_mask(self, features=None, clade=None):
+        """Boolean mask over the features for a list of feature names and/or a clade (e.g. 'C')"""
+        key = (tuple(features) if features is not None else None, clade)
+        if key not in self._feature_mask_cache:
+            mask = np.ones(len(self.feature_names), dtype=bool)
+            if features is not None:
+                mask = np.zeros(len(self.feature_names), dtype=bool)
+                mask[[self.feature_name_to_col_dict[_] for _ in features]] = True
+            if clade is not None:
+                mask &= self.feature_clades == clade
+            self._feature_mask_cache[key] = mask
+        return self._feature_mask_cache[key]
+
+    def _cell_feature_sum(self, measure, features, clade):
+        """Per cell sum of a measure over the selected features. Cached per feature selection."""
+        key = (measure, tuple(features) if features is not None else None, clade)
+        if key not in self._cell_feature_sum_cache:
+            self._cell_feature_sum_cache[key] = getattr(self, measure)[
+                :, self.feature_mask(features=features, clade=clade)].sum(axis=1)
+        return self._cell_feature_sum_cache[key]
+
+    def n_samples(self, **selection):
+        return int(self.sample_counts[self.cell_mask(**selection)].sum())
+
+    def totals(self, measure='counts', **selection):
+        """
+        Per feature totals for the selection as a Series.
+        :param measure: 'counts' (absolute counts), 'rel_sums' (summed per sample relative abundances)
+        or 'nonzero' (number of samples the feature was found in)
+        """
+        return pd.Series(getattr(self, measure)[self.cell_mask(**selection)].sum(axis=0), index=self.feature_names)
+
+    def composition(self, features=None, clade=None, mean_of_samples=False, **selection):
+        """
+        The relative abundance of the selected features within the selected cells.
+        :param mean_of_samples: If False, the proportion of all counts in the selected cells
+        that belong to the selected features (i.e. pooled). If True, the mean of the per sample relative abundances.
+        """
+        cell_mask = self.cell_mask(**selection)
+        if mean_of_samples:
+            n = self.sample_counts[cell_mask].sum()
+            return self._cell_feature_sum('rel_sums', features, clade)[cell_mask].sum() / n if n else np.nan
+        tot = self.cell_totals[cell_mask].sum()
+        return self._cell_feature_sum('counts', features, clade)[cell_mask].sum() / tot if tot else np.nan
+
+    def prevalence(self, features=None, clade=None, **selection):
+        """Per feature proportion of the selected samples in which the feature was found"""
+        n = self.n_samples(**selection)
+        nonzero = self.nonzero[self.cell_mask(**selection)][:, self.feature_mask(features=features, clade=clade)]
+        return pd.Series(
+            nonzero.sum(axis=0) / n if n else np.nan,
+            index=[f for f, keep in zip(self.feature_names, self.feature_mask(features, clade)) if keep]
+        )
+
+    def rollup(self, dims, measure='counts'):
+        """A df of the per feature totals for every combination of the given dims e.g. ['species', 'region']"""
+        return pd.DataFrame(getattr(self, measure), columns=self.feature_names).groupby(
+            [self.cell_df[_] for _ in dims]).sum()
+
+
+class SampleMetaIndex:
+    """
+    Integer coded sample meta info (species, region, reef and genetic cluster) in a fixed sample row order.
+
+    Every dimension is stored as an array of category codes (one per sample row) so that selecting samples,
+    colouring samples and finding the boundaries between groups (e.g. reefs) in any sample ordering are array
+    operations rather than string work per sample. Membership masks are cached per selection.
+    Sample names that are not in the index get the row (and code) -1 e.g. negative samples.
+
+    e.g. the MAQ P. verrucosa samples:
+        meta_index.names(species='pver', region='MAQ')
+    e.g. the positions of the reef boundaries of samples in a given plotting order:
+        meta_index.boundaries('reef', meta_index.take(sample_names))
+    """
+    dims = ('species', 'region', 'reef', 'cluster')
+
+    def __init__(self, sample_meta_df, categories=None):
+        """
+        :param sample_meta_df: df indexed by sample name with a column for each of the dims
+        :param categories: optional dict of dim to the ordered categories of that dim (e.g. the regions north to south).
+        Otherwise the categories are in order of first appearance.
+        """
+        categories = categories if categories else {}
+        self.sample_names = list(sample_meta_df.index)
+        self.sample_name_to_row_dict = {s: i for i, s in enumerate(self.sample_names)}
+        self.categories = {}
+        self.codes = {}
+        for dim in self.dims:
+            values = sample_meta_df[dim].astype(str).values
+            if dim in categories:
+                self.categories[dim] = list(categories[dim])
+                self.codes[dim] = pd.Categorical(values, categories=self.categories[dim]).codes.astype(np.int32)
+            else:
+                codes, uniques = pd.factorize(values)
+                self.categories[dim] = list(uniques)
+                self.codes[dim] = codes.astype(np.int32)
+        self._mask_cache = {}
+
+    def __len__(self):
+        return len(self.sample_names)
+
+    def code(self, dim, value):
+        return self.categories[dim].index(value)
+
+    def mask(self, **selection):
+        """
+        Boolean mask over the sample rows for the given selection e.g. species='spis', reef=['WAJ-R1', 'WAJ-R3'].
+        Dimensions that are not given are not filtered on.
+        """
+        key = tuple(sorted((k, tuple(v) if isinstance(v, (list, tuple, set)) else v) for k, v in selection.items()))
+        if key not in self._mask_cache:
+            mask = np.ones(len(self.sample_names), dtype=bool)
+            for dim, value in selection.items():
+                if dim not in self.dims:
+                    raise ValueError(f"Unknown meta dimension {dim}. Dimensions are {self.dims}")
+                values = value if isinstance(value, (list, tuple, set)) else [value]
+                # Values that are not categories of the dim match no samples
+                mask &= np.isin(self.codes[dim], [self.code(dim, _) for _ in values if _ in self.categories[dim]])
+            self._mask_cache[key] = mask
+        return self._mask_cache[key]
+
+    def rows(self, **selection):
+        """The sample rows of a selection in index order"""
+        return np.flatnonzero(self.mask(**selection))
+
+    def names(self, **selection):
+        """The sample names of a selection in index order"""
+        return [self.sample_names[_] for _ in self.rows(**selection)]
+
+    def take(self, sample_names):
+        """The rows of the given sample names (in the given order). -1 for names that are not in the index."""
+        return np.array([self.sample_name_to_row_dict.get(_, -1) for _ in sample_names], dtype=np.int64)
+
+    def codes_of(self, dim, rows):
+        """The codes of a dim for the given rows (-1 where the row is -1)"""
+        rows = np.asarray(rows)
+        return np.where(rows >= 0, self.codes[dim][rows], -1)
+
+    def values(self, dim, rows):
+        """The category values of a dim for the given rows (None where the row is -1)"""
+        lookup = np.array(self.categories[dim] + [None], dtype=object)
+        return lookup[self.codes_of(dim, rows)]
+
+    def colors(self, dim, color_dict, rows, missing_color='black'):
+        """The colour of every given row looked up by the category of a dim. missing_color where the row is -1."""
+        lookup = np.array([color_dict[_] for _ in self.categories[dim]] + [missing_color], dtype=object)
+        return lookup[self.codes_of(dim, rows)]
+
+    def runs(self, dim, rows):
+        """
+        Run length encoding of the codes of a dim in the given row order.
+        :return: (start positions, run lengths, code of each run)
+        """
+        codes = self.codes_of(dim, rows)
+        if not len(codes):
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), codes
+        starts = np.concatenate([[0], self.boundaries(dim, rows)])
+        lengths = np.diff(np.append(starts, len(codes)))
+        return starts, lengths, codes[starts]
+
+    def boundaries(self, dim, rows):
+        """The positions (in the given row order) at which the category of a dim changes from that of the previous row"""
+        codes = self.codes_of(dim, rows)
+        return np.flatnonzero(codes[1:] != codes[:-1]) + 1
+
+
+def _profile_name_divs(profile_name):
+    """The set of DIVs of an ITS2 type profile name e.g. C3-C3c-C3gulf/C3ye -> {C3, C3c, C3gulf, C3ye}"""
+    return set(filter(None, re.split(r"[/\-]+", profile_name)))
+
+
+class ProfileDIVIncidence:
+    """
+    A sparse binary profile x DIV incidence matrix.
+
+    The profile names are parsed into their DIVs once. All DIV overlap questions are then products of the
+    incidence matrix e.g. the number of DIVs shared by every pair of profiles is matrix @ matrix.T.
+
+    e.g. the profiles sharing 3 or more DIVs as a network:
+        Buitrago(dist_type='bc').get_div_incidence().network_edges(min_shared=3)
+    """
+    def __init__(self, profile_to_div_set_dict, profile_to_name_dict=None):
+        """
+        :param profile_to_div_set_dict: profile uid to the set (or list) of its DIVs
+        :param profile_to_name_dict: optional profile uid to profile name (used for the network export)
+        """
+        self.profiles = list(profile_to_div_set_dict.keys())
+        self.profile_to_row_dict = {p: i for i, p in enumerate(self.profiles)}
+        self.divs = sorted(set(chain.from_iterable(profile_to_div_set_dict.values())))
+        self.div_to_col_dict = {d: i for i, d in enumerate(self.divs)}
+        rows, cols = [], []
+        for row, divs in enumerate(profile_to_div_set_dict.values()):
+            for div in divs:
+                rows.append(row)
+                cols.append(self.div_to_col_dict[div])
+        self.matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(self.profiles), len(self.divs)))
+        self.matrix.sum_duplicates()
+        self.matrix.data[:] = 1
+        self.n_divs = np.asarray(self.matrix.sum(axis=1)).ravel()
+        self.profile_to_name_dict = profile_to_name_dict if profile_to_name_dict else {}
+
+    @classmethod
+    def from_profile_names(cls, profile_to_name_dict):
+        """From profile uid to ITS2 type profile name e.g. the meta rows of the profile count table"""
+        return cls(
+            {p: _profile_name_divs(name) for p, name in profile_to_name_dict.items()},
+            profile_to_name_dict=profile_to_name_dict
+        )
+
+    @classmethod
+    def from_abundance(cls, profile_abundance):
+        """From the profiles of an SPAbundance of the profile count table"""
+        return cls.from_profile_names(
+            {p: profile_abundance.feature_label(p) for p in profile_abundance.feature_names})
+
+    def rows(self, profiles):
+        return np.array([self.profile_to_row_dict[_] for _ in profiles], dtype=np.int64)
+
+    def subset(self, profiles):
+        """A new ProfileDIVIncidence of the given profiles (in the given order)"""
+        return ProfileDIVIncidence(self.div_sets(profiles), self.profile_to_name_dict)
+
+    def div_sets(self, profiles=None):
+        """Dict of profile uid to its set of DIVs for the given profiles (default all) in the given order"""
+        profiles = self.profiles if profiles is None else profiles
+        matrix = self.matrix
+        return {
+            p: {self.divs[_] for _ in matrix.indices[matrix.indptr[r]:matrix.indptr[r + 1]]}
+            for p, r in zip(profiles, self.rows(profiles))
+        }
+
+    def shared_div_counts(self):
+        """Sparse profiles x profiles matrix of the number of DIVs each pair of profiles has in common"""
+        return (self.matrix @ self.matrix.T).tocsr()
+
+    def shared_div_counts_of_pairs(self, profiles_a, profiles_b):
+        """The number of DIVs in common of each (profiles_a[i], profiles_b[i]) pair"""
+        a = self.matrix[self.rows(profiles_a)]
+        b = self.matrix[self.rows(profiles_b)]
+        return np.asarray(a.multiply(b).sum(axis=1)).ravel()
+
+    def shared_divs(self, profile_a, profile_b):
+        """The sorted DIVs that two profiles have in common"""
+        return sorted(self.div_sets([profile_a])[profile_a].intersection(self.div_sets([profile_b])[profile_b]))
+
+    def jaccard(self):
+        """Sparse profiles x profiles Jaccard similarity of the DIV sets (only the pairs sharing a DIV are stored)"""
+        shared = self.shared_div_counts().tocoo()
+        union = self.n_divs[shared.row] + self.n_divs[shared.col] - shared.data
+        return sparse.csr_matrix((shared.data / union, (shared.row, shared.col)), shape=shared.shape)
+
+    def network_edges(self, min_shared=3):
+        """
+        The pairs of profiles sharing at least min_shared DIVs.
+        :return: df of profile_1, profile_2, name_1, name_2, shared_divs, jaccard (one row per pair)
+        """
+        shared = sparse.triu(self.shared_div_counts(), k=1).tocoo()
+        keep = shared.data >= min_shared
+        rows, cols, counts = shared.row[keep], shared.col[keep], shared.data[keep]
+        profile_1 = [self.profiles[_] for _ in rows]
+        profile_2 = [self.profiles[_] for _ in cols]
+        return pd.DataFrame({
+            'profile_1': profile_1, 'profile_2': profile_2,
+            'name_1': [self.profile_to_name_dict.get(_, '') for _ in profile_1],
+            'name_2': [self.profile_to_name_dict.get(_, '') for _ in profile_2],
+            'shared_divs': counts, 'jaccard': counts / (self.n_divs[rows] + self.n_divs[cols] - counts)
+        })
+
+    def export_network(self, path, min_shared=3):
+        """Write the shared DIV network (network_edges) as a tab separated edge list e.g. for Cytoscape"""
+        edge_df = self.network_edges(min_shared=min_shared)
+        edge_df.to_csv(path, sep='\t', index=False)
+        return edge_df
+
+
+def cluster_div_sets(profile_to_div_set_dict, verbose=True):
+    """
+    Cluster ITS2 type profiles that have 3 or more DIVs in common.
+    :param profile_to_div_set_dict: profile uid to the set of DIVs of the profile
+    :return: dict of representative DIVs (comma separated string) to the list of profile uids it represents
+    """
+    rep_divs_to_profiles = defaultdict(list)
+    incidence = ProfileDIVIncidence(profile_to_div_set_dict)
+    shared = incidence.shared_div_counts()
+    shared.setdiag(0)
+    shared.eliminate_zeros()
+    for row, (profile_outer, div_outer) in enumerate(profile_to_div_set_dict.items()):
+        set_of_representatives = set()
+        start, end = shared.indptr[row], shared.indptr[row + 1]
+        # Only the profiles that have 3 or more DIVs in common with this profile (from the shared DIV counts)
+        for col in shared.indices[start:end][shared.data[start:end] >= 3]:
+            # THen these can be merged
+            divs_in_common = div_outer.intersection(profile_to_div_set_dict[incidence.profiles[col]])
+            divs_in_common_as_string = ",".join(sorted(divs_in_common))
+            set_of_representatives.add(divs_in_common_as_string)
+        if set_of_representatives:
+            if len(set_of_representatives) == 1:
+                rep_divs_to_profiles[list(set_of_representatives)[0]].append(profile_outer)
+            else:
+                # Make a bunch of 3 tuples of the sets and see which of these is found
+                # in the largest number of the list_of_representatives
+                all_divs = set()
+                for div_set in set_of_representatives:
+                    all_divs.update(set(div_set.split(',')))
+                three_tup_abund_dict = defaultdict(int)
+                for three_tup in itertools.combinations(all_divs, 3):
+                    three_set = set(three_tup)
+                    for div_str in set_of_representatives:
+                        div_set = set(div_str.split(","))
+                        if three_set.issubset(div_set):
+                            three_tup_abund_dict[three_tup] += 1
+                # Now take the most abundant
+                sorted_tups = sorted(three_tup_abund_dict.items(), key=lambda x: x[1], reverse=True)
+                biggest = sorted_tups[0][1]
+                next = sorted_tups[1][1] if len(sorted_tups) > 1 else 0
+                if biggest > next:
+                    # all good
+                    div_rep = ",".join(sorted(sorted_tups[0][0]))
+                    rep_divs_to_profiles[div_rep].append(profile_outer)
+                else:
+                    if {"C21", "C21n", "C21r"}.issubset(div_outer):
+                        rep_divs_to_profiles['C21,C21n,C21r'].append(profile_outer)
+                    else:
+                        if verbose:
+                            print("we have a problem")
+    return rep_divs_to_profiles
+
+
+class ProfileRepresentatives:
+    """
+    Persistent DIV cluster representatives of ITS2 type profiles (see cluster_div_sets) that new profiles can be
+    assigned to without re-clustering all of the profiles.
+
+    The representatives (sets of 3 or more DIVs) and the profiles that matched no other profile are held in inverted
+    indices of DIV to representative and DIV to profile so that assigning a new profile only looks at the
+    representatives and profiles sharing DIVs with it. A new profile is assigned to the representative it shares the
+    most (and at least 3) DIVs with. Otherwise, if it shares 3 or more DIVs with a profile that has not been
+    clustered, a new representative of their common DIVs is created. Otherwise it stays unclustered.
+    The label of a representative (used for its colour) is its first profile so that labels do not change
+    as profiles are added.
+    """
+    def __init__(self):
+        self.rep_divs_to_profiles = {}
+        self.profile_to_div_set_dict = {}
+        self.unclustered_profiles = set()
+        self._div_to_reps = defaultdict(set)
+        self._div_to_unclustered_profiles = defaultdict(set)
+
+    @classmethod
+    def from_div_sets(cls, profile_to_div_set_dict, verbose=True):
+        """Full clustering of the profiles (profile uid to set of DIVs) with cluster_div_sets"""
+        reps = cls()
+        reps.profile_to_div_set_dict = dict(profile_to_div_set_dict)
+        for rep_divs, profiles in cluster_div_sets(profile_to_div_set_dict, verbose=verbose).items():
+            reps._add_rep(rep_divs, profiles)
+        clustered = set(chain.from_iterable(reps.rep_divs_to_profiles.values()))
+        for profile in profile_to_div_set_dict:
+            if profile not in clustered:
+                reps._add_unclustered(profile)
+        return reps
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        reps = cls()
+        reps.profile_to_div_set_dict = state['profile_to_div_set_dict']
+        for rep_divs, profiles in state['rep_divs_to_profiles'].items():
+            reps._add_rep(rep_divs, profiles)
+        for profile in state['unclustered_profiles']:
+            reps._add_unclustered(profile)
+        return reps
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump({
+                'rep_divs_to_profiles': self.rep_divs_to_profiles,
+                'profile_to_div_set_dict': self.profile_to_div_set_dict,
+                'unclustered_profiles': sorted(self.unclustered_profiles)
+            }, f)
+
+    def _add_rep(self, rep_divs, profiles):
+        self.rep_divs_to_profiles[rep_divs] = list(profiles)
+        for div in rep_divs.split(','):
+            self._div_to_reps[div].add(rep_divs)
+
+    def _add_unclustered(self, profile):
+        self.unclustered_profiles.add(profile)
+        for div in self.profile_to_div_set_dict[profile]:
+            self._div_to_unclustered_profiles[div].add(profile)
+
+    def _remove_unclustered(self, profile):
+        self.unclustered_profiles.discard(profile)
+        for div in self.profile_to_div_set_dict[profile]:
+            self._div_to_unclustered_profiles[div].discard(profile)
+
+    def assign(self, profile_to_div_set_dict):
+        """
+        Assign new profiles (profile uid to set of DIVs). Profiles that are already known are ignored.
+        :return: dict of each newly assigned profile to its representative DIVs (None if unclustered)
+        """
+        assigned = {}
+        for profile, divs in profile_to_div_set_dict.items():
+            if profile in self.profile_to_div_set_dict:
+                continue
+            divs = set(divs)
+            self.profile_to_div_set_dict[profile] = divs
+            rep_overlap = defaultdict(int)
+            for div in divs:
+                for rep_divs in self._div_to_reps.get(div, ()):
+                    rep_overlap[rep_divs] += 1
+            # Most DIVs in common, then the representative whose DIVs are all in the profile, then the largest
+            candidates = [
+                (n, n == len(rep_divs.split(',')), len(self.rep_divs_to_profiles[rep_divs]), rep_divs)
+                for rep_divs, n in rep_overlap.items() if n >= 3
+            ]
+            if candidates:
+                rep_divs = max(candidates, key=lambda x: x[:3])[3]
+                self.rep_divs_to_profiles[rep_divs].append(profile)
+                assigned[profile] = rep_divs
+                continue
+            profile_overlap = defaultdict(int)
+            for div in divs:
+                for other in self._div_to_unclustered_profiles.get(div, ()):
+                    profile_overlap[other] += 1
+            partners = [other for other, n in profile_overlap.items() if n >= 3]
+            if partners:
+                partner = max(partners, key=lambda _: (profile_overlap[_], str(_)))
+                rep_divs = ",".join(sorted(divs.intersection(self.profile_to_div_set_dict[partner])))
+                self._remove_unclustered(partner)
+                if rep_divs in self.rep_divs_to_profiles:
+                    self.rep_divs_to_profiles[rep_divs].extend([partner, profile])
+                else:
+                    self._add_rep(rep_divs, [partner, profile])
+                assigned[profile] = rep_divs
+            else:
+                self._add_unclustered(profile)
+                assigned[profile] = None
+        return assigned
+
+    def prof_to_rep_dict(self):
+        """Clustered profile uid to the label (first profile uid) of its representative"""
+        return {profile: profiles[0] for profiles in self.rep_divs_to_profiles.values() for profile in profiles}
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Execution backends for the permutation and bootstrap workloads of buitrago.py (and RADSeq/radseq_genotypes.py).
+
+Work is split into deterministic chunks: every chunk is a call of a module level function with its own arguments
+(typically a spawned numpy SeedSequence and the number of permutations/replicates of the chunk, see seeded_chunks)
+so the results do not depend on where or in which order the chunks are run. Large shared inputs are passed once
+per worker through an initializer (as for a ProcessPoolExecutor) rather than with every chunk.
+
+LocalBackend runs the chunks in a local process pool. SharedDirBackend writes them to a work queue in a directory
+on a filesystem shared between nodes and any number of workers, started on any of the nodes with
+
+    python buitrago_jobs.py worker /shared/queue_dir
+
+claim, run and write back the chunks. Chunks of a worker that is lost (its claim is no longer refreshed) are put
+back in the queue and rerun. No services other than the shared filesystem are needed.
+
+e.g.
+    backend = get_backend('queue:/shared/buitrago_queue')
+    BuitragoMantel(dist_type='bc', n_perm=9999, backend=backend)
+"""
+
+import argparse
+import importlib.util
+import os
+import pickle
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+import numpy as np
+
+
+def seeded_chunks(seed, n_total, n_chunks):
+    """
+    Split n_total permutations/replicates into at most n_chunks chunks, each with its own spawned seed.
+    :param seed: an int or a list of ints (e.g. [seed, offset] for independent streams of the same analysis)
+    :return: (list of SeedSequence, list of chunk sizes)
+    """
+    chunk_sizes = [len(_) for _ in np.array_split(np.arange(n_total), max(1, n_chunks)) if len(_)]
+    return np.random.SeedSequence(seed).spawn(len(chunk_sizes)), chunk_sizes
+
+
+class LocalBackend:
+    """
+    Run chunks in a local process pool. Chunks lost to a crashed worker process (BrokenProcessPool) are rerun in a
+    new pool up to max_retries times.
+    """
+    def __init__(self, n_proc=None, max_retries=2):
+        self.n_proc = n_proc if n_proc else os.cpu_count()
+        self.max_retries = max_retries
+
+    @property
+    def n_chunks(self):
+        """The default number of chunks to split a workload into"""
+        return self.n_proc * 4
+
+    def make_temp_dir(self, prefix):
+        """A temporary directory the workers can read (see SharedDirBackend.make_temp_dir)"""
+        return tempfile.mkdtemp(prefix=prefix)
+
+    def map(self, func, chunk_args, initializer=None, initargs=()):
+        """
+        Run func(*args) for every args of chunk_args.
+        :return: the results in the order of chunk_args
+        """
+        chunk_args = list(chunk_args)
+        results = {}
+        for attempt in range(self.max_retries + 1):
+            todo = [i for i in range(len(chunk_args)) if i not in results]
+            if not todo:
+                break
+            try:
+                with ProcessPoolExecutor(
+                        max_workers=self.n_proc, initializer=initializer, initargs=initargs
+                ) as executor:
+                    futures = {i: executor.submit(func, *chunk_args[i]) for i in todo}
+                    for i, future in futures.items():
+                        results[i] = future.result()
+            except BrokenProcessPool:
+                if attempt == self.max_retries:
+                    raise
+                print(f"A worker process was lost, rerunning {len(chunk_args) - len(results)} chunks")
+        return [results[i] for i in range(len(chunk_args))]
+
+
+def _function_ref(func):
+    """
+    A picklable reference to a module level function that a worker on another node can import:
+    the path of the module file and the name of the function.
+    """
+    module = sys.modules[func.__module__]
+    return os.path.abspath(module.__file__), func.__qualname__
+
+
+def _import_function(module_path, name):
+    module_name = os.path.splitext(os.path.basename(module_path))[0]
+    if module_name in sys.modules and getattr(sys.modules[module_name], '__file__', None) == module_path:
+        module = sys.modules[module_name]
+    else:
+        module_dir = os.path.dirname(module_path)
+        if module_dir not in sys.path:
+            sys.path.insert(0, module_dir)
+        spec = importlib.util.spec_from_file_location(module_name, module_path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    return getattr(module, name)
+
+
+def _write_atomic(path, obj):
+    """Pickle obj to path through a temporary file in the same directory so readers never see a partial file"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+class SharedDirBackend:
+    """
+    Run chunks through a work queue in a directory on a shared filesystem.
+
+    Each map call is a job directory in queue_dir holding job.p (the chunk function, initializer and initargs)
+    and one file per chunk that moves from todo/ to claimed/ (by the worker running it, with an atomic rename)
+    to done/ (the result) or failed/ (the traceback). Running workers touch their claim every heartbeat seconds;
+    a claim that has not been touched for lease seconds is a lost worker and its chunk is put back in todo/,
+    up to max_retries times per chunk.
+
+    :param local_workers: the number of worker processes to run on this node while waiting (0 to rely entirely
+    on workers started elsewhere with: python buitrago_jobs.py worker queue_dir)
+    :param n_chunks: the default number of chunks to split a workload into
+    """
+    def __init__(
+            self, queue_dir, local_workers=None, n_chunks=64, lease=300, heartbeat=30, poll_interval=1.0,
+            max_retries=3
+    ):
+        self.queue_dir = os.path.abspath(queue_dir)
+        os.makedirs(self.queue_dir, exist_ok=True)
+        self.local_workers = os.cpu_count() if local_workers is None else local_workers
+        self.n_chunks = n_chunks
+        self.lease = lease
+        self.heartbeat = heartbeat
+        self.poll_interval = poll_interval
+        self.max_retries = max_retries
+
+    def make_temp_dir(self, prefix):
+        """A temporary directory within the queue directory so that workers on other nodes can read it"""
+        scratch_dir = os.path.join(self.queue_dir, 'scratch')
+        os.makedirs(scratch_dir, exist_ok=True)
+        return tempfile.mkdtemp(prefix=prefix, dir=scratch_dir)
+
+    def map(self, func, chunk_args, initializer=None, initargs=()):
+        """
+        Queue func(*args) for every args of chunk_args and wait for the results.
+        :return: the results in the order of chunk_args
+        """
+        chunk_args = list(chunk_args)
+        job_dir = self._queue_job(func, chunk_args, initializer, initargs)
+
+        workers = [
+            multiprocessing.Process(target=run_worker, args=(self.queue_dir,), kwargs={'job_dir': job_dir})
+            for _ in range(min(self.local_workers, len(chunk_args)))
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            results = self._collect(job_dir, len(chunk_args))
+        finally:
+            # Tells any workers still on this job to move on
+            open(os.path.join(job_dir, 'finished'), 'w').close()
+            for worker in workers:
+                worker.join()
+            shutil.rmtree(job_dir, ignore_errors=True)
+        return [results[i] for i in range(len(chunk_args))]
+
+    def _queue_job(self, func, chunk_args, initializer=None, initargs=()):
+        """Write a job directory with one queued chunk per args of chunk_args. :return: the job directory"""
+        job_dir = os.path.join(self.queue_dir, f"job_{time.strftime('%Y%m%dT%H%M%S')}_{uuid.uuid4().hex[:8]}")
+        for sub_dir in ['todo', 'claimed', 'done', 'failed']:
+            os.makedirs(os.path.join(job_dir, sub_dir))
+        _write_atomic(os.path.join(job_dir, 'job.p'), {
+            'func': _function_ref(func),
+            'initializer': _function_ref(initializer) if initializer else None,
+            'initargs': initargs, 'heartbeat': self.heartbeat
+        })
+        for i, args in enumerate(chunk_args):
+            _write_atomic(os.path.join(job_dir, 'todo', f'{i}.p'), args)
+        # Marks the job as ready to be worked on
+        open(os.path.join(job_dir, 'ready'), 'w').close()
+        return job_dir
+
+    def _collect(self, job_dir, n_chunks):
+        results = {}
+        retries = {}
+        while len(results) < n_chunks:
+            for file_name in os.listdir(os.path.join(job_dir, 'failed')):
+                with open(os.path.join(job_dir, 'failed', file_name)) as f:
+                    raise RuntimeError(f"Chunk {file_name.split('.')[0]} of {job_dir} failed:\n{f.read()}")
+            for file_name in os.listdir(os.path.join(job_dir, 'done')):
+                i = int(file_name.split('.')[0])
+                if i not in results and file_name.endswith('.p'):
+                    with open(os.path.join(job_dir, 'done', file_name), 'rb') as f:
+                        results[i] = pickle.load(f)
+            self._requeue_lost(job_dir, retries)
+            if len(results) < n_chunks:
+                time.sleep(self.poll_interval)
+        return results
+
+    def _requeue_lost(self, job_dir, retries):
+        """Put the chunks whose claims have not been refreshed within the lease back in todo/"""
+        claimed_dir = os.path.join(job_dir, 'claimed')
+        now = time.time()
+        for file_name in os.listdir(claimed_dir):
+            claim_path = os.path.join(claimed_dir, file_name)
+            try:
+                if now - os.path.getmtime(claim_path) < self.lease:
+                    continue
+            except FileNotFoundError:
+                continue
+            i = int(file_name.split('.')[0])
+            if os.path.exists(os.path.join(job_dir, 'done', f'{i}.p')):
+                continue
+            retries[i] = retries.get(i, 0) + 1
+            if retries[i] > self.max_retries:
+                raise RuntimeError(f"Chunk {i} of {job_dir} was lost {retries[i]} times")
+            print(f"Chunk {i} was lost ({file_name}), requeueing it")
+            try:
+                os.replace(claim_path, os.path.join(job_dir, 'todo', f'{i}.p'))
+            except FileNotFoundError:
+                pass
+
+
+def _claim_chunk(job_dir):
+    """Claim a queued chunk of a job with an atomic rename. :return: (chunk index, claim path) or None"""
+    todo_dir = os.path.join(job_dir, 'todo')
+    try:
+        file_names = sorted(os.listdir(todo_dir), key=lambda _: int(_.split('.')[0]) if _.endswith('.p') else -1)
+    except FileNotFoundError:
+        return None
+    worker_id = f"{socket.gethostname()}.{os.getpid()}"
+    for file_name in file_names:
+        if not file_name.endswith('.p'):
+            continue
+        i = int(file_name.split('.')[0])
+        todo_path = os.path.join(todo_dir, file_name)
+        claim_path = os.path.join(job_dir, 'claimed', f'{i}.{worker_id}')
+        try:
+            # Touch before the rename (which keeps the mtime) so that a chunk that has been queued for longer
+            # than the lease is not taken for a lost claim and requeued as soon as it is claimed
+            os.utime(todo_path)
+            os.rename(todo_path, claim_path)
+        except (FileNotFoundError, OSError):
+            # Claimed by another worker first
+            continue
+        return i, claim_path
+    return None
+
+
+def _heartbeat(claim_path, interval, stop_event):
+    while not stop_event.wait(interval):
+        try:
+            os.utime(claim_path)
+        except FileNotFoundError:
+            return
+
+
+def run_worker(queue_dir, job_dir=None, idle_exit=None, poll_interval=1.0):
+    """
+    Claim and run chunks from the jobs of a queue directory.
+    :param job_dir: only work on this job and return once it is finished
+    :param idle_exit: return after this many seconds without any work (default: run until killed)
+    """
+    initialised_job = None
+    idle_since = time.time()
+    while True:
+        if job_dir is not None:
+            if os.path.exists(os.path.join(job_dir, 'finished')) or not os.path.exists(job_dir):
+                return
+            job_dirs = [job_dir]
+        else:
+            job_dirs = sorted(
+                os.path.join(queue_dir, _) for _ in os.listdir(queue_dir)
+                if _.startswith('job_') and os.path.exists(os.path.join(queue_dir, _, 'ready'))
+                and not os.path.exists(os.path.join(queue_dir, _, 'finished'))
+            )
+        claimed = None
+        for candidate in job_dirs:
+            claimed = _claim_chunk(candidate)
+            if claimed:
+                current_job = candidate
+                break
+        if claimed is None:
+            if idle_exit is not None and time.time() - idle_since > idle_exit:
+                return
+            time.sleep(poll_interval)
+            continue
+        idle_since = time.time()
+        i, claim_path = claimed
+        try:
+            with open(claim_path, 'rb') as f:
+                args = pickle.load(f)
+        except FileNotFoundError:
+            # The claim was lost (requeued to todo/) before it could be read, so the chunk is left to be claimed again
+            continue
+        with open(os.path.join(current_job, 'job.p'), 'rb') as f:
+            job = pickle.load(f)
+        stop_event = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(claim_path, job['heartbeat'], stop_event), daemon=True)
+        heartbeat.start()
+        try:
+            if initialised_job != current_job:
+                # The initializer sets the worker's shared state for the job (once per job per worker)
+                if job['initializer']:
+                    _import_function(*job['initializer'])(*job['initargs'])
+                initialised_job = current_job
+            result = _import_function(*job['func'])(*args)
+            _write_atomic(os.path.join(current_job, 'done', f'{i}.p'), result)
+        except Exception:
+            with open(os.path.join(current_job, 'failed', f'{i}.txt'), 'w') as f:
+                f.write(traceback.format_exc())
+        finally:
+            stop_event.set()
+            heartbeat.join()
+            try:
+                os.remove(claim_path)
+            except FileNotFoundError:
+                pass
+
+
+def get_backend(backend=None, n_proc=None):
+    """
+    :param backend: a backend (returned as is), None or 'local' for a LocalBackend of n_proc processes, or
+    'queue:<directory>' for a SharedDirBackend on that directory with n_proc local worker processes
+    """
+    if backend is None or backend == 'local':
+        return LocalBackend(n_proc=n_proc)
+    if isinstance(backend, str):
+        if backend.startswith('queue:'):
+            return SharedDirBackend(backend[len('queue:'):], local_workers=n_proc)
+        raise ValueError(f"Unknown backend {backend}. Use 'local' or 'queue:<directory>'")
+    return backend
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Work queue worker for the buitrago permutation/bootstrap chunks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    worker_parser = subparsers.add_parser('worker', help="Run chunks from a shared queue directory")
+    worker_parser.add_argument('queue_dir')
+    worker_parser.add_argument('--n-proc', type=int, default=1, help="number of worker processes on this node")
+    worker_parser.add_argument('--idle-exit', type=float, help="exit after this many seconds without work")
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        workers = [
+            multiprocessing.Process(target=run_worker, args=(args.queue_dir,), kwargs={'idle_exit': args.idle_exit})
+            for _ in range(args.n_proc)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+The statistics behind the permutation and bootstrap analyses of buitrago.py.
+
+Every permutation/bootstrap workload is a module level chunk function taking (seed, number of permutations or
+replicates) along with the worker initializer that sets the shared state it reads (see buitrago_jobs), so that the
+chunks can be run by any backend. The analysis classes of buitrago.py read the inputs, call these and write
+the results.
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import pdist
+
+from buitrago_data import cluster_div_sets
+
+
+# Shared state for the Mantel permutation workers. Set once per worker process by mantel_worker_init
+# so that the (potentially very large) condensed matrices are only pickled once per worker
+# rather than once per permutation chunk.
+_MANTEL_SHARED = {}
+# The permuted statistics are float32 sums in a different order than the observed one, so a permutation
+# reproducing the observed statistic can come out a few ulps below it
+MANTEL_TOLERANCE = 1e-6
+
+
+def condensed_index(rows, cols, n):
+    """
+    Convert (row, col) square matrix coordinates (row != col) into indices of a
+    scipy style condensed distance vector for a matrix of n objects.
+    """
+    i = np.minimum(rows, cols)
+    j = np.maximum(rows, cols)
+    return n * i - (i * (i + 1)) // 2 + (j - i - 1)
+
+
+def mantel_worker_init(x, y_stack, n, batch_bytes):
+    _MANTEL_SHARED['x'] = x
+    _MANTEL_SHARED['y_stack'] = y_stack
+    _MANTEL_SHARED['n'] = n
+    iu, ju = np.triu_indices(n, k=1)
+    idx_dtype = np.int32 if n < 46000 else np.int64
+    _MANTEL_SHARED['iu'] = iu.astype(idx_dtype)
+    _MANTEL_SHARED['ju'] = ju.astype(idx_dtype)
+    # Each permutation in a batch needs an index array and a gathered float32 copy of x
+    _MANTEL_SHARED['batch_size'] = max(1, int(batch_bytes // (len(x) * (idx_dtype().itemsize * 3 + 4))))
+
+
+def mantel_perm_chunk(seed, n_perm):
+    """
+    Compute the correlation between the permuted x and each row of y_stack for n_perm permutations.
+    The permutations are done on the object labels of x (i.e. rows and columns together) by gathering
+    from the condensed vector with index arrays, in batches sized to the memory budget.
+    :return: float32 array of shape (n_perm, number of y matrices)
+    """
+    x = _MANTEL_SHARED['x']
+    y_stack = _MANTEL_SHARED['y_stack']
+    n = _MANTEL_SHARED['n']
+    iu = _MANTEL_SHARED['iu']
+    ju = _MANTEL_SHARED['ju']
+    rng = np.random.default_rng(seed)
+    m = len(x)
+    out = np.empty((n_perm, y_stack.shape[0]), dtype=np.float32)
+    done = 0
+    while done < n_perm:
+        b = min(_MANTEL_SHARED['batch_size'], n_perm - done)
+        perms = rng.permuted(np.tile(np.arange(n, dtype=iu.dtype), (b, 1)), axis=1)
+        idx = condensed_index(perms[:, iu], perms[:, ju], n)
+        # x is standardised so the mean of the products is the Pearson correlation
+        out[done:done + b] = (x[idx] @ y_stack.T) / m
+        done += b
+    return out
+
+
+def partial_r(r_xy, r_xz, r_yz):
+    return (r_xy - r_xz * r_yz) / np.sqrt((1 - r_xz ** 2) * (1 - r_yz ** 2))
+
+
+# Shared state for the environmental association permutation workers. See env_scan_worker_init.
+_ENV_SCAN_SHARED = {}
+
+
+def env_scan_worker_init(y_csc, q, reef_codes, reef_values, y_r_ss, df, sorted_abs_t, abs_t, batch_size):
+    _ENV_SCAN_SHARED.update(
+        y_csc=y_csc, q=q, reef_codes=reef_codes, reef_values=reef_values, y_r_ss=y_r_ss, df=df,
+        sorted_abs_t=sorted_abs_t, abs_t=abs_t, batch_size=batch_size
+    )
+
+
+def env_scan_t_stats(y_csc, q, x, y_r_ss, df):
+    """
+    t statistics of the covariate coefficient for every feature (column of y_csc) and every column of x,
+    after projecting the nuisance covariates (orthonormal basis q) out of x (Frisch-Waugh-Lovell).
+    Because the residualised x is orthogonal to q, x_r'y == x_r'y_r so y never needs to be residualised
+    or densified: the only product with the sparse matrix is y' x_r.
+    :return: array of shape (n_features, n_columns of x)
+    """
+    x_r = x - q @ (q.T @ x)
+    sxx = np.einsum('ij,ij->j', x_r, x_r)
+    xty = np.asarray(y_csc.T @ x_r)
+    beta = xty / sxx
+    rss = np.clip(y_r_ss[:, None] - beta ** 2 * sxx, 0, None)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return beta / np.sqrt(rss / df / sxx), beta
+
+
+def env_scan_perm_chunk(seed, n_perm):
+    """
+    Run n_perm permutations of the reef level covariate (values shuffled between reefs) and reduce them
+    on the fly to (1) a histogram of the null |t| against the sorted observed |t| (for the FDR) and
+    (2) the per feature count of null |t| >= observed |t|.
+    """
+    s = _ENV_SCAN_SHARED
+    rng = np.random.default_rng(seed)
+    n_features = len(s['abs_t'])
+    threshold_hist = np.zeros(n_features + 1, dtype=np.int64)
+    exceed_counts = np.zeros(n_features, dtype=np.int64)
+    done = 0
+    while done < n_perm:
+        b = min(s['batch_size'], n_perm - done)
+        reef_value_perms = np.stack([rng.permutation(s['reef_values']) for _ in range(b)], axis=1)
+        t_null, _ = env_scan_t_stats(
+            y_csc=s['y_csc'], q=s['q'], x=reef_value_perms[s['reef_codes']], y_r_ss=s['y_r_ss'], df=s['df'])
+        abs_t_null = np.nan_to_num(np.abs(t_null), nan=0)
+        threshold_hist += np.bincount(
+            np.searchsorted(s['sorted_abs_t'], abs_t_null.ravel(), side='right'), minlength=n_features + 1)
+        exceed_counts += (abs_t_null >= s['abs_t'][:, None]).sum(axis=1)
+        done += b
+    return threshold_hist, exceed_counts
+
+
+# Shared state for the bootstrap workers. The count matrix is opened read only from a memory mapped
+# .npy file in each worker so that it is shared between the processes rather than copied to each.
+_BOOTSTRAP_SHARED = {}
+
+
+def clade_keys(linkage_matrix, n_leaves):
+    """
+    The leaf membership of every internal node of a linkage as bytes (packed bit sets) so that
+    clades can be compared between trees by hashing.
+    """
+    n_bytes = (n_leaves + 7) // 8
+    packed = np.zeros((2 * n_leaves - 1, n_bytes), dtype=np.uint8)
+    packed[np.arange(n_leaves), np.arange(n_leaves) // 8] = 1 << (7 - np.arange(n_leaves) % 8)
+    for i, (left, right) in enumerate(linkage_matrix[:, :2].astype(int)):
+        packed[n_leaves + i] = packed[left] | packed[right]
+    return [_.tobytes() for _ in packed[n_leaves:]]
+
+
+def bc_sqrt_linkage(counts, method):
+    """Bray-Curtis distances of the square root transformed relative abundances and their linkage"""
+    rel = counts / counts.sum(axis=1, keepdims=True)
+    return linkage(pdist(np.sqrt(rel), metric='braycurtis'), method=method)
+
+
+def bootstrap_worker_init(counts_path, ref_clade_keys, method, n_clusters, profile_div_samples):
+    _BOOTSTRAP_SHARED['counts'] = np.load(counts_path, mmap_mode='r') if counts_path else None
+    _BOOTSTRAP_SHARED['ref_clade_to_index'] = {k: i for i, k in enumerate(ref_clade_keys)}
+    _BOOTSTRAP_SHARED['method'] = method
+    _BOOTSTRAP_SHARED['n_clusters'] = n_clusters
+    _BOOTSTRAP_SHARED['profile_div_samples'] = profile_div_samples
+
+
+def bootstrap_dendro_chunk(seed, n_reps):
+    """
+    For each replicate resample the sequence counts of every sample (multinomial with the sample's
+    observed total and proportions), recompute the distances and linkage and record which of the
+    reference clades were recovered and the flat cluster assignment of every sample.
+    :return: (per reference clade count of replicates recovering it, n_reps x n_samples cluster labels)
+    """
+    counts = _BOOTSTRAP_SHARED['counts']
+    ref_clade_to_index = _BOOTSTRAP_SHARED['ref_clade_to_index']
+    rng = np.random.default_rng(seed)
+    totals = counts.sum(axis=1).astype(np.int64)
+    props = counts / totals[:, None]
+    support = np.zeros(len(ref_clade_to_index), dtype=np.int64)
+    labels = np.empty((n_reps, counts.shape[0]), dtype=np.int32)
+    for rep in range(n_reps):
+        rep_linkage = bc_sqrt_linkage(rng.multinomial(totals, props).astype(float), _BOOTSTRAP_SHARED['method'])
+        for key in clade_keys(rep_linkage, counts.shape[0]):
+            i = ref_clade_to_index.get(key)
+            if i is not None:
+                support[i] += 1
+        labels[rep] = fcluster(rep_linkage, t=_BOOTSTRAP_SHARED['n_clusters'], criterion='maxclust')
+    return support, labels
+
+
+def bootstrap_profile_chunk(seed, n_reps):
+    """
+    For each replicate resample the sequence counts of every sample (multinomial with the sample's observed total
+    and proportions), re-derive the DIVs of every profile and rerun the 3 shared DIV profile clustering.
+    A DIV is kept in a profile if it is still detected in at least half of the samples of the profile
+    it was detected in (DIVs not found in the sequence counts are always kept).
+    :return: n_reps x n_profiles cluster labels (profiles that are not clustered get their own label)
+    """
+    counts = _BOOTSTRAP_SHARED['counts']
+    profile_div_samples = _BOOTSTRAP_SHARED['profile_div_samples']
+    profiles = list(profile_div_samples.keys())
+    profile_to_index = {p: i for i, p in enumerate(profiles)}
+    rng = np.random.default_rng(seed)
+    totals = counts.sum(axis=1).astype(np.int64)
+    props = counts / totals[:, None]
+    labels = np.empty((n_reps, len(profiles)), dtype=np.int32)
+    for rep in range(n_reps):
+        detected = rng.multinomial(totals, props) > 0
+        rep_div_sets = {
+            p: {div for div, col, rows in div_samples if not len(rows) or detected[rows, col].mean() >= 0.5}
+            for p, div_samples in profile_div_samples.items()
+        }
+        labels[rep] = np.arange(len(profiles)) + len(profiles)
+        for rep_label, members in enumerate(cluster_div_sets(rep_div_sets, verbose=False).values()):
+            labels[rep, [profile_to_index[_] for _ in members]] = rep_label
+    return labels
+
+
+# Shared state for the co-occurrence permutation workers. See cooccurrence_worker_init.
+_COOCCURRENCE_SHARED = {}
+
+
+def cooccurrence_worker_init(counts, pseudocount, measure, n_bins, block_features):
+    _COOCCURRENCE_SHARED.update(
+        counts=counts, pseudocount=pseudocount, measure=measure, n_bins=n_bins, block_features=block_features)
+
+
+def clr_centred(counts, pseudocount):
+    """
+    The centred log ratio transform of a dense sample x feature count matrix (with a pseudocount for the zeros),
+    centred per feature, and the sum of squares of every feature.
+    """
+    log_counts = np.log(counts + pseudocount)
+    clr = log_counts - log_counts.mean(axis=1, keepdims=True)
+    clr -= clr.mean(axis=0)
+    return clr, np.einsum('ij,ij->j', clr, clr)
+
+
+def cooccurrence_blocks(clr, ss, measure, block_features):
+    """
+    Yield (first row, block) for blocks of rows of the upper triangle of the feature x feature association matrix.
+    The block holds the associations of features first row:first row + len(block) with all features from
+    first row on (computed with one matrix product), the diagonal and below set to nan.
+    'rho' is the proportionality coefficient 2 cov(i, j) / (var(i) + var(j)) of the clr values
+    (Lovell et al. 2015, as propr's rho) and 'pearson' the Pearson correlation of the clr values.
+    """
+    n_features = clr.shape[1]
+    for start in range(0, n_features, block_features):
+        end = min(start + block_features, n_features)
+        block = clr[:, start:end].T @ clr[:, start:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if measure == 'rho':
+                block = 2 * block / (ss[start:end, None] + ss[None, start:])
+            else:
+                block = block / np.sqrt(ss[start:end, None] * ss[None, start:])
+        block[np.tril_indices(end - start)] = np.nan
+        yield start, block
+
+
+def abs_hist(block, n_bins):
+    """Histogram of the |association| values of a block over n_bins equal bins of [0, 1] (nan ignored)"""
+    abs_values = np.abs(block[~np.isnan(block)])
+    return np.bincount(np.minimum((abs_values * n_bins).astype(np.int64), n_bins - 1), minlength=n_bins)
+
+
+def cooccurrence_perm_chunk(seed, n_perm):
+    """
+    Run n_perm permutations, each shuffling the counts of every feature independently between the samples
+    (so that any co-occurrence is broken but the distribution of each feature kept) and reduce each to the
+    histogram of the null |association| of all pairs of features.
+    """
+    s = _COOCCURRENCE_SHARED
+    rng = np.random.default_rng(seed)
+    null_hist = np.zeros(s['n_bins'], dtype=np.int64)
+    for _ in range(n_perm):
+        clr, ss = clr_centred(rng.permuted(s['counts'], axis=0), s['pseudocount'])
+        for start, block in cooccurrence_blocks(clr, ss, s['measure'], s['block_features']):
+            null_hist += abs_hist(block, s['n_bins'])
+    return null_hist
+
+
+# Shared state for the IndVal permutation workers. See indval_worker_init.
+_INDVAL_SHARED = {}
+
+
+def indval_stats(abund_t, presence_t, codes, comb, group_sizes):
+    """
+    The group equalized IndVal (IndVal.g, De Caceres & Legendre 2009, as indicspecies' multipatt) of every feature
+    for every combination of groups, for a batch of groupings of the samples at once.
+    :param abund_t: sparse feature x sample (relative) abundance matrix
+    :param presence_t: sparse feature x sample presence (1/0) matrix
+    :param codes: array (n_samples, n_groupings) of the group (0 to n_groups - 1) of every sample in every grouping.
+    All groupings must have the same group sizes (e.g. permutations of one grouping).
+    :param comb: array (n_groups, n_comb) of the groups (1/0) making up every combination
+    :param group_sizes: the number of samples in every group
+    :return: (IndVal, A, B) arrays of shape (n_features, n_groupings, n_comb). IndVal is sqrt(A * B) where A
+    (specificity) is the sum of the mean abundances of the groups of the combination over the sum of the mean
+    abundances of all groups and B (fidelity) is the proportion of the samples of the combination the feature
+    is found in.
+    """
+    n_samples, n_groupings = codes.shape
+    n_groups = comb.shape[0]
+    # One hot matrix of the group of every sample in every grouping (n_samples x n_groupings * n_groups)
+    one_hot = sparse.csc_matrix((
+        np.ones(codes.size), (np.repeat(np.arange(n_samples), n_groupings),
+                              (codes + np.arange(n_groupings) * n_groups).ravel())
+    ), shape=(n_samples, n_groupings * n_groups))
+    n_features = abund_t.shape[0]
+    group_means = (abund_t @ one_hot).toarray().reshape(n_features, n_groupings, n_groups) / group_sizes
+    group_presence = (presence_t @ one_hot).toarray().reshape(n_features, n_groupings, n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = (group_means @ comb) / group_means.sum(axis=2, keepdims=True)
+    b = (group_presence @ comb) / (group_sizes @ comb)
+    return np.sqrt(a * b), a, b
+
+
+def indval_worker_init(abund_t, presence_t, codes, comb, group_sizes, max_stat, batch_size):
+    _INDVAL_SHARED.update(
+        abund_t=abund_t, presence_t=presence_t, codes=codes, comb=comb, group_sizes=group_sizes,
+        max_stat=max_stat, batch_size=batch_size
+    )
+
+
+def indval_perm_chunk(seed, n_perm):
+    """
+    Run n_perm permutations of the samples between the groups, in batches, and return the per feature count of
+    permutations in which the best combination's IndVal is >= the observed (as multipatt).
+    """
+    s = _INDVAL_SHARED
+    rng = np.random.default_rng(seed)
+    exceed_counts = np.zeros(len(s['max_stat']), dtype=np.int64)
+    done = 0
+    while done < n_perm:
+        b = min(s['batch_size'], n_perm - done)
+        codes = np.stack([rng.permutation(s['codes']) for _ in range(b)], axis=1)
+        stat, _, _ = indval_stats(s['abund_t'], s['presence_t'], codes, s['comb'], s['group_sizes'])
+        # Allow for rounding differences between the observed and a permutation that reproduces it
+        exceed_counts += (np.nan_to_num(stat, nan=0).max(axis=2) >= s['max_stat'][:, None] - 1e-10).sum(axis=1)
+        done += b
+    return exceed_counts
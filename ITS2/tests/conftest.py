@@ -0,0 +1,5 @@
+import os
+import sys
+
+# buitrago_data.py, buitrago_stats.py and buitrago_jobs.py are imported as top level modules as buitrago.py does
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+
+from buitrago_data import (
+    ProfileDIVIncidence, ProfileRepresentatives, SPAbundance, SPAbundanceCube, cluster_div_sets
+)
+
+
+def _abundance_and_meta():
+    rng = np.random.default_rng(0)
+    counts = rng.integers(0, 20, size=(12, 5))
+    counts[3] = 0
+    abundance = SPAbundance(counts, [f's{_}' for _ in range(12)], ['C3', 'C1', '964_A', 'A1', '12_D'])
+    meta_df = pd.DataFrame({
+        'species': ['spis'] * 6 + ['pver'] * 6,
+        'region': ['MAQ', 'WAJ'] * 6,
+        'reef': ['MAQ-R1', 'WAJ-R1', 'MAQ-R2', 'WAJ-R1'] * 3,
+        'cluster': ['CL1', 'CL2', 'CL1'] * 4,
+    }, index=abundance.sample_names)
+    return counts, abundance, meta_df
+
+
+def test_abundance_relative_and_clades():
+    counts, abundance, _ = _abundance_and_meta()
+    rel = abundance.relative().matrix.toarray()
+    totals = counts.sum(axis=1, keepdims=True)
+    np.testing.assert_allclose(rel, np.divide(counts, totals, out=np.zeros(counts.shape), where=totals != 0))
+    np.testing.assert_array_equal(abundance.feature_clades(), ['C', 'C', 'A', 'A', 'D'])
+    subset = abundance.subset(sample_names=['s5', 's0'], feature_mask=abundance.feature_clades() == 'C')
+    np.testing.assert_array_equal(subset.matrix.toarray(), counts[[5, 0]][:, :2])
+
+
+def test_cube_matches_sample_level_queries():
+    counts, abundance, meta_df = _abundance_and_meta()
+    cube = SPAbundanceCube(abundance, meta_df)
+    rel = abundance.relative().matrix.toarray()
+    for selection in [{}, {'species': 'spis'}, {'region': 'WAJ', 'cluster': 'CL1'}, {'reef': ['MAQ-R1', 'MAQ-R2']}]:
+        rows = np.ones(len(meta_df), dtype=bool)
+        for dim, value in selection.items():
+            rows &= meta_df[dim].isin(np.atleast_1d(value)).values
+        assert cube.n_samples(**selection) == rows.sum()
+        np.testing.assert_array_equal(cube.totals(**selection).values, counts[rows].sum(axis=0))
+        np.testing.assert_allclose(
+            cube.composition(clade='C', **selection), counts[rows][:, :2].sum() / counts[rows].sum())
+        np.testing.assert_allclose(
+            cube.composition(clade='A', mean_of_samples=True, **selection), rel[rows][:, 2:4].sum() / rows.sum())
+        np.testing.assert_allclose(
+            cube.prevalence(features=['C1', '12_D'], **selection).values,
+            (counts[rows][:, [1, 4]] > 0).mean(axis=0))
+    rollup = cube.rollup(['species'])
+    np.testing.assert_array_equal(rollup.loc['pver'].values, counts[6:].sum(axis=0))
+
+
+_PROFILE_TO_DIV_SET_DICT = {
+    1: {'C3', 'C3c', 'C3gulf', 'C3ye'},
+    2: {'C3', 'C3c', 'C3gulf', 'C115'},
+    3: {'A1', 'A1bv', 'A1bw'},
+    4: {'D1', 'D4', 'D6'},
+    5: {'C3', 'C3c', 'C21'},
+}
+
+
+def test_cluster_div_sets():
+    # 1 and 2 share C3, C3c and C3gulf. 5 shares only 2 DIVs with either so stays unclustered
+    assert dict(cluster_div_sets(_PROFILE_TO_DIV_SET_DICT, verbose=False)) == {'C3,C3c,C3gulf': [1, 2]}
+
+
+def test_profile_representatives_assign(tmp_path):
+    reps = ProfileRepresentatives.from_div_sets(_PROFILE_TO_DIV_SET_DICT, verbose=False)
+    assert reps.unclustered_profiles == {3, 4, 5}
+    path = str(tmp_path / 'reps.p')
+    reps.save(path)
+    reps = ProfileRepresentatives.load(path)
+
+    assigned = reps.assign({
+        # Known profiles are ignored
+        1: {'C3'},
+        # To the existing representative
+        6: {'C3', 'C3c', 'C3gulf', 'C3d'},
+        # A new representative with the unclustered profile 4
+        7: {'D1', 'D4', 'D6', 'D2'},
+        # Unclustered
+        8: {'G3', 'G3b'},
+    })
+    assert assigned == {6: 'C3,C3c,C3gulf', 7: 'D1,D4,D6', 8: None}
+    assert reps.rep_divs_to_profiles == {'C3,C3c,C3gulf': [1, 2, 6], 'D1,D4,D6': [4, 7]}
+    assert reps.unclustered_profiles == {3, 5, 8}
+    # The labels of the existing representatives do not change
+    assert reps.prof_to_rep_dict() == {1: 1, 2: 1, 6: 1, 4: 4, 7: 4}
+
+
+def test_profile_div_incidence():
+    incidence = ProfileDIVIncidence.from_profile_names({
+        1: 'C3-C3c-C3gulf/C3ye', 2: 'C3/C3c-C3gulf-C115', 5: 'C3-C3c-C21', 3: 'A1-A1bv-A1bw'})
+    assert incidence.div_sets([1])[1] == {'C3', 'C3c', 'C3gulf', 'C3ye'}
+    profiles = [1, 2, 5, 3]
+    shared = incidence.shared_div_counts()[incidence.rows(profiles)][:, incidence.rows(profiles)].toarray()
+    np.testing.assert_array_equal(shared, [[4, 3, 2, 0], [3, 4, 2, 0], [2, 2, 3, 0], [0, 0, 0, 3]])
+    np.testing.assert_array_equal(incidence.shared_div_counts_of_pairs([1, 2, 5], [2, 5, 3]), [3, 2, 0])
+    assert incidence.shared_divs(1, 5) == ['C3', 'C3c']
+
+    edge_df = incidence.network_edges(min_shared=2)
+    edges = {frozenset(pair): j for pair, j in zip(zip(edge_df['profile_1'], edge_df['profile_2']), edge_df['jaccard'])}
+    assert edges == {frozenset([1, 2]): 3 / 5, frozenset([1, 5]): 2 / 5, frozenset([2, 5]): 2 / 5}
+    jaccard = incidence.jaccard()[incidence.rows([1])][:, incidence.rows([2])].toarray()
+    np.testing.assert_allclose(jaccard, [[3 / 5]])
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pytest
+
+from buitrago_jobs import LocalBackend, SharedDirBackend, _claim_chunk, get_backend, run_worker, seeded_chunks
+from buitrago_stats import mantel_perm_chunk, mantel_worker_init
+
+
+def _mantel_job(rng, n=8):
+    x = rng.normal(size=n * (n - 1) // 2).astype(np.float32)
+    y_stack = rng.normal(size=(2, n * (n - 1) // 2)).astype(np.float32)
+    return x, y_stack, n, 2 ** 12
+
+
+def test_shared_dir_claim_requeue_done(tmp_path):
+    initargs = _mantel_job(np.random.default_rng(0))
+    seeds, chunk_sizes = seeded_chunks(1, 30, 3)
+    chunk_args = list(zip(seeds, chunk_sizes))
+    backend = SharedDirBackend(str(tmp_path), local_workers=0, lease=60, poll_interval=0.01, max_retries=1)
+    job_dir = backend._queue_job(mantel_perm_chunk, chunk_args, mantel_worker_init, initargs)
+    assert sorted(os.listdir(os.path.join(job_dir, 'todo'))) == ['0.p', '1.p', '2.p']
+
+    # A claim moves the chunk out of todo/
+    i, claim_path = _claim_chunk(job_dir)
+    assert i == 0 and os.path.dirname(claim_path) == os.path.join(job_dir, 'claimed')
+    assert sorted(os.listdir(os.path.join(job_dir, 'todo'))) == ['1.p', '2.p']
+
+    # A claim refreshed within the lease is left alone, one older than the lease is requeued
+    retries = {}
+    backend._requeue_lost(job_dir, retries)
+    assert os.path.exists(claim_path) and not retries
+    stale = os.path.getmtime(claim_path) - 2 * backend.lease
+    os.utime(claim_path, (stale, stale))
+    backend._requeue_lost(job_dir, retries)
+    assert not os.listdir(os.path.join(job_dir, 'claimed')) and retries == {0: 1}
+    assert sorted(os.listdir(os.path.join(job_dir, 'todo'))) == ['0.p', '1.p', '2.p']
+
+    # A worker runs every chunk, the requeued one included, to done/
+    run_worker(backend.queue_dir, job_dir=job_dir, idle_exit=0, poll_interval=0.01)
+    assert not os.listdir(os.path.join(job_dir, 'todo')) and not os.listdir(os.path.join(job_dir, 'claimed'))
+    results = backend._collect(job_dir, len(chunk_args))
+    mantel_worker_init(*initargs)
+    for i, args in enumerate(chunk_args):
+        np.testing.assert_array_equal(results[i], mantel_perm_chunk(*args))
+
+
+def test_shared_dir_lost_too_often(tmp_path):
+    backend = SharedDirBackend(str(tmp_path), local_workers=0, lease=60, max_retries=0)
+    job_dir = backend._queue_job(mantel_perm_chunk, [(np.random.SeedSequence(0), 5)])
+    _, claim_path = _claim_chunk(job_dir)
+    stale = os.path.getmtime(claim_path) - 2 * backend.lease
+    os.utime(claim_path, (stale, stale))
+    with pytest.raises(RuntimeError):
+        backend._requeue_lost(job_dir, {})
+
+
+def test_get_backend(tmp_path):
+    assert isinstance(get_backend(n_proc=3), LocalBackend) and get_backend(n_proc=3).n_proc == 3
+    backend = get_backend(f'queue:{tmp_path}', n_proc=2)
+    assert isinstance(backend, SharedDirBackend) and backend.local_workers == 2
+    assert get_backend(backend) is backend
+    with pytest.raises(ValueError):
+        get_backend('slurm')
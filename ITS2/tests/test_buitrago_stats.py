@@ -0,0 +1,171 @@
+import itertools
+
+import numpy as np
+from scipy import sparse
+from scipy.cluster.hierarchy import linkage
+from scipy.spatial.distance import pdist, squareform
+from scipy.stats import pearsonr
+
+from buitrago_stats import (
+    abs_hist, bc_sqrt_linkage, bootstrap_dendro_chunk, bootstrap_worker_init, clade_keys, clr_centred,
+    condensed_index, cooccurrence_blocks, env_scan_t_stats, indval_stats, mantel_perm_chunk, mantel_worker_init,
+    partial_r
+)
+
+
+def _standardised(v):
+    return ((v - v.mean()) / v.std()).astype(np.float32)
+
+
+def _random_condensed(rng, n):
+    return pdist(rng.normal(size=(n, 3)))
+
+
+def test_condensed_index():
+    n = 6
+    square = np.arange(n * n, dtype=float).reshape(n, n)
+    square = square + square.T
+    np.fill_diagonal(square, 0)
+    condensed = squareform(square)
+    rows, cols = np.nonzero(~np.eye(n, dtype=bool))
+    np.testing.assert_array_equal(condensed[condensed_index(rows, cols, n)], square[rows, cols])
+
+
+def test_mantel_r_is_pearson_r():
+    rng = np.random.default_rng(1)
+    x, y = _random_condensed(rng, 20), _random_condensed(rng, 20)
+    # As in BuitragoMantel: the mean of the products of the standardised condensed matrices
+    r = float(_standardised(x) @ _standardised(y)) / len(x)
+    np.testing.assert_allclose(r, pearsonr(x, y)[0], atol=1e-6)
+
+
+def test_mantel_permutations_are_object_permutations():
+    # With 5 objects every permuted statistic must be the Pearson r of y with x with its objects relabelled
+    rng = np.random.default_rng(2)
+    n = 5
+    x, y = _random_condensed(rng, n), _random_condensed(rng, n)
+    x_square = squareform(x)
+    possible_r = np.array([
+        pearsonr(squareform(x_square[np.ix_(perm, perm)], checks=False), y)[0]
+        for perm in map(list, itertools.permutations(range(n)))
+    ])
+    mantel_worker_init(_standardised(x), np.vstack([_standardised(y)]), n, batch_bytes=2 ** 12)
+    perm_r = mantel_perm_chunk(np.random.SeedSequence(3), 50)
+    assert perm_r.shape == (50, 1)
+    assert np.all(np.min(np.abs(perm_r - possible_r[None, :]), axis=1) < 1e-5)
+    # Same seed, same permutations
+    np.testing.assert_array_equal(perm_r, mantel_perm_chunk(np.random.SeedSequence(3), 50))
+
+
+def test_partial_r():
+    # The partial correlation is the correlation of the residuals of x and y on z
+    rng = np.random.default_rng(4)
+    z = rng.normal(size=200)
+    x = z + rng.normal(size=200)
+    y = z + rng.normal(size=200)
+    x_res = x - np.polyval(np.polyfit(z, x, 1), z)
+    y_res = y - np.polyval(np.polyfit(z, y, 1), z)
+    np.testing.assert_allclose(
+        partial_r(pearsonr(x, y)[0], pearsonr(x, z)[0], pearsonr(y, z)[0]), pearsonr(x_res, y_res)[0])
+
+
+def test_env_scan_t_stats_match_least_squares():
+    # t of the covariate in y ~ covariate + group for every feature, against a full least squares fit
+    rng = np.random.default_rng(5)
+    n = 40
+    group = np.repeat([0, 1, 2, 3], 10)
+    covariate = rng.normal(size=n)
+    y = rng.poisson(3, size=(n, 6)).astype(float) + np.outer(covariate, np.arange(6))
+    y[:, 0] = 0
+    y[:5, 0] = 1
+
+    z = np.column_stack([np.ones(n)] + [group == g for g in [1, 2, 3]]).astype(float)
+    q = np.linalg.qr(z)[0]
+    df = n - q.shape[1] - 1
+    y_csc = sparse.csc_matrix(y)
+    y_r_ss = (y ** 2).sum(axis=0) - ((q.T @ y) ** 2).sum(axis=0)
+    t, beta = env_scan_t_stats(y_csc, q, covariate.reshape(-1, 1), y_r_ss, df)
+
+    design = np.column_stack([covariate, z])
+    coef, rss = np.linalg.lstsq(design, y, rcond=None)[:2]
+    se = np.sqrt(rss / df * np.linalg.inv(design.T @ design)[0, 0])
+    np.testing.assert_allclose(beta.ravel(), coef[0], atol=1e-10)
+    np.testing.assert_allclose(t.ravel(), coef[0] / se, rtol=1e-8)
+
+
+def test_clade_keys():
+    # Leaves 0 and 1 merge first, then 2 and 3, then the two pairs: the same clades however the linkage lists them
+    points = np.array([[0.0], [0.1], [5.0], [5.2]])
+    keys = clade_keys(linkage(points, 'average'), 4)
+    assert keys[0] == bytes([0b11000000])
+    assert keys[1] == bytes([0b00110000])
+    assert keys[2] == bytes([0b11110000])
+    # Relabelling the leaves within the pairs keeps the clades, swapping leaves between the pairs does not
+    assert set(clade_keys(linkage(points[[1, 0, 3, 2]], 'average'), 4)) == set(keys)
+    assert set(clade_keys(linkage(points[[0, 2, 1, 3]], 'average'), 4)) != set(keys)
+
+
+def test_bootstrap_dendrogram_support(tmp_path):
+    # Two groups of samples with very different, deeply sequenced compositions: the split is always recovered
+    rng = np.random.default_rng(6)
+    props = np.vstack([np.tile([0.7, 0.2, 0.1, 0.0], (4, 1)), np.tile([0.0, 0.1, 0.2, 0.7], (4, 1))])
+    counts = rng.multinomial(10000, props).astype(float)
+    counts_path = str(tmp_path / 'counts.npy')
+    np.save(counts_path, counts)
+    ref_linkage = bc_sqrt_linkage(counts, 'average')
+    bootstrap_worker_init(counts_path, clade_keys(ref_linkage, 8), 'average', 2, None)
+    support, labels = bootstrap_dendro_chunk(np.random.SeedSequence(7), 20)
+    group_clades = [i for i, key in enumerate(clade_keys(ref_linkage, 8)) if key in (b'\xf0', b'\x0f')]
+    assert len(group_clades) == 2
+    np.testing.assert_array_equal(support[group_clades], 20)
+    assert labels.shape == (20, 8)
+    assert np.all(labels[:, :4] == labels[:, :1]) and np.all(labels[:, 4:] != labels[:, :1])
+
+
+def test_cooccurrence_blocks():
+    rng = np.random.default_rng(9)
+    counts = rng.poisson(5, size=(12, 7)).astype(float)
+    clr, ss = clr_centred(counts, 0.5)
+    log_counts = np.log(counts + 0.5)
+    expected_clr = log_counts - log_counts.mean(axis=1, keepdims=True)
+    for measure in ['rho', 'pearson']:
+        blocks = list(cooccurrence_blocks(clr, ss, measure, block_features=3))
+        assert [start for start, _ in blocks] == [0, 3, 6]
+        n_values = 0
+        for start, block in blocks:
+            for a in range(block.shape[0]):
+                for b in range(block.shape[1]):
+                    i, j = start + a, start + b
+                    if j <= i:
+                        assert np.isnan(block[a, b])
+                        continue
+                    x, y = expected_clr[:, i], expected_clr[:, j]
+                    if measure == 'rho':
+                        expected = 1 - np.var(x - y) / (np.var(x) + np.var(y))
+                    else:
+                        expected = pearsonr(x, y)[0]
+                    np.testing.assert_allclose(block[a, b], expected)
+                    n_values += 1
+            assert abs_hist(block, 10).sum() == np.sum(~np.isnan(block))
+        assert n_values == 7 * 6 // 2
+
+
+def test_indval_stats():
+    rng = np.random.default_rng(4)
+    abund = rng.random((9, 5)) * (rng.random((9, 5)) < 0.6)
+    group = np.array([0, 0, 0, 1, 1, 2, 2, 2, 2])
+    group_sizes = np.bincount(group).astype(float)
+    comb = np.array([_ for _ in itertools.product([0, 1], repeat=3) if any(_)]).T
+    codes = np.stack([group, rng.permutation(group)], axis=1)
+    abund_t = sparse.csr_matrix(abund.T)
+    stat, a, b = indval_stats(abund_t, (abund_t > 0).astype(float), codes, comb, group_sizes)
+    assert stat.shape == (5, 2, comb.shape[1])
+    for g in range(codes.shape[1]):
+        group_means = np.array([abund[codes[:, g] == k].mean(axis=0) for k in range(3)])
+        for c in range(comb.shape[1]):
+            in_comb = np.isin(codes[:, g], np.flatnonzero(comb[:, c]))
+            for f in range(5):
+                expected_a = group_means[comb[:, c] == 1, f].sum() / group_means[:, f].sum()
+                expected_b = np.mean(abund[in_comb, f] > 0)
+                np.testing.assert_allclose([a[f, g, c], b[f, g, c]], [expected_a, expected_b])
+    np.testing.assert_allclose(stat, np.sqrt(a * b))
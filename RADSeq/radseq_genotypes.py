@@ -0,0 +1,1045 @@
+#!/usr/bin/env python3
+"""
+Python access to the RADSeq genotypes.
+
+A VCF (e.g. populations.snps.vcf or spis.LE.filtered.recode.indnames.vcf) is streamed once into a GenotypeStore:
+a directory holding a 2-bit packed, memory mapped genotype matrix (SNP major, 4 samples per byte) along with
+the SNP index (scaffold, position, id, alleles) and the sample names (converted to the names used in the
+spis/pver.genclust.strata files e.g. SMAQ_R1_1_filtered -> SMAQ-R1-1).
+
+Genotype codes are the number of alternative alleles (0, 1 or 2) and 3 for missing.
+
+Usage:
+    python radseq_genotypes.py build spis.LE.filtered.recode.indnames.vcf spis_genotypes
+    python radseq_genotypes.py info spis_genotypes
+    python radseq_genotypes.py pca spis_genotypes --prefix spis.LE.filtered.PCA
+    python radseq_genotypes.py ld spis_genotypes --keep K6/SCL*.txt --scaffolds Spis.10largest.Scaffolds --prefix spis
+    python radseq_genotypes.py fst spis_genotypes spis.genclust.strata --prefix spis
+    python radseq_genotypes.py outliers spis_genotypes spis.genclust.strata.K6.tsv --prefix spis.popgenclust
+
+The ld, fst and outliers jobs can be spread over nodes with --backend queue:/shared/dir and workers started on the nodes
+with python ../ITS2/buitrago_jobs.py worker /shared/dir (see buitrago_jobs.py).
+"""
+
+import argparse
+import gzip
+import json
+import os
+import re
+import sys
+
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+MISSING = 3
+
+# VCF GT string (first 3 characters) to genotype code. Anything else (e.g. multi-allelic) is missing.
+_GT_CODE_DICT = {
+    f"{a}{sep}{b}": int(a == '1') + int(b == '1')
+    for a in '01' for b in '01' for sep in '/|'
+}
+
+# For every byte value, the 4 genotype codes it packs
+_UNPACK_TABLE = np.array(
+    [[(byte >> (2 * i)) & 3 for i in range(4)] for byte in range(256)], dtype=np.uint8)
+
+
+def vcf_sample_name_to_strata_name(vcf_name):
+    """
+    SMAQ_R1_1_filtered, SMAQ_R1_1_filtered-sorted (STACKS populations.snps.vcf) or SMAQ-R1-1-filtered -> SMAQ-R1-1
+    (the names used in the genclust.strata files)
+    """
+    return re.sub(r"[_-]filtered(-sorted)?$", "", vcf_name).replace('_', '-')
+
+
+def pack_genotypes(codes):
+    """Pack an n_snps x n_samples array of genotype codes into n_snps x ceil(n_samples / 4) bytes"""
+    n_snps, n_samples = codes.shape
+    n_bytes = (n_samples + 3) // 4
+    padded = np.full((n_snps, n_bytes * 4), MISSING, dtype=np.uint8)
+    padded[:, :n_samples] = codes
+    padded = padded.reshape(n_snps, n_bytes, 4)
+    return padded[:, :, 0] | (padded[:, :, 1] << 2) | (padded[:, :, 2] << 4) | (padded[:, :, 3] << 6)
+
+
+def unpack_genotypes(packed, n_samples):
+    """Unpack n_snps x n_bytes packed genotypes into an n_snps x n_samples array of genotype codes"""
+    return _UNPACK_TABLE[packed].reshape(packed.shape[0], -1)[:, :n_samples]
+
+
+def _open_text(path):
+    return gzip.open(path, 'rt') if path.endswith('.gz') else open(path, 'r')
+
+
+class GenotypeStore:
+    """
+    A 2-bit packed, memory mapped genotype matrix with its SNP index (snp_df) and sample names.
+
+    Subsetting (samples, snps, scaffolds, filter_maf) returns a new GenotypeStore over the same memory map
+    so no genotypes are copied until they are unpacked with genotypes() or iter_blocks().
+
+    e.g.
+        store = GenotypeStore.open('spis_genotypes').filter_maf(0.05)
+        store = store.subset(samples=strata_df.index)
+        codes = store.genotypes()
+    """
+    def __init__(self, store_dir, packed, snp_df, all_sample_names, snp_rows=None, sample_cols=None):
+        self.store_dir = store_dir
+        self.packed = packed
+        self.all_sample_names = list(all_sample_names)
+        self.snp_rows = np.arange(packed.shape[0]) if snp_rows is None else np.asarray(snp_rows)
+        self.sample_cols = np.arange(len(self.all_sample_names)) if sample_cols is None else np.asarray(sample_cols)
+        self.snp_df = snp_df.iloc[self.snp_rows].reset_index(drop=True) if snp_rows is not None else snp_df
+        self.sample_names = [self.all_sample_names[_] for _ in self.sample_cols]
+        self._all_samples = sample_cols is None
+        self._full_snp_df = snp_df
+
+    @property
+    def n_snps(self):
+        return len(self.snp_rows)
+
+    @property
+    def n_samples(self):
+        return len(self.sample_cols)
+
+    @classmethod
+    def from_vcf(cls, vcf_path, store_dir, chunk_snps=10000):
+        """
+        Stream a VCF into a new GenotypeStore in store_dir.
+        SNPs are parsed and packed in chunks of chunk_snps so that only one chunk is held in memory.
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        snp_rows = []
+        sample_names = None
+        n_snps = 0
+        with _open_text(vcf_path) as vcf, open(os.path.join(store_dir, 'genotypes.bin'), 'wb') as bin_file:
+            chunk = []
+            for line in vcf:
+                if line.startswith('##'):
+                    continue
+                if line.startswith('#CHROM'):
+                    sample_names = [vcf_sample_name_to_strata_name(_) for _ in line.rstrip('\n').split('\t')[9:]]
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                snp_rows.append(fields[:5])
+                chunk.append([_GT_CODE_DICT.get(_[:3], MISSING) for _ in fields[9:]])
+                if len(chunk) == chunk_snps:
+                    bin_file.write(pack_genotypes(np.array(chunk, dtype=np.uint8)).tobytes())
+                    n_snps += len(chunk)
+                    chunk = []
+            if chunk:
+                bin_file.write(pack_genotypes(np.array(chunk, dtype=np.uint8)).tobytes())
+                n_snps += len(chunk)
+        snp_df = pd.DataFrame(snp_rows, columns=['scaffold', 'pos', 'id', 'ref', 'alt'])
+        snp_df['pos'] = snp_df['pos'].astype(np.int64)
+        snp_df.to_csv(os.path.join(store_dir, 'snps.tsv'), sep='\t', index=False)
+        with open(os.path.join(store_dir, 'samples.txt'), 'w') as f:
+            f.write('\n'.join(sample_names) + '\n')
+        with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+            json.dump({'n_snps': n_snps, 'n_samples': len(sample_names), 'vcf_path': os.path.abspath(vcf_path)}, f)
+        print(f"Stored {n_snps} SNPs x {len(sample_names)} samples in {store_dir}")
+        return cls.open(store_dir)
+
+    @classmethod
+    def open(cls, store_dir):
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        with open(os.path.join(store_dir, 'samples.txt')) as f:
+            sample_names = [_.rstrip() for _ in f if _.strip()]
+        snp_df = pd.read_csv(os.path.join(store_dir, 'snps.tsv'), sep='\t', dtype={'scaffold': str, 'id': str})
+        packed = np.memmap(
+            os.path.join(store_dir, 'genotypes.bin'), dtype=np.uint8, mode='r',
+            shape=(meta['n_snps'], (meta['n_samples'] + 3) // 4))
+        return cls(store_dir, packed, snp_df, sample_names)
+
+    def subset(self, samples=None, snps=None, scaffolds=None):
+        """
+        :param samples: sample names (in the order wanted) or a boolean mask over the current samples
+        :param snps: SNP positions (indices into the current SNPs) or a boolean mask over the current SNPs
+        :param scaffolds: scaffold names to keep
+        """
+        snp_rows = self.snp_rows
+        sample_cols = None if self._all_samples else self.sample_cols
+        if samples is not None:
+            samples = np.asarray(samples)
+            if samples.dtype == bool:
+                sample_cols = self.sample_cols[samples]
+            else:
+                name_to_col_dict = {n: c for n, c in zip(self.sample_names, self.sample_cols)}
+                missing = [_ for _ in samples if _ not in name_to_col_dict]
+                if missing:
+                    raise KeyError(f"{len(missing)} samples are not in the store e.g. {missing[:3]}")
+                sample_cols = np.array([name_to_col_dict[_] for _ in samples], dtype=np.int64)
+        if snps is not None:
+            snp_rows = snp_rows[np.asarray(snps)]
+        if scaffolds is not None:
+            keep = np.isin(self.snp_df['scaffold'].values, list(scaffolds))
+            if snps is not None:
+                keep = keep[np.asarray(snps)]
+            snp_rows = snp_rows[keep]
+        return GenotypeStore(
+            self.store_dir, self.packed, self._full_snp_df, self.all_sample_names, snp_rows, sample_cols)
+
+    def genotypes(self, snps=None):
+        """
+        The genotype codes (0, 1, 2 alternative alleles; 3 missing) as an n_snps x n_samples uint8 array.
+        :param snps: optional positions (or slice) of the current SNPs to unpack
+        """
+        rows = self.snp_rows if snps is None else self.snp_rows[snps]
+        codes = unpack_genotypes(np.asarray(self.packed[rows]), len(self.all_sample_names))
+        return codes if self._all_samples else codes[:, self.sample_cols]
+
+    def iter_blocks(self, block_snps=10000):
+        """Yield (start position, genotype codes) for consecutive blocks of block_snps SNPs"""
+        for start in range(0, self.n_snps, block_snps):
+            yield start, self.genotypes(slice(start, start + block_snps))
+
+    def allele_counts(self, block_snps=10000):
+        """:return: (per SNP alternative allele count, per SNP number of called (non missing) samples)"""
+        alt = np.empty(self.n_snps, dtype=np.int64)
+        called = np.empty(self.n_snps, dtype=np.int64)
+        for start, codes in self.iter_blocks(block_snps):
+            is_called = codes != MISSING
+            alt[start:start + len(codes)] = np.where(is_called, codes, 0).sum(axis=1)
+            called[start:start + len(codes)] = is_called.sum(axis=1)
+        return alt, called
+
+    def maf(self):
+        """Per SNP minor allele frequency (of the current samples). NaN where no sample is called."""
+        alt, called = self.allele_counts()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            p = alt / (2 * called)
+        return np.minimum(p, 1 - p)
+
+    def missing_rate(self):
+        _, called = self.allele_counts()
+        return 1 - called / self.n_samples
+
+    def filter_maf(self, min_maf):
+        """The SNPs with a minor allele frequency (in the current samples) of at least min_maf"""
+        return self.subset(snps=np.flatnonzero(self.maf() >= min_maf))
+
+    def dosage(self, snps=None):
+        """Genotypes as float alternative allele dosages with NaN for missing"""
+        codes = self.genotypes(snps).astype(np.float32)
+        codes[codes == MISSING] = np.nan
+        return codes
+
+
+def read_strata(strata_path):
+    """
+    Series of sample name to stratum from a genclust.strata file (INDIVIDUALS,STRATA), comma or
+    whitespace separated (e.g. spis.genclust.strata.K6.tsv)
+    """
+    return pd.read_csv(strata_path, sep=r'[,\s]+', engine='python', index_col=0)['STRATA']
+
+
+def randomized_pca(store, n_components=20, n_oversample=10, n_iter=4, block_snps=10000, seed=42):
+    """
+    PCA of the standardised genotypes (as plink --pca: the eigenvectors of the genetic relationship matrix
+    X'X / n_snps where X holds, per SNP, (dosage - 2p) / sqrt(2p(1 - p)) and 0 for missing genotypes).
+
+    Only the top components are computed, with a randomized range finder and n_iter power iterations.
+    Every product with X'X is accumulated over blocks of block_snps SNPs so the memory needed is that of one
+    block plus n_samples x (n_components + n_oversample).
+    :return: (df of the sample eigenvectors (samples x PC1..PCk), eigenvalues, sum of all the eigenvalues)
+    """
+    alt, called = store.allele_counts(block_snps)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p = alt / (2 * called)
+    polymorphic = (p > 0) & (p < 1)
+    store = store.subset(snps=np.flatnonzero(polymorphic))
+    p = p[polymorphic]
+    scale = 1 / np.sqrt(2 * p * (1 - p))
+    n_samples = store.n_samples
+    total_variance = [0.0]
+
+    def standardised_blocks():
+        for start, codes in store.iter_blocks(block_snps):
+            block = slice(start, start + len(codes))
+            x = (codes - 2 * p[block, None]) * scale[block, None]
+            x[codes == MISSING] = 0
+            yield x
+
+    def gram_product(q):
+        y = np.zeros_like(q)
+        total_variance[0] = 0.0
+        for x in standardised_blocks():
+            y += x.T @ (x @ q)
+            total_variance[0] += np.einsum('ij,ij->', x, x)
+        return y
+
+    rng = np.random.default_rng(seed)
+    n_basis = min(n_components + n_oversample, n_samples)
+    y = gram_product(rng.standard_normal((n_samples, n_basis)))
+    for _ in range(n_iter):
+        y = gram_product(np.linalg.qr(y)[0])
+    q = np.linalg.qr(y)[0]
+    eigenvalues, vectors = np.linalg.eigh(q.T @ gram_product(q))
+    order = np.argsort(eigenvalues)[::-1][:n_components]
+    eigenvectors = q @ vectors[:, order]
+    # A deterministic sign: the largest loading of each component is positive
+    eigenvectors *= np.sign(eigenvectors[np.abs(eigenvectors).argmax(axis=0), np.arange(eigenvectors.shape[1])])
+    pc_df = pd.DataFrame(
+        eigenvectors, index=store.sample_names, columns=[f'PC{_ + 1}' for _ in range(eigenvectors.shape[1])])
+    return pc_df, eigenvalues[order] / store.n_snps, total_variance[0] / store.n_snps
+
+
+def write_plink_pca(pc_df, eigenvalues, prefix):
+    """Write {prefix}.eigenvec and {prefix}.eigenval in the plink --pca format read by 06_*_PCAstructure.R"""
+    with open(f"{prefix}.eigenvec", 'w') as f:
+        for sample_name, row in pc_df.iterrows():
+            f.write(' '.join([sample_name, sample_name] + [f"{_:.6g}" for _ in row.values]) + '\n')
+    with open(f"{prefix}.eigenval", 'w') as f:
+        f.write('\n'.join(f"{_:.6g}" for _ in eigenvalues) + '\n')
+
+
+def read_plink_pca(prefix):
+    """:return: (df of the sample eigenvectors, eigenvalues) from {prefix}.eigenvec and {prefix}.eigenval"""
+    pc_df = pd.read_csv(f"{prefix}.eigenvec", sep=r'\s+', header=None)
+    pc_df = pc_df.drop(columns=[1]).set_index(0)
+    pc_df.index.name = None
+    pc_df.columns = [f'PC{_ + 1}' for _ in range(pc_df.shape[1])]
+    return pc_df, np.loadtxt(f"{prefix}.eigenval", ndmin=1)
+
+
+# Per worker process state for the LD jobs: the genotype store opened once by _init_genotype_worker
+_GENOTYPE_SHARED = {}
+
+
+def _init_genotype_worker(store_dir):
+    _GENOTYPE_SHARED['store'] = GenotypeStore.open(store_dir)
+
+
+def _pairwise_complete_r2(x_a, m_a, x_b, m_b):
+    """
+    r2 (squared Pearson correlation of the dosages) between every SNP of block a and every SNP of block b
+    using, for each pair, only the samples called at both SNPs (as plink --r2 does).
+    x are the dosages with 0 where missing and m the called masks (n_snps x n_samples float arrays).
+    """
+    n = m_a @ m_b.T
+    s_a = x_a @ m_b.T
+    s_b = m_a @ x_b.T
+    cov = x_a @ x_b.T - s_a * s_b / n
+    var_a = (x_a * x_a) @ m_b.T - s_a ** 2 / n
+    var_b = m_a @ (x_b * x_b).T - s_b ** 2 / n
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r2 = cov ** 2 / (var_a * var_b)
+    r2[(n < 2) | (var_a <= 1e-12) | (var_b <= 1e-12)] = np.nan
+    return np.clip(r2, 0, 1)
+
+
+def _ld_scaffold_job(sample_names, scaffold, min_maf, max_dist, bin_width, n_r2_bins, block_snps):
+    """
+    Bin the r2 of all pairs of SNPs on one scaffold that are at most max_dist bp apart.
+    Pairs are computed block by block (blocks of block_snps consecutive SNPs) and only blocks within max_dist
+    of each other are compared. Nothing per pair is kept: each block pair is added to the per distance bin
+    r2 sums, pair counts and r2 histograms (n_r2_bins bins over [0, 1], used for the medians).
+    :return: (scaffold, number of SNPs, r2 sums, pair counts, r2 histograms)
+    """
+    n_dist_bins = int(np.ceil(max_dist / bin_width))
+    r2_sum = np.zeros(n_dist_bins)
+    pair_count = np.zeros(n_dist_bins, dtype=np.int64)
+    r2_hist = np.zeros((n_dist_bins, n_r2_bins), dtype=np.int64)
+    store = _GENOTYPE_SHARED['store'].subset(samples=sample_names, scaffolds=[scaffold])
+    if store.n_snps:
+        store = store.filter_maf(min_maf)
+    positions = store.snp_df['pos'].values
+    order = np.argsort(positions, kind='stable')
+    positions = positions[order]
+    if store.n_snps < 2:
+        return scaffold, store.n_snps, r2_sum, pair_count, r2_hist
+    codes = store.genotypes()[order]
+    called = (codes != MISSING).astype(np.float64)
+    dosage = np.where(codes != MISSING, codes, 0).astype(np.float64)
+
+    starts = list(range(0, len(positions), block_snps))
+    for i, a in enumerate(starts):
+        a_slice = slice(a, a + block_snps)
+        for b in starts[i:]:
+            b_slice = slice(b, b + block_snps)
+            if positions[b] - positions[a_slice][-1] > max_dist:
+                break
+            r2 = _pairwise_complete_r2(dosage[a_slice], called[a_slice], dosage[b_slice], called[b_slice])
+            dist = positions[b_slice][None, :] - positions[a_slice][:, None]
+            keep = (dist <= max_dist) & ~np.isnan(r2)
+            if a == b:
+                keep &= np.triu(np.ones_like(keep), k=1)
+            dist, r2 = dist[keep], r2[keep]
+            # Right closed bins as in 08b (cut(..., include.lowest=T, right=T)): [0, w], (w, 2w] ...
+            dist_bin = np.clip(np.ceil(dist / bin_width).astype(np.int64) - 1, 0, n_dist_bins - 1)
+            r2_bin = np.minimum((r2 * n_r2_bins).astype(np.int64), n_r2_bins - 1)
+            r2_sum += np.bincount(dist_bin, weights=r2, minlength=n_dist_bins)
+            pair_count += np.bincount(dist_bin, minlength=n_dist_bins)
+            r2_hist += np.bincount(
+                dist_bin * n_r2_bins + r2_bin, minlength=n_dist_bins * n_r2_bins).reshape(n_dist_bins, n_r2_bins)
+    return scaffold, store.n_snps, r2_sum, pair_count, r2_hist
+
+
+def _hist_median(r2_hist):
+    """Per row median of r2 histograms (interpolated within the histogram bin)"""
+    n_r2_bins = r2_hist.shape[1]
+    cum = np.cumsum(r2_hist, axis=1)
+    total = cum[:, -1]
+    half = total / 2
+    median_bin = np.argmax(cum >= half[:, None], axis=1)
+    below = np.where(median_bin > 0, cum[np.arange(len(cum)), median_bin - 1], 0)
+    in_bin = r2_hist[np.arange(len(cum)), median_bin]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        median = (median_bin + (half - below) / in_bin) / n_r2_bins
+    median[total == 0] = np.nan
+    return median
+
+
+class LDDecay:
+    """
+    LD (r2) decay per genetic cluster on the largest scaffolds, replacing the all pairs plink --r2 runs of
+    08a_*_LDanalysis.sh and the binning of 08b_*_LDvisualization.R.
+
+    For each cluster (a vcftools --keep style list of samples) the SNPs are MAF filtered within the cluster
+    (vcftools --maf) and the r2 of every pair of SNPs on a scaffold within max_dist bp is binned by distance
+    (bins of bin_width bp). Each (cluster, scaffold) pair is a job run across n_proc processes (or nodes with a
+    backend, see buitrago_jobs.get_backend).
+    A 'mean' curve pools the pairs of all clusters (as the rbind of the clusters in 08b).
+
+    Outputs {prefix}.LDdecay.bins.tsv (cluster, start, end, mid, mean, median, n_pairs) and
+    {prefix}.LDdecay.pdf/.png.
+
+    e.g.
+        LDDecay(
+            store_dir='spis_genotypes', cluster_dict={f'SCL{i}': f'K6/SCL{i}.txt' for i in range(1, 7)},
+            scaffolds=read_scaffold_list('Spis.10largest.Scaffolds'), prefix='spis')
+    """
+    def __init__(
+            self, store_dir, cluster_dict, scaffolds=None, prefix='LD', min_maf=0.05, max_dist=100000, bin_width=100,
+            n_r2_bins=200, block_snps=2000, n_proc=None, colors=None, backend=None
+    ):
+        """
+        :param cluster_dict: cluster name to a list of sample names or the path of a file listing them
+        :param scaffolds: the scaffolds to use (default all)
+        """
+        self.store_dir = store_dir
+        self.prefix = prefix
+        self.bin_width = bin_width
+        self.n_dist_bins = int(np.ceil(max_dist / bin_width))
+        store = GenotypeStore.open(store_dir)
+        self.cluster_sample_dict = {
+            cluster: self._cluster_samples(samples, store) for cluster, samples in cluster_dict.items()}
+        if scaffolds is None:
+            scaffolds = list(store.snp_df['scaffold'].unique())
+        self.scaffolds = list(scaffolds)
+
+        self.r2_sum = {_: np.zeros(self.n_dist_bins) for _ in self.cluster_sample_dict}
+        self.pair_count = {_: np.zeros(self.n_dist_bins, dtype=np.int64) for _ in self.cluster_sample_dict}
+        self.r2_hist = {_: np.zeros((self.n_dist_bins, n_r2_bins), dtype=np.int64) for _ in self.cluster_sample_dict}
+        self.n_snps = {_: 0 for _ in self.cluster_sample_dict}
+        backend = _import_buitrago_jobs().get_backend(backend, n_proc)
+        job_clusters, job_args = [], []
+        for cluster, samples in self.cluster_sample_dict.items():
+            for scaffold in self.scaffolds:
+                job_clusters.append(cluster)
+                job_args.append((samples, scaffold, min_maf, max_dist, bin_width, n_r2_bins, block_snps))
+        job_results = backend.map(
+            _ld_scaffold_job, job_args, initializer=_init_genotype_worker, initargs=(os.path.abspath(store_dir),))
+        for cluster, (scaffold, n_snps, r2_sum, pair_count, r2_hist) in zip(job_clusters, job_results):
+            self.n_snps[cluster] += n_snps
+            self.r2_sum[cluster] += r2_sum
+            self.pair_count[cluster] += pair_count
+            self.r2_hist[cluster] += r2_hist
+        for cluster, n_snps in self.n_snps.items():
+            print(f"{cluster}: {n_snps} SNPs with MAF >= {min_maf} on {len(self.scaffolds)} scaffolds")
+
+        self.bins_df = self.make_bins_df()
+        self.bins_df.to_csv(f"{prefix}.LDdecay.bins.tsv", sep='\t', index=False)
+        self.plot(colors)
+
+    @staticmethod
+    def _cluster_samples(samples, store):
+        if isinstance(samples, str):
+            with open(samples) as f:
+                samples = [vcf_sample_name_to_strata_name(_.split()[0]) for _ in f if _.strip()]
+        in_store = set(store.sample_names)
+        return [_ for _ in samples if _ in in_store]
+
+    def make_bins_df(self):
+        starts = np.arange(self.n_dist_bins) * self.bin_width
+        clusters = list(self.cluster_sample_dict) + ['mean']
+        dfs = []
+        for cluster in clusters:
+            if cluster == 'mean':
+                r2_sum, pair_count = sum(self.r2_sum.values()), sum(self.pair_count.values())
+                r2_hist = sum(self.r2_hist.values())
+            else:
+                r2_sum, pair_count, r2_hist = self.r2_sum[cluster], self.pair_count[cluster], self.r2_hist[cluster]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = r2_sum / pair_count
+            dfs.append(pd.DataFrame({
+                'cluster': cluster, 'start': starts, 'end': starts + self.bin_width,
+                'mid': starts + self.bin_width / 2, 'mean': mean, 'median': _hist_median(r2_hist),
+                'n_pairs': pair_count
+            }))
+        return pd.concat(dfs, ignore_index=True)
+
+    def plot(self, colors=None):
+        fig, ax = plt.subplots(figsize=(7, 4))
+        clusters = list(self.bins_df['cluster'].unique())
+        if colors is None:
+            colors = list(plt.get_cmap('tab10').colors[:len(clusters) - 1]) + ['black']
+        for cluster, color in zip(clusters, colors):
+            cluster_df = self.bins_df[(self.bins_df['cluster'] == cluster) & (self.bins_df['n_pairs'] > 0)]
+            ax.plot(cluster_df['start'], cluster_df['mean'], color=color, linewidth=0.75, label=cluster)
+            ax.scatter(cluster_df['start'], cluster_df['mean'], color=color, s=2, alpha=0.5)
+        ax.set_xlabel('Distance (kilobases)')
+        ax.set_ylabel('LD (r$^2$)')
+        ax.xaxis.set_major_formatter(mpl.ticker.FuncFormatter(lambda x, _: f"{x / 1000:g}"))
+        ax.set_ylim(0, 0.5)
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.legend(fontsize='x-small', frameon=False)
+        ax.set_title(f"LD decay (mean r2) - {self.prefix}")
+        plt.savefig(f"{self.prefix}.LDdecay.pdf")
+        plt.savefig(f"{self.prefix}.LDdecay.png", dpi=600)
+        plt.close(fig)
+
+
+def read_scaffold_list(path):
+    """Scaffold names, one per line (e.g. Spis.10largest.Scaffolds)"""
+    with open(path) as f:
+        return [_.split()[0] for _ in f if _.strip()]
+
+
+# The reef order used for the pairwise FST matrices (as in 04_*_PairwiseFST.R)
+REEF_ORDER = [
+    'MAQ-R1', 'MAQ-R2', 'WAJ-R1', 'WAJ-R3', 'WAJ-R4', 'YAN-R1', 'YAN-R3', 'YAN-R4', 'KAU-R1', 'KAU-R2', 'KAU-R3',
+    'DOG-R1', 'DOG-R2', 'DOG-R3', 'FAR-R1', 'FAR-R2', 'FAR-R3', 'FAR-R4'
+]
+
+
+def population_allele_summaries(store, sample_to_pop, pops, block_snps=10000):
+    """
+    Per population and SNP, the number of called individuals, alternative allele count and heterozygote count.
+    :param sample_to_pop: dict (or Series) of sample name to population
+    :return: three n_pops x n_snps arrays (n, alt, het)
+    """
+    samples = [_ for _ in store.sample_names if _ in sample_to_pop]
+    store = store.subset(samples=samples)
+    pop_index = np.array([pops.index(sample_to_pop[_]) for _ in samples])
+    # Sample to population indicator used to sum over the samples of each population with one product per block
+    indicator = np.zeros((len(samples), len(pops)))
+    indicator[np.arange(len(samples)), pop_index] = 1
+    n = np.empty((len(pops), store.n_snps))
+    alt = np.empty_like(n)
+    het = np.empty_like(n)
+    for start, codes in store.iter_blocks(block_snps):
+        block = slice(start, start + len(codes))
+        n[:, block] = ((codes != MISSING) @ indicator).T
+        alt[:, block] = (np.where(codes != MISSING, codes, 0) @ indicator).T
+        het[:, block] = ((codes == 1) @ indicator).T
+    return n, alt, het
+
+
+def weir_cockerham_components(n, alt, het, pair_i, pair_j):
+    """
+    The per SNP Weir & Cockerham (1984) variance components a, b and c for each pair of populations.
+    FST of a pair (over a set of SNPs) is sum(a) / sum(a + b + c).
+    :param n, alt, het: n_pops x n_snps summaries from population_allele_summaries
+    :param pair_i, pair_j: the population indices of each pair
+    :return: (a, a + b + c) as n_pairs x n_snps arrays, 0 at the SNPs not called in at least 2 individuals of both
+    """
+    n_1, n_2 = n[pair_i], n[pair_j]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p_1, p_2 = alt[pair_i] / (2 * n_1), alt[pair_j] / (2 * n_2)
+        h_1, h_2 = het[pair_i] / n_1, het[pair_j] / n_2
+        n_bar = (n_1 + n_2) / 2
+        n_c = 2 * n_bar - (n_1 ** 2 + n_2 ** 2) / (2 * n_bar)
+        p_bar = (n_1 * p_1 + n_2 * p_2) / (2 * n_bar)
+        s2 = (n_1 * (p_1 - p_bar) ** 2 + n_2 * (p_2 - p_bar) ** 2) / n_bar
+        h_bar = (n_1 * h_1 + n_2 * h_2) / (2 * n_bar)
+        pq = p_bar * (1 - p_bar)
+        a = n_bar / n_c * (s2 - (pq - s2 / 2 - h_bar / 4) / (n_bar - 1))
+        b = n_bar / (n_bar - 1) * (pq - s2 / 2 - (2 * n_bar - 1) / (4 * n_bar) * h_bar)
+        c = h_bar / 2
+    abc = a + b + c
+    bad = (n_1 < 2) | (n_2 < 2) | ~np.isfinite(a) | ~np.isfinite(abc)
+    a[bad] = 0
+    abc[bad] = 0
+    return a, abc
+
+
+# Shared state for the FST bootstrap workers. See _fst_worker_init.
+_FST_SHARED = {}
+
+
+def _fst_worker_init(a, abc):
+    _FST_SHARED['a'] = a
+    _FST_SHARED['abc'] = abc
+
+
+def _fst_bootstrap_chunk(seed, n_boot):
+    """
+    FST of every pair for n_boot bootstrap resamplings of the SNPs.
+    Each resampling is a vector of the number of times each SNP is drawn so that the resampled sums of the
+    components of all pairs are a single matrix product.
+    :return: n_pairs x n_boot array
+    """
+    rng = np.random.default_rng(seed)
+    a, abc = _FST_SHARED['a'], _FST_SHARED['abc']
+    n_snps = a.shape[1]
+    weights = np.stack([np.bincount(rng.integers(0, n_snps, n_snps), minlength=n_snps) for _ in range(n_boot)])
+    weights = weights.T.astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (a @ weights) / (abc @ weights)
+
+
+def _import_buitrago_jobs():
+    """The job backends shared with the ITS2 analyses (ITS2/buitrago_jobs.py)"""
+    its2_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ITS2')
+    if its2_dir not in sys.path:
+        sys.path.append(its2_dir)
+    import buitrago_jobs
+    return buitrago_jobs
+
+
+class PairwiseFST:
+    """
+    Weir & Cockerham (1984) pairwise FST between all populations with bootstrap (over SNPs) confidence intervals,
+    replacing StAMPP stamppFst(nboots=1000, percent=95) in 04_*_PairwiseFST.R.
+
+    The genotypes are read once into per population summaries (called individuals, alternative allele and
+    heterozygote counts per SNP) from which the components of all pairs are computed at once. The bootstraps are
+    run in chunks across n_proc processes (or nodes with a backend, see buitrago_jobs.get_backend).
+
+    Outputs (in the format of 04_*_PairwiseFST.R):
+        {prefix}.fst.value.tsv: FST rounded to 3 decimals (populations[:-1] x populations[1:], upper triangle)
+        {prefix}.fst.ci95.{n_boot}perm.tsv: the CI as lower-upper (populations[1:] x populations[:-1], lower triangle)
+        {prefix}.fst.bootstraps.tsv: population pairs with the FST, CI limits and bootstrap p-value (unrounded)
+
+    e.g.
+        PairwiseFST(store_dir='spis_genotypes', strata_path='spis.genclust.strata', prefix='spis')
+    """
+    def __init__(
+            self, store_dir, strata_path, prefix, n_boot=1000, percent=95, n_proc=None, seed=42, pop_order=None,
+            chunk_boot=25, backend=None
+    ):
+        self.prefix = prefix
+        self.n_boot = n_boot
+        self.percent = percent
+        self.seed = seed
+        self.n_proc = n_proc if n_proc else os.cpu_count()
+        self.chunk_boot = chunk_boot
+        self.jobs = _import_buitrago_jobs()
+        self.backend = self.jobs.get_backend(backend, self.n_proc)
+        store = GenotypeStore.open(store_dir)
+        strata = read_strata(strata_path)
+        strata = strata[strata.index.isin(store.sample_names)]
+        if pop_order is None:
+            pop_order = REEF_ORDER
+        self.pops = [_ for _ in pop_order if _ in set(strata)] + sorted(set(strata).difference(pop_order))
+        print(f"{len(strata)} samples in {len(self.pops)} populations, {store.n_snps} SNPs")
+
+        n, alt, het = population_allele_summaries(store, strata.to_dict(), self.pops)
+        self.pair_i, self.pair_j = np.tril_indices(len(self.pops), k=-1)
+        self.a, self.abc = weir_cockerham_components(n, alt, het, self.pair_i, self.pair_j)
+        self.fst = self.a.sum(axis=1) / self.abc.sum(axis=1)
+        self.boot_fst = self._bootstrap()
+
+        self.fst_df = self.make_fst_df()
+        self.fst_df.to_csv(f"{prefix}.fst.bootstraps.tsv", sep='\t', index=False)
+        self.write_matrices()
+
+    def _bootstrap(self):
+        seeds, chunk_sizes = self.jobs.seeded_chunks(self.seed, self.n_boot, self.n_boot // self.chunk_boot)
+        boot_arrays = self.backend.map(
+            _fst_bootstrap_chunk, zip(seeds, chunk_sizes), initializer=_fst_worker_init, initargs=(self.a, self.abc))
+        return np.concatenate(boot_arrays, axis=1)
+
+    def make_fst_df(self):
+        tail = (100 - self.percent) / 2
+        lower, upper = np.nanpercentile(self.boot_fst, [tail, 100 - tail], axis=1)
+        return pd.DataFrame({
+            'Population1': [self.pops[_] for _ in self.pair_i],
+            'Population2': [self.pops[_] for _ in self.pair_j],
+            'Fst': self.fst, 'lower': lower, 'upper': upper,
+            # As StAMPP: the proportion of bootstraps with an FST of 0 or less
+            'p_value': np.mean(self.boot_fst <= 0, axis=1)
+        })
+
+    def write_matrices(self):
+        ci_df = pd.DataFrame(index=self.pops[1:], columns=self.pops[:-1], dtype=object)
+        value_df = pd.DataFrame(index=self.pops[:-1], columns=self.pops[1:], dtype=object)
+        for pop_1, pop_2, fst, lower, upper in self.fst_df[
+                ['Population1', 'Population2', 'Fst', 'lower', 'upper']].itertuples(index=False):
+            ci_df.at[pop_1, pop_2] = f"{lower:.3f}-{upper:.3f}"
+            value_df.at[pop_2, pop_1] = f"{fst:.3f}"
+        self._write_r_table(ci_df, f"{self.prefix}.fst.ci95.{self.n_boot}perm.tsv")
+        self._write_r_table(value_df, f"{self.prefix}.fst.value.tsv")
+
+    @staticmethod
+    def _write_r_table(df, path):
+        """Write as R write.table(quote=F, sep='\\t') does: no header cell above the row names and NA for missing"""
+        with open(path, 'w') as f:
+            f.write('\t'.join(df.columns) + '\n')
+            for row_name, row in df.iterrows():
+                f.write('\t'.join([row_name] + ['NA' if pd.isna(_) else _ for _ in row.values]) + '\n')
+
+
+def weir_cockerham_locus_components(n, alt, het):
+    """
+    The per SNP Weir & Cockerham (1984) variance components over all populations at once
+    (weir_cockerham_components is the special case of 2 populations). Populations without any called individual
+    at a SNP are left out of that SNP. The FST of a SNP is a / (a + b + c).
+    :param n, alt, het: n_pops x n_snps summaries from population_allele_summaries
+    :return: (a, a + b + c) arrays of n_snps, nan at the SNPs called in fewer than 2 populations
+    """
+    called = n > 0
+    r = called.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p = np.where(called, alt / (2 * n), 0)
+        h = np.where(called, het / n, 0)
+        n_bar = n.sum(axis=0) / r
+        n_c = (r * n_bar - (n ** 2).sum(axis=0) / (r * n_bar)) / (r - 1)
+        p_bar = (n * p).sum(axis=0) / (r * n_bar)
+        s2 = (n * (p - p_bar) ** 2).sum(axis=0) / ((r - 1) * n_bar)
+        h_bar = (n * h).sum(axis=0) / (r * n_bar)
+        pq = p_bar * (1 - p_bar)
+        a = n_bar / n_c * (s2 - (pq - (r - 1) / r * s2 - h_bar / 4) / (n_bar - 1))
+        b = n_bar / (n_bar - 1) * (pq - (r - 1) / r * s2 - (2 * n_bar - 1) / (4 * n_bar) * h_bar)
+        c = h_bar / 2
+    abc = a + b + c
+    bad = (r < 2) | ~np.isfinite(a) | ~np.isfinite(abc)
+    a[bad] = np.nan
+    abc[bad] = np.nan
+    return a, abc
+
+
+def standardized_frequencies(n, alt):
+    """
+    The population allele frequencies of every SNP standardized by the mean frequency (pi) over the populations:
+    (p - pi) / sqrt(pi (1 - pi)), the scale on which the XtX of BayPass is defined (Gunther & Coop 2013).
+    :return: (n_pops x n_snps standardized frequencies, pi), nan at SNPs with an uncalled population
+    or a pi of 0 or 1
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p = alt / (2 * n)
+        pi = p.mean(axis=0)
+        return (p - pi) / np.sqrt(pi * (1 - pi)), pi
+
+
+def xtx_statistic(y, omega_pinv):
+    """The XtX like statistic y' Omega^-1 y of every SNP (column of the standardized frequencies y)"""
+    return np.einsum('il,ij,jl->l', y, omega_pinv, y)
+
+
+def _locus_fst(n, alt, het):
+    a, abc = weir_cockerham_locus_components(n, alt, het)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return a / abc
+
+
+# Shared state for the outlier null simulation workers. See OutlierScan._simulate_null.
+_OUTLIER_SHARED = {}
+
+
+def _outlier_worker_init(n, pi, drift_sqrt, omega_pinv, f_is, min_maf):
+    _OUTLIER_SHARED.update(
+        n=n, pi=pi, drift_sqrt=drift_sqrt, omega_pinv=omega_pinv, f_is=f_is, min_maf=min_maf)
+
+
+def _outlier_null_chunk(seed, n_sim):
+    """
+    Simulate n_sim neutral SNPs and return their FST and XtX.
+    Every simulated SNP takes the per population sample sizes and mean allele frequency (pi) of a random observed
+    SNP (locus resampling). The population frequencies are drawn around pi with the covariance of the drift between
+    the populations (as BayPass' simulate.baypass), the genotypes drawn per population with the observed F_IS and
+    the statistics computed as for the observed SNPs. Simulated SNPs that are monomorphic (or below min_maf) are
+    dropped as they would be from the data.
+    :return: (fst, xtx) arrays
+    """
+    s = _OUTLIER_SHARED
+    rng = np.random.default_rng(seed)
+    loci = rng.integers(0, s['pi'].shape[0], n_sim)
+    n, pi = s['n'][:, loci], s['pi'][loci]
+    y = s['drift_sqrt'] @ rng.standard_normal((s['drift_sqrt'].shape[1], n_sim))
+    p = np.clip(pi + np.sqrt(pi * (1 - pi)) * y, 0, 1)
+    q = 1 - p
+    f_is = s['f_is']
+    genotype_probs = np.stack([p ** 2 + f_is * p * q, 2 * p * q * (1 - f_is), q ** 2 + f_is * p * q], axis=-1)
+    genotype_counts = rng.multinomial(n.astype(np.int64), np.clip(genotype_probs, 0, None))
+    het = genotype_counts[..., 1].astype(float)
+    alt = 2 * genotype_counts[..., 0] + het
+    total_alt = alt.sum(axis=0) / (2 * n.sum(axis=0))
+    keep = np.minimum(total_alt, 1 - total_alt) > s['min_maf']
+    n, alt, het = n[:, keep], alt[:, keep], het[:, keep]
+    y, _ = standardized_frequencies(n, alt)
+    return _locus_fst(n, alt, het), xtx_statistic(y, s['omega_pinv'])
+
+
+def scaffold_id(scaffold):
+    """The scaffold number as in the SNP id dictionaries of 09a e.g. Spis.scaffold123|size4567 -> 123"""
+    return re.sub(r'^(Spis\.scaffold|Pver_Sc)', '', re.sub(r'[|_]size.*$', '', scaffold))
+
+
+class OutlierScan:
+    """
+    Per SNP FST and XtX outlier scan, a fast pre-screen of the candidate SNPs of the BayeScan and BayPass runs
+    of 09a-09c, and the writer of their input files.
+
+    The genotypes are read once into per population summaries (see population_allele_summaries). For every SNP
+    the multi population Weir & Cockerham FST and an XtX like statistic (the standardized allele frequencies
+    scaled by the inverse of their covariance between populations estimated over all SNPs, Gunther & Coop 2013)
+    are computed at once. Both are calibrated against a null of n_sim simulated neutral SNPs (see
+    _outlier_null_chunk), simulated in chunks across n_proc processes (or nodes with a backend, see
+    buitrago_jobs.get_backend), as the POD calibration of 09b: SNPs above the upper_quantile of the null XtX
+    are candidates for positive selection and below the lower_quantile for balancing selection.
+
+    Outputs:
+        {prefix}.outliers.tsv: every SNP with its FST, XtX, their empirical p-values and the selection call
+        {prefix}.outliers.candidates.tsv: the SNPs called positive or balancing or with an FST above the
+        upper_quantile of the null FST
+        {prefix}.bayescan, {prefix}.baypass, {prefix}.snps.id.dictionary.BAYESCAN.txt,
+        {prefix}.snps.id.dictionary.BAYPASS.txt and {prefix}.monomorphicsnpsindex2remove.txt as made in 09a
+        (the BayPass file and dictionary without the monomorphic SNPs)
+
+    e.g.
+        OutlierScan(store_dir='spis_genotypes', strata_path='spis.genclust.strata.K6.tsv', prefix='spis.popgenclust')
+    """
+    def __init__(
+            self, store_dir, strata_path, prefix, n_sim=100000, upper_quantile=0.999, lower_quantile=0.001,
+            min_maf=0, omega_min_maf=0.1, n_proc=None, seed=31689, pop_order=None, write_inputs=True, backend=None
+    ):
+        """
+        :param min_maf: the SNPs (observed and simulated) with a minor allele frequency <= min_maf are not scanned
+        :param omega_min_maf: the minimum minor allele frequency of the SNPs the covariance between the populations
+        is estimated from
+        """
+        self.prefix = prefix
+        self.n_sim = n_sim
+        self.upper_quantile = upper_quantile
+        self.lower_quantile = lower_quantile
+        self.min_maf = min_maf
+        self.omega_min_maf = omega_min_maf
+        self.seed = seed
+        self.n_proc = n_proc if n_proc else os.cpu_count()
+        self.jobs = _import_buitrago_jobs()
+        self.backend = self.jobs.get_backend(backend, self.n_proc)
+        store = GenotypeStore.open(store_dir)
+        strata = read_strata(strata_path)
+        strata = strata[strata.index.isin(store.sample_names)]
+        if pop_order is None:
+            pop_order = REEF_ORDER
+        self.pops = [_ for _ in pop_order if _ in set(strata)] + sorted(set(strata).difference(pop_order))
+        print(f"{len(strata)} samples in {len(self.pops)} populations, {store.n_snps} SNPs")
+
+        self.snp_df = store.snp_df.reset_index(drop=True)
+        self.n, self.alt, self.het = population_allele_summaries(store, strata.to_dict(), self.pops)
+        if write_inputs:
+            self.write_bayescan_baypass()
+
+        self.scan_df = self.scan()
+        self.scan_df.to_csv(f"{prefix}.outliers.tsv", sep='\t', index=False)
+        candidates_df = self.scan_df[(self.scan_df['selection'] != 'neutral') | self.scan_df['fst_outlier']]
+        candidates_df.to_csv(f"{prefix}.outliers.candidates.tsv", sep='\t', index=False)
+        print(
+            f"{(self.scan_df['selection'] == 'positive').sum()} candidates for positive and "
+            f"{(self.scan_df['selection'] == 'balancing').sum()} for balancing selection (XtX), "
+            f"{self.scan_df['fst_outlier'].sum()} FST outliers")
+
+    def _polymorphic(self):
+        """The SNPs with a minor allele frequency (over all populations) > min_maf i.e. polymorphic by default"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            total_alt = self.alt.sum(axis=0) / (2 * self.n.sum(axis=0))
+        return np.minimum(total_alt, 1 - total_alt) > self.min_maf
+
+    def scan(self):
+        """The observed statistics, the null and the per SNP p-values and selection calls"""
+        fst = _locus_fst(self.n, self.alt, self.het)
+        y, pi = standardized_frequencies(self.n, self.alt)
+        # The SNPs used for the covariance and as the templates of the null: polymorphic and called in every population
+        informative = self._polymorphic() & np.isfinite(y).all(axis=0)
+        y_informative = y[:, informative]
+        # The covariance is estimated from the SNPs of intermediate frequency as the standardized frequencies of
+        # SNPs close to fixation are truncated (at 0 or 1) and would shrink it
+        common = np.minimum(pi[informative], 1 - pi[informative]) >= self.omega_min_maf
+        omega = y_informative[:, common] @ y_informative[:, common].T / common.sum()
+        # The standardized frequencies are centred on their mean so omega has rank n_pops - 1
+        omega_pinv = np.linalg.pinv(omega)
+        xtx = np.full(len(fst), np.nan)
+        xtx[informative] = xtx_statistic(y_informative, omega_pinv)
+        fst[~informative] = np.nan
+
+        null_fst, null_xtx = self._simulate_null(omega, omega_pinv, informative, pi)
+        null_fst, null_xtx = np.sort(null_fst[np.isfinite(null_fst)]), np.sort(null_xtx[np.isfinite(null_xtx)])
+        xtx_upper, xtx_lower = np.quantile(null_xtx, [self.upper_quantile, self.lower_quantile])
+        fst_upper = np.quantile(null_fst, self.upper_quantile)
+        print(
+            f"Null of {len(null_xtx)} simulated SNPs: XtX {self.lower_quantile} and {self.upper_quantile} quantiles "
+            f"{xtx_lower:.4f} and {xtx_upper:.4f}, FST {self.upper_quantile} quantile {fst_upper:.4f}")
+
+        with np.errstate(invalid='ignore'):
+            selection = np.where(xtx > xtx_upper, 'positive', np.where(xtx < xtx_lower, 'balancing', 'neutral'))
+            fst_outlier = fst > fst_upper
+        return pd.DataFrame({
+            'scaffold': self.snp_df['scaffold'], 'pos': self.snp_df['pos'], 'id': self.snp_df['id'],
+            # The marker index of the BayeScan input
+            'index': np.arange(1, len(fst) + 1),
+            'n': self.n.sum(axis=0).astype(int), 'pi': pi, 'fst': fst, 'xtx': xtx,
+            'p_fst': self._empirical_p(null_fst, fst), 'p_xtx': self._empirical_p(null_xtx, xtx),
+            'selection': np.where(informative, selection, 'NA'), 'fst_outlier': fst_outlier
+        })
+
+    @staticmethod
+    def _empirical_p(sorted_null, observed):
+        """The proportion of the null >= each observed value (with the observed counted as one of the null)"""
+        p = (len(sorted_null) - np.searchsorted(sorted_null, observed, side='left') + 1) / (len(sorted_null) + 1)
+        return np.where(np.isfinite(observed), p, np.nan)
+
+    def _simulate_null(self, omega, omega_pinv, informative, pi):
+        # The standardized frequencies vary with both the drift between the populations and the sampling of the
+        # individuals. Remove the (centred) sampling variance, (1 + F_IS) / 2n per population, to get the drift.
+        n = self.n[:, informative]
+        exp_het = 2 * pi[informative] * (1 - pi[informative]) * n
+        f_is = float(np.clip(1 - self.het[:, informative].sum() / exp_het.sum(), 0, 1))
+        n_pops = len(self.pops)
+        centre = np.eye(n_pops) - 1 / n_pops
+        sampling = centre @ np.diag(((1 + f_is) / (2 * n)).mean(axis=1)) @ centre
+        eigenvalues, eigenvectors = np.linalg.eigh(omega - sampling)
+        drift_sqrt = eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))
+
+        seeds, chunk_sizes = self.jobs.seeded_chunks(self.seed, self.n_sim, self.backend.n_chunks)
+        results = self.backend.map(
+            _outlier_null_chunk, zip(seeds, chunk_sizes), initializer=_outlier_worker_init,
+            initargs=(n, pi[informative], drift_sqrt, omega_pinv, f_is, self.min_maf))
+        return np.concatenate([_[0] for _ in results]), np.concatenate([_[1] for _ in results])
+
+    def write_bayescan_baypass(self):
+        """
+        Write the BayeScan input (as hierfstat's write.bayescan: per population the number of gene copies, the number
+        of alleles and the count of each allele of every SNP), the BayPass genotype file (a line per polymorphic SNP
+        with the reference and alternative allele counts of each population) and the SNP id dictionaries.
+        """
+        ref = (2 * self.n - self.alt).astype(int)
+        alt = self.alt.astype(int)
+        ref_present, alt_present = ref.sum(axis=0) > 0, alt.sum(axis=0) > 0
+        n_alleles = ref_present.astype(int) + alt_present
+        with open(f"{self.prefix}.bayescan", 'w') as f:
+            f.write(f"[loci]={self.n.shape[1]}\n\n[populations]={len(self.pops)}\n\n")
+            for i in range(len(self.pops)):
+                f.write(f"[pop]={i + 1}\n")
+                for j, (ref_count, alt_count) in enumerate(zip(ref[i], alt[i])):
+                    # Only the alleles found in any population are listed, as write.bayescan
+                    counts = [
+                        str(count) for count, present in [(ref_count, ref_present[j]), (alt_count, alt_present[j])]
+                        if present
+                    ]
+                    f.write(f"{j + 1} {ref_count + alt_count} {n_alleles[j]} {' '.join(counts)}\n")
+                f.write("\n")
+        polymorphic = n_alleles == 2
+        counts = np.empty((2 * len(self.pops), polymorphic.sum()), dtype=int)
+        counts[0::2], counts[1::2] = ref[:, polymorphic], alt[:, polymorphic]
+        np.savetxt(f"{self.prefix}.baypass", counts.T, fmt='%d', delimiter=' ')
+
+        dictionary_df = pd.DataFrame({
+            'scaffold': [scaffold_id(_) for _ in self.snp_df['scaffold']], 'pos': self.snp_df['pos'],
+            'id': self.snp_df['id'], 'index': np.arange(1, self.n.shape[1] + 1)
+        })
+        dictionary_df.to_csv(f"{self.prefix}.snps.id.dictionary.BAYESCAN.txt", sep='\t', header=False, index=False)
+        dictionary_df['index'].loc[~polymorphic].to_csv(
+            f"{self.prefix}.monomorphicsnpsindex2remove.txt", header=False, index=False)
+        baypass_df = dictionary_df[polymorphic].copy()
+        baypass_df['index'] = np.arange(1, len(baypass_df) + 1)
+        baypass_df.to_csv(f"{self.prefix}.snps.id.dictionary.BAYPASS.txt", sep='\t', header=False, index=False)
+        print(f"Wrote the BayeScan ({self.n.shape[1]} SNPs) and BayPass ({polymorphic.sum()} SNPs) inputs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bit packed genotype store built from a RADSeq VCF")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help="Stream a VCF (optionally .gz) into a genotype store")
+    build_parser.add_argument('vcf')
+    build_parser.add_argument('store_dir')
+    build_parser.add_argument('--chunk-snps', type=int, default=10000)
+    info_parser = subparsers.add_parser('info', help="Summarise a genotype store")
+    info_parser.add_argument('store_dir')
+    info_parser.add_argument('--strata', help="genclust.strata file to check the sample names against")
+    pca_parser = subparsers.add_parser('pca', help="Randomized PCA of the genotypes (plink --pca outputs)")
+    pca_parser.add_argument('store_dir')
+    pca_parser.add_argument('--prefix', required=True)
+    pca_parser.add_argument('--n-components', type=int, default=20)
+    pca_parser.add_argument('--maf', type=float, default=0)
+    ld_parser = subparsers.add_parser('ld', help="LD (r2) decay per genetic cluster")
+    ld_parser.add_argument('store_dir')
+    ld_parser.add_argument('--keep', nargs='+', required=True, help="sample list per cluster e.g. K6/SCL1.txt")
+    ld_parser.add_argument('--scaffolds', help="file listing the scaffolds to use e.g. Spis.10largest.Scaffolds")
+    ld_parser.add_argument('--prefix', default='LD')
+    ld_parser.add_argument('--maf', type=float, default=0.05)
+    ld_parser.add_argument('--max-dist', type=int, default=100000)
+    ld_parser.add_argument('--bin-width', type=int, default=100)
+    ld_parser.add_argument('--n-proc', type=int)
+    ld_parser.add_argument('--backend', help="'local' (default) or queue:<shared directory>")
+    fst_parser = subparsers.add_parser('fst', help="Weir & Cockerham pairwise FST with bootstrap CIs")
+    fst_parser.add_argument('store_dir')
+    fst_parser.add_argument('strata', help="genclust.strata file giving the population of each sample")
+    fst_parser.add_argument('--prefix', required=True)
+    fst_parser.add_argument('--n-boot', type=int, default=1000)
+    fst_parser.add_argument('--percent', type=float, default=95)
+    fst_parser.add_argument('--n-proc', type=int)
+    fst_parser.add_argument('--seed', type=int, default=42)
+    fst_parser.add_argument('--backend', help="'local' (default) or queue:<shared directory>")
+    outliers_parser = subparsers.add_parser(
+        'outliers', help="Per SNP FST and XtX outlier scan, writing the BayeScan and BayPass inputs")
+    outliers_parser.add_argument('store_dir')
+    outliers_parser.add_argument(
+        'strata', help="strata file giving the population (e.g. genetic cluster) of each sample")
+    outliers_parser.add_argument('--prefix', required=True)
+    outliers_parser.add_argument('--n-sim', type=int, default=100000, help="number of simulated neutral SNPs")
+    outliers_parser.add_argument('--upper-quantile', type=float, default=0.999)
+    outliers_parser.add_argument('--lower-quantile', type=float, default=0.001)
+    outliers_parser.add_argument('--maf', type=float, default=0)
+    outliers_parser.add_argument('--n-proc', type=int)
+    outliers_parser.add_argument('--seed', type=int, default=31689)
+    outliers_parser.add_argument('--backend', help="'local' (default) or queue:<shared directory>")
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        GenotypeStore.from_vcf(args.vcf, args.store_dir, chunk_snps=args.chunk_snps)
+    elif args.command == 'info':
+        store = GenotypeStore.open(args.store_dir)
+        maf = store.maf()
+        print(f"{store.n_snps} SNPs on {store.snp_df['scaffold'].nunique()} scaffolds x {store.n_samples} samples")
+        print(f"Missing rate {store.missing_rate().mean():.4f}; median MAF {np.nanmedian(maf):.4f}")
+        if args.strata:
+            strata = read_strata(args.strata)
+            in_store = set(store.sample_names)
+            print(f"{len(in_store.intersection(strata.index))} of the {len(strata)} strata samples are in the store")
+    elif args.command == 'pca':
+        store = GenotypeStore.open(args.store_dir)
+        if args.maf:
+            store = store.filter_maf(args.maf)
+        pc_df, eigenvalues, total_variance = randomized_pca(store, n_components=args.n_components)
+        write_plink_pca(pc_df, eigenvalues, args.prefix)
+        print(f"The first {len(eigenvalues)} PCs explain {100 * eigenvalues.sum() / total_variance:.2f}% of the variance")
+    elif args.command == 'ld':
+        LDDecay(
+            store_dir=args.store_dir,
+            cluster_dict={os.path.splitext(os.path.basename(_))[0]: _ for _ in args.keep},
+            scaffolds=read_scaffold_list(args.scaffolds) if args.scaffolds else None, prefix=args.prefix,
+            min_maf=args.maf, max_dist=args.max_dist, bin_width=args.bin_width, n_proc=args.n_proc,
+            backend=args.backend
+        )
+    elif args.command == 'fst':
+        PairwiseFST(
+            store_dir=args.store_dir, strata_path=args.strata, prefix=args.prefix, n_boot=args.n_boot,
+            percent=args.percent, n_proc=args.n_proc, seed=args.seed, backend=args.backend
+        )
+    elif args.command == 'outliers':
+        OutlierScan(
+            store_dir=args.store_dir, strata_path=args.strata, prefix=args.prefix, n_sim=args.n_sim,
+            upper_quantile=args.upper_quantile, lower_quantile=args.lower_quantile, min_maf=args.maf,
+            n_proc=args.n_proc, seed=args.seed, backend=args.backend
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# radseq_genotypes.py is a script rather than an installed package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
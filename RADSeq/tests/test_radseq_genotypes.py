@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+
+from radseq_genotypes import (
+    MISSING, GenotypeStore, OutlierScan, _outlier_null_chunk, _outlier_worker_init, pack_genotypes,
+    population_allele_summaries, standardized_frequencies, unpack_genotypes, weir_cockerham_components,
+    weir_cockerham_locus_components, xtx_statistic
+)
+
+
+def test_pack_unpack_round_trip():
+    rng = np.random.default_rng(0)
+    # 7 samples so that the last byte of every SNP is padded
+    codes = rng.integers(0, 4, size=(50, 7)).astype(np.uint8)
+    packed = pack_genotypes(codes)
+    assert packed.shape == (50, 2)
+    np.testing.assert_array_equal(unpack_genotypes(packed, 7), codes)
+
+
+def test_pack_known_byte():
+    # 4 samples per byte, the first sample in the lowest 2 bits
+    packed = pack_genotypes(np.array([[0, 1, 2, MISSING], [2, 0, 0, 0]], dtype=np.uint8))
+    np.testing.assert_array_equal(packed, [[0b11100100], [0b00000010]])
+
+
+def test_store_from_vcf(tmp_path):
+    vcf_path = tmp_path / 'test.vcf'
+    vcf_path.write_text(
+        "##fileformat=VCFv4.2\n"
+        "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT"
+        "\tSMAQ_R1_1_filtered\tSMAQ_R1_2_filtered\tSWAJ_R2_3_filtered\n"
+        "scaf1\t10\t1\tA\tG\t.\tPASS\t.\tGT\t0/0\t0/1\t1/1\n"
+        "scaf1\t20\t2\tC\tT\t.\tPASS\t.\tGT\t./.\t1|0\t0|0\n"
+        "scaf2\t5\t3\tG\tA\t.\tPASS\t.\tGT\t1/1\t1/1\t0/1\n"
+    )
+    store = GenotypeStore.from_vcf(str(vcf_path), str(tmp_path / 'store'), chunk_snps=2)
+    assert store.sample_names == ['SMAQ-R1-1', 'SMAQ-R1-2', 'SWAJ-R2-3']
+    np.testing.assert_array_equal(store.genotypes(), [[0, 1, 2], [MISSING, 1, 0], [2, 2, 1]])
+
+    reopened = GenotypeStore.open(str(tmp_path / 'store'))
+    reopened = reopened.subset(samples=['SWAJ-R2-3', 'SMAQ-R1-1'], scaffolds=['scaf1'])
+    np.testing.assert_array_equal(reopened.genotypes(), [[2, 0], [0, MISSING]])
+    alt, called = reopened.allele_counts()
+    np.testing.assert_array_equal(alt, [2, 0])
+    np.testing.assert_array_equal(called, [2, 1])
+
+
+def _store_of(codes, sample_names):
+    snp_df = pd.DataFrame({'scaffold': 'scaf1', 'pos': np.arange(len(codes)), 'id': '.', 'ref': 'A', 'alt': 'G'})
+    return GenotypeStore(None, pack_genotypes(np.array(codes, dtype=np.uint8)), snp_df, sample_names)
+
+
+def test_weir_cockerham_two_populations():
+    # Population 1: genotypes 0/0 and 0/1 (p = 0.25, h = 0.5), population 2: 1/1 and 1/1 (p = 1, h = 0), the missing
+    # sample is ignored. By hand with n = 2: p_bar = 0.625, s2 = 0.28125, h_bar = 0.25, so
+    # a = 0.28125 - (0.234375 - 0.140625 - 0.0625) = 0.25, b = 2 (0.234375 - 0.140625 - 0.375 * 0.25) = 0,
+    # c = 0.125 and FST = 0.25 / 0.375 = 2 / 3
+    store = _store_of([[0, 1, 2, 2, MISSING]], ['a', 'b', 'c', 'd', 'e'])
+    n, alt, het = population_allele_summaries(
+        store, {'a': 'pop1', 'b': 'pop1', 'c': 'pop2', 'd': 'pop2', 'e': 'pop2'}, ['pop1', 'pop2'])
+    np.testing.assert_array_equal(n, [[2], [2]])
+    np.testing.assert_array_equal(alt, [[1], [4]])
+    np.testing.assert_array_equal(het, [[1], [0]])
+
+    a, abc = weir_cockerham_components(n, alt, het, np.array([1]), np.array([0]))
+    np.testing.assert_allclose(a, [[0.25]])
+    np.testing.assert_allclose(abc, [[0.375]])
+    np.testing.assert_allclose(a.sum(axis=1) / abc.sum(axis=1), [2 / 3])
+
+    # The multi population components reduce to the same for 2 populations
+    a_locus, abc_locus = weir_cockerham_locus_components(n, alt, het)
+    np.testing.assert_allclose(a_locus, [0.25])
+    np.testing.assert_allclose(abc_locus, [0.375])
+
+
+def test_weir_cockerham_identical_populations():
+    # Identical allele frequencies and heterozygosities: no differentiation (a < 0 for the sampling correction)
+    n = np.array([[10.0], [10.0]])
+    alt = np.array([[10.0], [10.0]])
+    het = np.array([[4.0], [4.0]])
+    a, abc = weir_cockerham_components(n, alt, het, np.array([1]), np.array([0]))
+    assert a[0, 0] < 0
+    assert abc[0, 0] > 0
+
+
+def test_weir_cockerham_uncalled_snp_is_dropped():
+    n = np.array([[1.0, 5.0], [5.0, 5.0]])
+    alt = np.array([[1.0, 2.0], [3.0, 8.0]])
+    het = np.array([[1.0, 2.0], [1.0, 0.0]])
+    a, abc = weir_cockerham_components(n, alt, het, np.array([1]), np.array([0]))
+    assert a[0, 0] == 0 and abc[0, 0] == 0
+    assert abc[0, 1] > 0
+
+
+def test_xtx_statistic():
+    rng = np.random.default_rng(5)
+    n = rng.integers(5, 20, size=(3, 6)).astype(float)
+    alt = np.floor(rng.random((3, 6)) * 2 * n)
+    y, pi = standardized_frequencies(n, alt)
+    np.testing.assert_allclose(pi, (alt / (2 * n)).mean(axis=0))
+    omega = np.cov(rng.normal(size=(3, 10)))
+    omega_pinv = np.linalg.pinv(omega)
+    np.testing.assert_allclose(xtx_statistic(y, omega_pinv), [y[:, l] @ omega_pinv @ y[:, l] for l in range(6)])
+
+
+def test_empirical_p():
+    sorted_null = np.sort(np.random.default_rng(6).random(99))
+    observed = np.array([-1, 0.5, sorted_null[10], 2, np.nan])
+    expected = [(np.sum(sorted_null >= x) + 1) / 100 for x in observed[:4]] + [np.nan]
+    np.testing.assert_allclose(OutlierScan._empirical_p(sorted_null, observed), expected)
+
+
+def test_outlier_null_chunk():
+    rng = np.random.default_rng(7)
+    n = rng.integers(10, 30, size=(3, 50)).astype(float)
+    pi = rng.uniform(0.1, 0.9, 50)
+    _outlier_worker_init(n, pi, 0.1 * np.eye(3), np.eye(3), 0.0, 0.0)
+    fst, xtx = _outlier_null_chunk(np.random.SeedSequence(8), 200)
+    assert len(fst) == len(xtx) and 0 < len(fst) <= 200
+    fst_again, xtx_again = _outlier_null_chunk(np.random.SeedSequence(8), 200)
+    np.testing.assert_array_equal(fst, fst_again)
+    np.testing.assert_array_equal(xtx, xtx_again)
+    # Without drift the populations only differ by sampling so that the FST is centred on 0
+    _outlier_worker_init(n, pi, np.zeros((3, 3)), np.eye(3), 0.0, 0.0)
+    fst, _ = _outlier_null_chunk(np.random.SeedSequence(8), 2000)
+    assert abs(np.nanmean(fst)) < 0.01